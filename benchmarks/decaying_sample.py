@@ -0,0 +1,75 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Measure the update throughput of the 1028-value exponentially decaying
+samples, the sorted-list L{ExponentiallyDecayingSample} against the
+L{HeapExponentiallyDecayingSample}, and the time one rescale takes.
+
+Run from the top of the source tree:
+
+    python benchmarks/decaying_sample.py [updates]
+"""
+
+import random
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.stats.exponentiallydecayingsample import (
+    ExponentiallyDecayingSample, HeapExponentiallyDecayingSample)
+
+
+def bench(sample_class, updates):
+    now = [0.0]
+    sample = sample_class(1028, 0.015, wall_time=lambda: now[0])
+    rnd = random.Random(0)
+    values = [rnd.lognormvariate(3, 1) for i in range(updates)]
+    # Spread the updates over five minutes, within one rescale period.
+    step = 300.0 / updates
+
+    start = time.time()
+    for value in values:
+        sample.update(value)
+        now[0] += step
+    elapsed = time.time() - start
+
+    rescales = 100
+    start = time.time()
+    for i in range(rescales):
+        sample.rescale(now[0], now[0])
+    rescale = (time.time() - start) / rescales
+    return elapsed, rescale
+
+
+def main(args):
+    updates = int(args[0]) if args else 200000
+    print "%d updates of a 1028-value sample" % updates
+    for sample_class in (ExponentiallyDecayingSample,
+                         HeapExponentiallyDecayingSample):
+        elapsed, rescale = bench(sample_class, updates)
+        print "%-32s %8.0f updates/s %8.3f ms/rescale" % (
+            sample_class.__name__, updates / elapsed, rescale * 1000)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
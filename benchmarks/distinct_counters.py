@@ -0,0 +1,78 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compare the C{pdistinct} counters: the SBox L{SlidingDistinctCounter} and
+L{SlidingHyperLogLog}, for update throughput, flush time and the error of
+each sliding window.
+
+Run from the top of the source tree:
+
+    python benchmarks/distinct_counters.py [items]
+"""
+
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.metrics.distinctmetric import (
+    DistinctMetricReporter, SlidingDistinctCounter, SlidingHyperLogLog)
+
+
+def bench(name, counter, items):
+    now = [0]
+    reporter = DistinctMetricReporter("bench", wall_time_func=lambda: now[0],
+                                      counter=counter)
+    # One item a second, each distinct, so a window of n seconds holds n.
+    keys = [str(i) for i in range(items)]
+    start = time.time()
+    for i, key in enumerate(keys):
+        now[0] = i + 1
+        reporter.update(key)
+    elapsed = time.time() - start
+
+    start = time.time()
+    metrics = dict((metric, value) for metric, value, _ in
+                   reporter.flush(10, now[0]))
+    flush = time.time() - start
+
+    errors = []
+    for suffix, expected in (("count", items), ("count_1hour", 3600),
+                             ("count_1day", 86400)):
+        expected = min(expected, items)
+        value = metrics["bench." + suffix]
+        errors.append("%s %+.1f%%" % (
+            suffix, 100.0 * (value - expected) / expected))
+    print "%-12s %9.0f items/s %7.1f ms flush  %s" % (
+        name, items / elapsed, flush * 1000, "  ".join(errors))
+
+
+def main(args):
+    items = int(args[0]) if args else 200000
+    print "%d distinct items, one per second" % items
+    bench("sbox", SlidingDistinctCounter(32, 32), items)
+    for precision in (10, 12, 14):
+        bench("hll p=%d" % precision, SlidingHyperLogLog(precision), items)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
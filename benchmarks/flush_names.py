@@ -0,0 +1,112 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Flush many counter, timer and gauge keys twice, and count the name
+strings each flush allocates, against the previous way of concatenating
+every name on every flush.
+
+Run from the top of the source tree:
+
+    python benchmarks/flush_names.py [keys-per-kind]
+"""
+
+import gc
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.server.processor import MessageProcessor
+
+
+class LegacyMessageProcessor(MessageProcessor):
+    """Datapoint names as they were built before L{OutputNames}."""
+
+    def flush_counter_metrics(self, interval, timestamp):
+        for key, count in self.counter_metrics.iteritems():
+            self.counter_metrics[key] = 0
+            value = count / interval
+            yield ((self.stats_prefix + key, value, timestamp),
+                   (self.count_prefix + key, count, timestamp))
+
+    def format_timer_metrics(self, key, percentiles, timestamp, count, lower,
+                             upper, thresholds):
+        items = {".upper": upper,
+                 ".lower": lower,
+                 ".count": count}
+        for (_, mean_names, upper_name), (mean, threshold_upper) in zip(
+            percentiles, thresholds):
+            for mean_name in mean_names:
+                items[mean_name] = mean
+            if upper_name is not None:
+                items[upper_name] = threshold_upper
+        return sorted((self.timer_prefix + key + item, value, timestamp)
+                      for item, value in items.iteritems())
+
+    def flush_gauge_metrics(self, timestamp):
+        for key, value in self.gauge_metrics.iteritems():
+            yield ((self.gauge_prefix + key + ".value", value, timestamp),)
+
+
+def fill(processor, keys):
+    for i in range(keys):
+        processor.counter_metrics["app.requests.%d" % i] = i
+        processor.timer_metrics["app.latency.%d" % i] = [i, i + 1, i + 2]
+        processor.gauge_metrics["app.queue.%d" % i] = i
+
+
+def bench(processor_class, keys):
+    """
+    Return the CPU time of the second flush, how many datapoints it
+    reported and how many of their names were not already reported by the
+    first one.
+    """
+    processor = processor_class(time_function=lambda: 42)
+    fill(processor, keys)
+    # The first flush stays alive, so that the ids of its names are not
+    # reused by the second.
+    first = list(processor.flush())
+    previous = set(id(name) for name, value, timestamp in first)
+    fill(processor, keys)
+
+    gc.disable()
+    start = time.clock()
+    datapoints = list(processor.flush())
+    elapsed = time.clock() - start
+    gc.enable()
+    fresh = sum(1 for name, value, timestamp in datapoints
+                if id(name) not in previous)
+    return elapsed, len(datapoints), fresh
+
+
+def main(args):
+    keys = int(args[0]) if args else 100000
+    print "%d keys each of counters, timers and gauges" % keys
+    for name, processor_class in (("legacy", LegacyMessageProcessor),
+                                  ("interned", MessageProcessor)):
+        elapsed, datapoints, fresh = bench(processor_class, keys)
+        print "%-9s %7.3fs %8d datapoints %8d new name strings" % (
+            name, elapsed, datapoints, fresh)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
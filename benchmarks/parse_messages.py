@@ -0,0 +1,152 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Measure how many StatsD lines per second L{MessageProcessor.process}
+handles over mixed traffic, against the previous split, regex and
+C{if/elif} based parser.
+
+Run from the top of the source tree:
+
+    python benchmarks/parse_messages.py [messages] [keys]
+"""
+
+import gc
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.server.processor import MessageProcessor
+
+
+RATE = re.compile("^@([\d\.]+)")
+
+
+class LegacyMessageProcessor(MessageProcessor):
+    """The parsing and dispatch path as it was before C{parse_message}."""
+
+    def process(self, message):
+        if not ":" in message:
+            return self.fail(message)
+
+        key, data = message.strip().split(":", 1)
+        if not "|" in data:
+            return self.fail(message)
+
+        fields = data.split("|")
+        if len(fields) < 2 or len(fields) > 3:
+            return self.fail(message)
+
+        key = self.normalize_key(key)
+        metric_type = fields[1]
+        return self.process_message(message, metric_type, key, fields)
+
+    def process_message(self, message, metric_type, key, fields):
+        start = self.time_function()
+        if metric_type == "c":
+            self.process_counter_metric(key, fields, message)
+        elif metric_type == "ms":
+            self.process_timer_metric(key, fields[0], message)
+        elif metric_type == "g":
+            self.process_gauge_metric(key, fields[0], message)
+        elif metric_type == "m":
+            self.process_meter_metric(key, fields[0], message)
+        elif metric_type in self.plugins:
+            self.process_plugin_metric(metric_type, key, fields, message)
+        else:
+            return self.fail(message)
+        self.process_timings.setdefault(metric_type, 0)
+        self.process_timings[metric_type] += self.time_function() - start
+        self.by_type.setdefault(metric_type, 0)
+        self.by_type[metric_type] += 1
+
+    def process_counter_metric(self, key, composite, message):
+        try:
+            value = float(composite[0])
+        except (TypeError, ValueError):
+            return self.fail(message)
+        rate = 1
+        if len(composite) == 3:
+            match = RATE.match(composite[2])
+            if match is None:
+                return self.fail(message)
+            rate = match.group(1)
+
+        self.compose_counter_metric(key, value, rate)
+
+
+def traffic(count, keys):
+    """
+    Build C{count} lines over C{keys} keys: half counters (a fifth of them
+    sampled), a third timers, and the rest gauges and meters.
+    """
+    rnd = random.Random(0)
+    lines = []
+    for i in range(count):
+        key = "app.server%d.requests.%d" % (i % 16, rnd.randrange(keys))
+        kind = rnd.random()
+        if kind < 0.4:
+            lines.append("%s:1|c" % key)
+        elif kind < 0.5:
+            lines.append("%s:1|c|@0.1" % key)
+        elif kind < 0.83:
+            lines.append("%s:%.3f|ms" % (key, rnd.lognormvariate(3, 1)))
+        elif kind < 0.93:
+            lines.append("%s:%d|g" % (key, rnd.randrange(1000)))
+        else:
+            lines.append("%s:1|m" % key)
+    return lines
+
+
+def bench(processor_class, lines):
+    gc.collect()
+    processor = processor_class()
+    process = processor.process
+    # CPU time is much steadier than wall time on a shared machine.
+    start = time.clock()
+    for line in lines:
+        process(line)
+    return time.clock() - start
+
+
+def main(args):
+    count = int(args[0]) if args else 500000
+    keys = int(args[1]) if len(args) > 1 else 1000
+    lines = traffic(count, keys)
+    print "%d messages over %d keys" % (count, keys)
+    candidates = (("before", LegacyMessageProcessor),
+                  ("after", MessageProcessor))
+    # Alternate the runs so that both see the same machine noise.
+    best = {}
+    for i in range(9):
+        for name, processor_class in candidates:
+            elapsed = bench(processor_class, lines)
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name, processor_class in candidates:
+        print "%-7s %7.3fs %10.0f messages/s" % (
+            name, best[name], count / best[name])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,94 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Micro-benchmark the percentile engine of L{HistogramMetricReporter} on
+1028-element reservoirs: a full sort against selecting only the ranks
+needed, in pure Python and with NumPy when it is installed.
+
+Run from the top of the source tree:
+
+    python benchmarks/percentiles.py [reservoirs]
+"""
+
+import math
+import random
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.stats import selection
+
+
+def full_sort(values, *percentiles):
+    values = sorted(values)
+    scores = []
+    for p in percentiles:
+        pos = p * (len(values) + 1)
+        if pos < 1:
+            scores.append(values[0])
+        elif pos >= len(values):
+            scores.append(values[-1])
+        else:
+            lower = values[int(pos) - 1]
+            upper = values[int(pos)]
+            scores.append(lower + (pos - math.floor(pos)) * (upper - lower))
+    return scores
+
+
+def bench(function, reservoirs, percentiles):
+    start = time.time()
+    for values in reservoirs:
+        function(values, *percentiles)
+    return time.time() - start
+
+
+def main(args):
+    count = int(args[0]) if args else 2000
+    rnd = random.Random(0)
+    reservoirs = [[rnd.lognormvariate(3, 1) for i in range(1028)]
+                  for j in range(count)]
+    numpy = selection.numpy
+    engines = [("sort", full_sort)]
+    if numpy is not None:
+        engines.append(("numpy", selection.percentiles))
+
+    def pure(values, *percentiles):
+        selection.numpy = None
+        try:
+            return selection.percentiles(values, *percentiles)
+        finally:
+            selection.numpy = numpy
+    engines.append(("heapq", pure))
+
+    print "%d reservoirs of 1028 values" % count
+    for name, percentiles in (
+        ("timer", (0.99, 0.999)),
+        ("histogram", (0.5, 0.75, 0.95, 0.98, 0.99, 0.999))):
+        for engine, function in engines:
+            elapsed = bench(function, reservoirs, percentiles)
+            print "%-10s %-6s %7.3fs %8.1f us/reservoir" % (
+                name, engine, elapsed, elapsed / count * 1e6)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
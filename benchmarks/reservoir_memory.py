@@ -0,0 +1,118 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Measure the memory held by timers in L{ConfigurableMessageProcessor},
+whose every key owns a 1028-value L{UniformSample} reservoir, with the
+current array-backed reservoir and with the previous eagerly allocated
+list.
+
+Run from the top of the source tree:
+
+    python benchmarks/reservoir_memory.py [keys] [samples-per-key]
+
+Each reservoir is measured in a fresh interpreter so that peak RSS is not
+shared between them.
+"""
+
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.metrics import timermetric
+from txstatsd.server.configurableprocessor import ConfigurableMessageProcessor
+from txstatsd.stats.uniformsample import UniformSample
+
+
+class ListUniformSample(UniformSample):
+    """The reservoir as it was: a list allocated in full up front."""
+
+    def __init__(self, reservoir_size):
+        self.reservoir_size = reservoir_size
+        self._values = [0 for i in range(reservoir_size)]
+        self._count = 0
+        self.maxint = sys.maxint
+
+    def clear(self):
+        self._values = [0 for i in range(len(self._values))]
+        self._count = 0
+
+    def update(self, value):
+        self._count += 1
+        if self._count <= len(self._values):
+            self._values[self._count - 1] = value
+        else:
+            r = random.randint(1, self.maxint) % self._count
+            if r < len(self._values):
+                self._values[r] = value
+
+    def get_values(self):
+        return self._values[:self.size()]
+
+
+def rss():
+    """Return the peak resident set size of this process in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(reservoir, keys, samples):
+    if reservoir == "list":
+        timermetric.UniformSample = ListUniformSample
+    processor = ConfigurableMessageProcessor(time_function=lambda: 42)
+    rnd = random.Random(0)
+    durations = [rnd.lognormvariate(3, 1) for i in range(samples)]
+
+    before = rss()
+    start = time.time()
+    for i in range(keys):
+        key = "timer.%d" % i
+        processor.compose_timer_metric(key, 0)
+        for duration in durations:
+            processor.compose_timer_metric(key, duration)
+    elapsed = time.time() - start
+    memory = rss() - before
+
+    start = time.time()
+    for metrics in processor.flush_timer_metrics(90, 42):
+        pass
+    flush = time.time() - start
+    print "%-6s %9d KiB %8.2fs create %8.2fs flush" % (
+        reservoir, memory, elapsed, flush)
+
+
+def main(args):
+    keys = int(args[0]) if args else 100000
+    samples = int(args[1]) if len(args) > 1 else 4
+    print "%d timer keys, %d samples each" % (keys, samples + 1)
+    for reservoir in ("list", "array"):
+        subprocess.check_call([sys.executable, __file__, "--reservoir",
+                               reservoir, str(keys), str(samples)])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--reservoir"]:
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
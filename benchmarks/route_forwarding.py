@@ -0,0 +1,105 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Route messages through a pure forwarding ruleset, which redirects every
+message over UDP and hands it to the processor unmodified, against the
+previous way of rebuilding each message in every redirect and again for
+the processor.
+
+The redirect service is never started, so the datagrams queue in the
+client and are not sent; what is measured is the routing itself.
+
+Run from the top of the source tree:
+
+    python benchmarks/route_forwarding.py [messages] [keys]
+"""
+
+import gc
+import random
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from twisted.application.service import MultiService
+
+from txstatsd.server.router import Router
+
+
+RULES = ("any => redirect_udp 127.0.0.1 8125\n"
+         "metric_type c => redirect_udp 127.0.0.1 8126")
+
+
+class NullProcessor(object):
+
+    def process_message(self, message, metric_type, key, fields):
+        pass
+
+    def flush(self):
+        pass
+
+
+class LegacyRouter(Router):
+    """Messages rebuilt at every redirect and for the processor."""
+
+    def is_raw_message(self, message, key):
+        return False
+
+
+def bench(router_class, messages):
+    router = router_class(NullProcessor(), RULES, service=MultiService())
+    gc.disable()
+    start = time.clock()
+    for message in messages:
+        router.process(message)
+    elapsed = time.clock() - start
+    gc.enable()
+    return elapsed
+
+
+def main(args):
+    count = int(args[0]) if args else 200000
+    keys = int(args[1]) if len(args) > 1 else 1000
+    rnd = random.Random(0)
+    messages = []
+    for i in range(count):
+        key = "app.web%d.requests.%d" % (rnd.randrange(10),
+                                         rnd.randrange(keys))
+        messages.append(rnd.choice(["%s:1|c", "%s:1|c|@0.1", "%s:%d|ms",
+                                    "%s:%d|g"]).replace("%d", str(i % 500))
+                        % key)
+    print "%d messages over %d keys, rules:" % (count, keys)
+    print RULES
+    best = {}
+    # Alternate the runs, so that both routers see the same noise.
+    for run in range(5):
+        for name, router_class in (("rebuild", LegacyRouter),
+                                   ("forward", Router)):
+            elapsed = bench(router_class, messages)
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name in ("rebuild", "forward"):
+        print "%-8s %7.3fs %8.0f messages/s" % (
+            name, best[name], count / best[name])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
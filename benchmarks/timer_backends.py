@@ -0,0 +1,90 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compare the memory held and the flush time of the timer backends of
+L{MessageProcessor}: the default list of durations and the DDSketch
+enabled by C{--timer-accuracy}.
+
+Run from the top of the source tree:
+
+    python benchmarks/timer_backends.py [keys] [samples-per-key]
+
+Each backend is measured in a fresh interpreter so that peak RSS is not
+shared between them.
+"""
+
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.server.processor import MessageProcessor
+
+
+def rss():
+    """Return the peak resident set size of this process in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(backend, keys, samples):
+    accuracy = {"list": None, "sketch": 0.01}[backend]
+    processor = MessageProcessor(time_function=lambda: 42,
+                                 timer_accuracy=accuracy)
+    rnd = random.Random(0)
+    # Parse every duration as the processor would, so that each sample is
+    # a distinct float object.
+    durations = ["%.3f" % rnd.lognormvariate(3, 1) for i in range(samples)]
+
+    before = rss()
+    start = time.time()
+    for i in range(keys):
+        key = "timer.%d" % i
+        for duration in durations:
+            processor.compose_timer_metric(key, float(duration))
+    ingest = time.time() - start
+    memory = rss() - before
+
+    start = time.time()
+    for metrics in processor.flush_timer_metrics(90, 42):
+        pass
+    flush = time.time() - start
+    print "%-7s %9d KiB %8.2fs ingest %8.2fs flush" % (
+        backend, memory, ingest, flush)
+
+
+def main(args):
+    keys = int(args[0]) if args else 1000
+    samples = int(args[1]) if len(args) > 1 else 5000
+    print "%d timer keys, %d samples each" % (keys, samples)
+    for backend in ("list", "sketch"):
+        subprocess.check_call([sys.executable, __file__, "--backend",
+                               backend, str(keys), str(samples)])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--backend"]:
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,81 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Time L{MessageProcessor.flush_timer_metrics} over many timer keys, with
+one percentile and with the four reported by C{--percentiles
+50,90,99,99.9}.
+
+Run from the top of the source tree:
+
+    python benchmarks/timer_flush.py [keys] [samples-per-key]
+"""
+
+import random
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+from txstatsd.server.processor import MessageProcessor
+
+
+def fill(processor, keys, samples):
+    rnd = random.Random(0)
+    durations = [rnd.lognormvariate(3, 1) for i in range(samples)]
+    for i in range(keys):
+        processor.timer_metrics["timer.%d" % i] = [
+            rnd.choice(durations) for j in range(samples)]
+
+
+def bench(keys, samples, percent, accuracy=None):
+    processor = MessageProcessor(time_function=lambda: 42,
+                                 timer_accuracy=accuracy)
+    if accuracy is None:
+        fill(processor, keys, samples)
+    else:
+        rnd = random.Random(0)
+        for i in range(keys):
+            for j in range(samples):
+                processor.compose_timer_metric(
+                    "timer.%d" % i, rnd.lognormvariate(3, 1))
+
+    start = time.time()
+    datapoints = 0
+    for metrics in processor.flush_timer_metrics(percent, 42):
+        datapoints += len(metrics)
+    return time.time() - start, datapoints
+
+
+def main(args):
+    keys = int(args[0]) if args else 50000
+    samples = int(args[1]) if len(args) > 1 else 20
+    print "%d timer keys, %d samples each" % (keys, samples)
+    for backend, accuracy in (("list", None), ("sketch", 0.01)):
+        for percent in ([90], [50, 90, 99, 99.9]):
+            elapsed, datapoints = bench(keys, samples, percent, accuracy)
+            print "%-7s %-16s %7.3fs %8d datapoints %8.0f keys/s" % (
+                backend, ",".join(map(str, percent)), elapsed, datapoints,
+                keys / elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
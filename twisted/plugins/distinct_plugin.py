@@ -23,7 +23,8 @@ from zope.interface import implements
 
 from twisted.plugin import IPlugin
 from txstatsd.itxstatsd import IMetricFactory
-from txstatsd.metrics.distinctmetric import DistinctMetricReporter
+from txstatsd.metrics.distinctmetric import (
+    DistinctMetricReporter, SlidingHyperLogLog)
 
 
 class DistinctMetricFactory(object):
@@ -32,11 +33,25 @@ class DistinctMetricFactory(object):
     name = "pdistinct"
     metric_type = "pd"
 
+    seeded = False
+    precision = None
+
     def build_metric(self, prefix, name, wall_time_func=None):
+        seed = name if self.seeded else None
+        counter = None
+        if self.precision is not None:
+            counter = SlidingHyperLogLog(self.precision)
         return DistinctMetricReporter(name, prefix=prefix,
-                                      wall_time_func=wall_time_func)
+                                      wall_time_func=wall_time_func,
+                                      seed=seed, counter=counter)
 
     def configure(self, options):
-        pass
+        # Worker processes must hash alike for their counters to merge.
+        self.seeded = bool(options.get("workers"))
+
+        section = dict(options.get("plugin_pdistinct", {}))
+        self.precision = None
+        if section.get("backend", "sbox") == "hyperloglog":
+            self.precision = int(section.get("precision", 10))
 
 distinct_metric_factory = DistinctMetricFactory()
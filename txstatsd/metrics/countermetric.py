@@ -78,11 +78,12 @@ class CounterMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.output_name = prefix + name + ".count"
         self.count = 0
 
     def mark(self, value):
         self.count = value
 
     def report(self, timestamp):
-        return [(self.prefix + self.name + ".count",
+        return [(self.output_name,
                  math.trunc(self.count), timestamp)]
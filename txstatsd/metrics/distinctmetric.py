@@ -25,10 +25,16 @@ Based on:
 http://citeseerx.ist.psu.edu/viewdoc/summary?doi=10.1.1.12.7100
 
 And extended for sliding windows.
+
+L{SlidingHyperLogLog} is a faster and more accurate alternative, based on:
+http://hal.archives-ouvertes.fr/hal-00465313
 """
+import math
 import random
+import struct
 import time
 import sys
+from hashlib import md5
 
 from zope.interface import implementer, implements
 
@@ -42,11 +48,13 @@ class SBoxHash(object):
     This class create a random hash function that is very fast.
     Based on SBOXes. Not Crypto Strong.
 
-    Two instances of this class will hash differently.
+    Two instances of this class will hash differently, unless they are
+    created with the same C{seed}.
     """
 
-    def __init__(self):
-        self.table = [random.randint(0, 0xFFFFFFFF - 1) for i in range(256)]
+    def __init__(self, seed=None):
+        rand = random if seed is None else random.Random(seed)
+        self.table = [rand.randint(0, 0xFFFFFFFF - 1) for i in range(256)]
 
     def hash(self, data):
         value = 0
@@ -81,11 +89,15 @@ def zeros(n):
 class SlidingDistinctCounter(object):
     """A probabilistic distinct counter with sliding windows."""
 
-    def __init__(self, n_hashes, n_buckets):
+    def __init__(self, n_hashes, n_buckets, seed=None):
         self.n_hashes = n_hashes
         self.n_buckets = n_buckets
 
-        self.hashes = [SBoxHash() for i in range(n_hashes)]
+        if seed is None:
+            self.hashes = [SBoxHash() for i in range(n_hashes)]
+        else:
+            self.hashes = [SBoxHash("%s:%d" % (seed, i))
+                           for i in range(n_hashes)]
         self.buckets = [[0] * n_buckets for i in range(n_hashes)]
 
     def add(self, when, item):
@@ -93,6 +105,16 @@ class SlidingDistinctCounter(object):
         for i, value in enumerate(hashes):
             self.buckets[i][min(self.n_buckets - 1, zeros(value))] = when
 
+    def merge(self, other):
+        """
+        Fold the buckets of another counter, built with the same seed, into
+        this one.
+        """
+        for mine, theirs in zip(self.buckets, other.buckets):
+            for b in range(self.n_buckets):
+                if theirs[b] > mine[b]:
+                    mine[b] = theirs[b]
+
     def distinct(self, since=0):
         total = 0.0
         for i in range(self.n_hashes):
@@ -106,6 +128,92 @@ class SlidingDistinctCounter(object):
         return int((2 ** v) / 0.77351)
 
 
+class SlidingHyperLogLog(object):
+    """
+    A HyperLogLog distinct counter with sliding windows.
+
+    Each item is hashed once, to 64 bits. The first C{precision} bits pick
+    one of C{2 ** precision} registers and the position of the lowest set
+    bit in the rest is the rank recorded in it. Instead of the highest rank
+    seen, every register keeps the ranks that could still be its highest
+    within some window: pairs of (time, rank) where later pairs have lower
+    ranks. Any window ending now can then be answered exactly as a plain
+    HyperLogLog over the items seen in it.
+
+    The relative standard error of an estimate is about
+    C{1.04 / sqrt(2 ** precision)}: 3.3% with the default precision of 10,
+    1.6% with 12. Small counts use linear counting and are more accurate.
+    Counters with the same precision can always be merged, since the hash
+    is not randomised.
+    """
+
+    def __init__(self, precision=10):
+        if not 4 <= precision <= 16:
+            raise ValueError("Precision must be between 4 and 16.")
+        self.precision = precision
+        self.n_registers = 1 << precision
+        self.rank_bits = 64 - precision
+        self.registers = {}
+        if self.n_registers >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.n_registers)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.n_registers]
+
+    def add(self, when, item):
+        value, = struct.unpack("<Q", md5(item).digest()[:8])
+        index = value >> self.rank_bits
+        rest = value & ((1 << self.rank_bits) - 1)
+        # The rank is one more than the leading zeros of the rest; bin()
+        # stands in for int.bit_length(), which needs Python 2.7.
+        if rest:
+            rank = self.rank_bits - (len(bin(rest)) - 2) + 1
+        else:
+            rank = self.rank_bits + 1
+        pairs = self.registers.get(index)
+        if pairs is None:
+            self.registers[index] = [(when, rank)]
+            return
+        # Older pairs with a rank no higher than this one can no longer be
+        # the highest of any window.
+        while pairs and pairs[-1][1] <= rank:
+            pairs.pop()
+        pairs.append((when, rank))
+
+    def merge(self, other):
+        """
+        Fold the registers of another counter with the same precision into
+        this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge counters of different precision.")
+        for index, theirs in other.registers.iteritems():
+            pairs = sorted(self.registers.get(index, []) + theirs)
+            merged = []
+            for when, rank in pairs:
+                while merged and merged[-1][1] <= rank:
+                    merged.pop()
+                merged.append((when, rank))
+            self.registers[index] = merged
+
+    def distinct(self, since=0):
+        total = 0.0
+        empty = self.n_registers
+        for pairs in self.registers.itervalues():
+            # Ranks decrease with time, so the first pair in the window
+            # holds the highest rank.
+            for when, rank in pairs:
+                if when > since:
+                    total += 2.0 ** -rank
+                    empty -= 1
+                    break
+        total += empty
+        m = self.n_registers
+        estimate = self.alpha * m * m / total
+        if estimate <= 2.5 * m and empty:
+            estimate = m * math.log(float(m) / empty)
+        return int(round(estimate))
+
+
 class DistinctMetric(Metric):
     """
     Keeps an estimate of the distinct numbers of items seen on various
@@ -125,20 +233,32 @@ class DistinctMetricReporter(object):
     if sys.version_info[0:2] == (2,6):
         implements(IMetric)
 
-    def __init__(self, name, wall_time_func=time.time, prefix=""):
+    items = (".count", ".count_1min", ".count_1hour", ".count_1day")
+
+    def __init__(self, name, wall_time_func=time.time, prefix="",
+                 seed=None, counter=None):
         """Construct a metric we expect to be periodically updated.
 
         @param name: Indicates what is being instrumented.
         @param wall_time_func: Function for obtaining wall time.
         @param prefix: If present, a string to prepend to the message
             composed when C{report} is called.
+        @param seed: If present, the seed for the hash functions, so that
+            reporters built with the same seed can be merged.
+        @param counter: If present, the sliding distinct counter to use,
+            such as a L{SlidingHyperLogLog}, instead of a
+            L{SlidingDistinctCounter}.
         """
         self.name = name
         self.wall_time_func = wall_time_func
-        self.counter = SlidingDistinctCounter(32, 32)
+        if counter is None:
+            counter = SlidingDistinctCounter(32, 32, seed=seed)
+        self.counter = counter
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.names = [(item, prefix + name + item)
+                      for item in sorted(self.items)]
 
     def count(self):
         return self.counter.distinct()
@@ -155,19 +275,20 @@ class DistinctMetricReporter(object):
     def process(self, fields):
         self.update(fields[0])
 
+    def merge(self, other):
+        """Fold the items seen by another reporter for this name."""
+        self.counter.merge(other.counter)
+
     def update(self, item):
         self.counter.add(self.wall_time_func(), item)
 
     def flush(self, interval, timestamp):
         now = self.wall_time_func()
-        metrics = []
         items = {".count": self.count(),
                  ".count_1min": self.count_1min(now),
                  ".count_1hour": self.count_1hour(now),
                  ".count_1day": self.count_1day(now)}
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item, value, timestamp))
-        return metrics
+        return [(name, items[item], timestamp) for item, name in self.names]
 
 # if we are running anything >= 2.7
 if sys.version_info[0:2] >= (2,7):
@@ -55,10 +55,11 @@ class GaugeMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.output_name = prefix + name + ".value"
         self.value = 0
 
     def mark(self, value):
         self.value = value
 
     def report(self, timestamp):
-        return [(self.prefix + self.name + ".value", self.value, timestamp)]
+        return [(self.output_name, self.value, timestamp)]
@@ -22,9 +22,11 @@
 
 import math
 
-from txstatsd.stats.exponentiallydecayingsample \
-    import ExponentiallyDecayingSample
-from txstatsd.stats.uniformsample import UniformSample
+from txstatsd.stats import selection
+from txstatsd.stats.exponentiallydecayingsample import (
+    ExponentiallyDecayingSample, HeapExponentiallyDecayingSample)
+from txstatsd.stats.uniformsample import (
+    SkippingUniformSample, UniformSample)
 
 
 class HistogramMetricReporter(object):
@@ -37,24 +39,36 @@ class HistogramMetricReporter(object):
     """
 
     @classmethod
-    def using_uniform_sample(cls, prefix=""):
+    def using_uniform_sample(cls, prefix="", skipping=False):
         """
         Uses a uniform sample of 1028 elements, which offers a 99.9%
         confidence level with a 5% margin of error assuming a normal
         distribution.
+
+        @param skipping: If true, uses a L{SkippingUniformSample}, which
+            is cheaper to update once the sample is full.
          """
-        sample = UniformSample(1028)
+        if skipping:
+            sample = SkippingUniformSample(1028)
+        else:
+            sample = UniformSample(1028)
         return HistogramMetricReporter(sample, prefix=prefix)
 
     @classmethod
-    def using_exponentially_decaying_sample(cls, prefix=""):
+    def using_exponentially_decaying_sample(cls, prefix="", heap=False):
         """
         Uses an exponentially decaying sample of 1028 elements, which offers
         a 99.9% confidence level with a 5% margin of error assuming a normal
         distribution, and an alpha factor of 0.015, which heavily biases
         the sample to the past 5 minutes of measurements.
+
+        @param heap: If true, uses a L{HeapExponentiallyDecayingSample},
+            which is cheaper to update once the sample is full.
         """
-        sample = ExponentiallyDecayingSample(1028, 0.015)
+        if heap:
+            sample = HeapExponentiallyDecayingSample(1028, 0.015)
+        else:
+            sample = ExponentiallyDecayingSample(1028, 0.015)
         return HistogramMetricReporter(sample, prefix=prefix)
 
     def __init__(self, sample, prefix=""):
@@ -100,6 +114,29 @@ class HistogramMetricReporter(object):
         self._sum += value
         self.update_variance(value)
 
+    def merge(self, other):
+        """Fold the values recorded by another histogram into this one."""
+        if other.count == 0:
+            return
+        self.sample.merge(other.sample)
+        self.set_max(other.max())
+        self.set_min(other.min())
+        self._sum += other._sum
+
+        # Combine the running variances, see Chan et al., "Updating
+        # Formulae and a Pairwise Algorithm for Computing Sample Variances".
+        count = self.count + other.count
+        if self.count == 0:
+            self.variance = list(other.variance)
+        else:
+            mean, s = self.variance
+            other_mean, other_s = other.variance
+            delta = float(other_mean - mean)
+            self.variance = [
+                mean + delta * other.count / count,
+                s + other_s + delta * delta * self.count * other.count / count]
+        self.count = count
+
     def report(self, timestamp):
         # median, 75, 95, 98, 99, 99.9 percentile
         percentiles = self.percentiles(0.5, 0.75, 0.95, 0.98, 0.99, 0.999)
@@ -139,28 +176,15 @@ class HistogramMetricReporter(object):
     def percentiles(self, *percentiles):
         """Returns a list of values at the given percentiles.
 
+        Only the ranks needed are selected from the sample, see
+        L{txstatsd.stats.selection}.
+
         @param percentiles one or more percentiles
         """
-
-        scores = [0.0] * len(percentiles)
         if self.count > 0:
-            values = self.sample.get_values()
-            values.sort()
-
-            for i in range(len(percentiles)):
-                p = percentiles[i]
-                pos = p * (len(values) + 1)
-                if pos < 1:
-                    scores[i] = values[0]
-                elif pos >= len(values):
-                    scores[i] = values[-1]
-                else:
-                    lower = values[int(pos) - 1]
-                    upper = values[int(pos)]
-                    scores[i] = lower + (pos - math.floor(pos)) * (
-                        upper - lower)
-
-        return scores
+            return selection.percentiles(self.sample.get_values(),
+                                         *percentiles)
+        return [0.0] * len(percentiles)
 
     def histogram(self):
         """Returns an histogram of the sample.
@@ -53,6 +53,8 @@ class MeterMetricReporter(object):
     interval.
     """
 
+    items = (".count", ".rate")
+
     def __init__(self, name, wall_time_func=time.time, prefix=""):
         """Construct a metric we expect to be periodically updated.
 
@@ -65,6 +67,8 @@ class MeterMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.names = [(item, prefix + name + item)
+                      for item in sorted(self.items)]
 
         self.value = self.count = 0
         self.poll_time = self.wall_time_func()
@@ -93,13 +97,9 @@ class MeterMetricReporter(object):
         rate = float(self.value) / (self.poll_time - poll_prev)
         self.count, self.value = self.count + self.value, 0
 
-        metrics = []
         items = {
             ".count": self.count,
             ".rate": rate
             }
-
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item,
-                            round(value, 6), timestamp))
-        return metrics
+        return [(name, round(items[item], 6), timestamp)
+                for item, name in self.names]
@@ -81,6 +81,13 @@ class SLIMetricReporter(object):
                 if condition(value, size):
                     self.counts[k] += 1
 
+    def merge(self, other):
+        """Fold the counts of another SLI reporter into this one."""
+        for k, value in other.counts.items():
+            self.counts[k] = self.counts.get(k, 0) + value
+        self.count += other.count
+        self.error += other.error
+
     def flush(self, interval, timestamp):
         metrics = []
         for item, value in self.counts.items():
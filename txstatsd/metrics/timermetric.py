@@ -23,7 +23,8 @@ import time
 
 from txstatsd.metrics.histogrammetric import HistogramMetricReporter
 from txstatsd.metrics.metric import Metric
-from txstatsd.stats.uniformsample import UniformSample
+from txstatsd.stats.uniformsample import (
+    SkippingUniformSample, UniformSample)
 
 
 class TimerMetric(Metric):
@@ -55,13 +56,20 @@ class TimerMetricReporter(object):
     statistics, plus throughput statistics via L{MeterMetricReporter}.
     """
 
-    def __init__(self, name, wall_time_func=time.time, prefix=""):
+    items = (".min", ".max", ".mean", ".stddev", ".99percentile",
+             ".999percentile", ".count", ".rate")
+
+    def __init__(self, name, wall_time_func=time.time, prefix="",
+                 skipping=False):
         """Construct a metric we expect to be periodically updated.
 
         @param name: Indicates what is being instrumented.
         @param wall_time_func: Function for obtaining wall time.
         @param prefix: If present, a string to prepend to the message
             composed when C{report} is called.
+        @param skipping: If true, samples durations with a
+            L{SkippingUniformSample}, which is cheaper to update once the
+            sample is full.
         """
         self.name = name
         self.wall_time_func = wall_time_func
@@ -69,8 +77,13 @@ class TimerMetricReporter(object):
         if prefix:
             prefix += "."
         self.prefix = prefix
+        self.names = [(item, prefix + name + item)
+                      for item in sorted(self.items)]
 
-        sample = UniformSample(1028)
+        if skipping:
+            sample = SkippingUniformSample(1028)
+        else:
+            sample = UniformSample(1028)
         self.histogram = HistogramMetricReporter(sample)
         # total number of values seen
         self.count = 0
@@ -133,21 +146,24 @@ class TimerMetricReporter(object):
         if duration >= 0:
             self.histogram.update(duration)
 
+    def merge(self, other):
+        """Fold the durations recorded by another timer into this one."""
+        self.count += other.count
+        self.histogram.merge(other.histogram)
+
     def report(self, timestamp):
-        # median, 75, 95, 98, 99, 99.9 percentile
-        percentiles = self.percentiles(0.5, 0.75, 0.95, 0.98, 0.99, 0.999)
-        metrics = []
+        # 99, 99.9 percentile
+        percentiles = self.percentiles(0.99, 0.999)
         items = {".min": self.min(),
                  ".max": self.max(),
                  ".mean": self.mean(),
                  ".stddev": self.std_dev(),
-                 ".99percentile": percentiles[4],
-                 ".999percentile": percentiles[5],
+                 ".99percentile": percentiles[0],
+                 ".999percentile": percentiles[1],
                  ".count": self.count,
                  ".rate": self.rate(timestamp),
                  }
-        for item, value in sorted(items.iteritems()):
-            metrics.append((self.prefix + self.name + item,
-                            round(value, 6), timestamp))
+        metrics = [(name, round(items[item], 6), timestamp)
+                   for item, name in self.names]
         self.clear(timestamp)
         return metrics
@@ -0,0 +1,332 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A client sending datapoints to carbon-cache daemons, spreading metrics
+across them with a consistent hash ring.
+
+When the carbon package is importable, its own ring places the metrics,
+the way carbon-relay and graphite-web's CARBONLINK lookups do. Otherwise
+the ring in L{txstatsd.hashing} does, which places them differently:
+graphite-web then asks the wrong carbon-cache for recent datapoints.
+"""
+
+import cPickle as pickle
+import os
+import time
+from collections import deque
+
+from twisted.application.service import Service
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+from txstatsd.hashing import ConsistentHashRing
+from txstatsd.server.spool import Spool
+
+try:
+    from carbon.hashing import ConsistentHashRing as CarbonHashRing
+except ImportError:
+    CarbonHashRing = None
+
+
+class CarbonPickleProtocol(Int32StringReceiver):
+    """Sends queued datapoints as length-prefixed pickled batches."""
+
+    paused = False
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self.factory.clientConnected(self)
+
+    def connectionLost(self, reason):
+        self.factory.clientDisconnected(self)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.sendQueued()
+
+    def stopProducing(self):
+        self.transport.loseConnection()
+
+    def sendQueued(self):
+        """Send queued batches until the queue is empty or we are paused."""
+        queue = self.factory.queue
+        batch_size = self.factory.batch_size
+        while queue and not self.paused:
+            batch = [queue.popleft()
+                     for i in xrange(min(batch_size, len(queue)))]
+            self.sendBatch(batch)
+            self.factory.sent += len(batch)
+
+    def sendBatch(self, datapoints):
+        self.sendString(pickle.dumps(datapoints, protocol=-1))
+
+
+class CarbonLineProtocol(CarbonPickleProtocol):
+    """Sends queued datapoints in the plaintext line protocol."""
+
+    def sendBatch(self, datapoints):
+        self.transport.write("".join(
+            "%s %s %d\n" % (metric, value, timestamp)
+            for metric, (timestamp, value) in datapoints))
+
+
+class CarbonClientFactory(ReconnectingClientFactory):
+    """
+    Holds the queue of datapoints for a single carbon-cache and keeps a
+    connection to it, reconnecting with an exponential backoff.
+    """
+
+    maxDelay = 30
+    noisy = False
+
+    protocols = {"pickle": CarbonPickleProtocol,
+                 "line": CarbonLineProtocol}
+
+    # How often to move spooled datapoints back to the queue, in seconds.
+    drain_interval = 0.1
+
+    def __init__(self, destination, max_queue_size=20000, batch_size=1000,
+                 protocol="pickle", spool=None, drain_rate=10000,
+                 time_function=time.time):
+        """
+        @param destination: The C{(host, port, instance)} to send to.
+        @param max_queue_size: The most datapoints waiting to be sent;
+            further ones are dropped, or spooled.
+        @param batch_size: The most datapoints sent in one message.
+        @param protocol: Either C{"pickle"} or C{"line"}.
+        @param spool: A L{Spool} keeping the datapoints which do not fit in
+            the queue, or C{None} to drop them.
+        @param drain_rate: The most spooled datapoints sent per second.
+        """
+        self.destination = destination
+        self.name = "%s_%d_%s" % destination
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.protocol = self.protocols[protocol]
+        self.queue = deque()
+        self.connected_protocol = None
+        self.connector = None
+        self.sent = 0
+        self.dropped = 0
+
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.drain_task = LoopingCall(self.drain)
+        self.time_function = time_function
+        self.drained = 0
+        self.last_report = time_function()
+
+    def startConnecting(self, reactor):
+        host, port, instance = self.destination
+        self.continueTrying = True
+        self.connector = reactor.connectTCP(host, port, self)
+        if self.spool is not None:
+            self.drain_task.clock = reactor
+            self.drain_task.start(self.drain_interval, now=False)
+
+    def stopConnecting(self):
+        self.stopTrying()
+        if self.connector is not None:
+            self.connector.disconnect()
+        if self.drain_task.running:
+            self.drain_task.stop()
+        if self.spool is not None:
+            self.spool.close()
+
+    def clientConnected(self, protocol):
+        log.msg("Connected to carbon at %s" % (self.name,))
+        self.resetDelay()
+        self.connected_protocol = protocol
+        protocol.sendQueued()
+
+    def clientDisconnected(self, protocol):
+        self.connected_protocol = None
+
+    def clientConnectionFailed(self, connector, reason):
+        log.msg("Could not connect to carbon at %s: %s" %
+                (self.name, reason.getErrorMessage()))
+        ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        log.msg("Lost connection to carbon at %s: %s" %
+                (self.name, reason.getErrorMessage()))
+        ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def sendDatapoints(self, datapoints):
+        """
+        Queue a list of C{(metric, (timestamp, value))}, dropping what does
+        not fit, and send them right away if connected.
+        """
+        room = max(self.max_queue_size - len(self.queue), 0)
+        if room < len(datapoints):
+            if self.spool is not None:
+                self.spool.append(datapoints[room:])
+            else:
+                self.dropped += len(datapoints) - room
+            datapoints = datapoints[:room]
+        self.queue.extend(datapoints)
+        if self.connected_protocol is not None:
+            self.connected_protocol.sendQueued()
+
+    def drain(self):
+        """
+        Move spooled datapoints back to the queue while connected, no
+        faster than C{drain_rate} and only into its empty half.
+        """
+        if self.connected_protocol is None or self.connected_protocol.paused:
+            return
+        room = self.max_queue_size // 2 - len(self.queue)
+        count = min(room, int(self.drain_rate * self.drain_interval))
+        if count <= 0 or not self.spool.bytes:
+            return
+        datapoints = self.spool.read(count)
+        self.drained += len(datapoints)
+        self.queue.extend(datapoints)
+        self.connected_protocol.sendQueued()
+
+    def report_stats(self):
+        """
+        Return the datapoints sent and dropped since the last call, and
+        how many are queued, along with the state of the spool.
+        """
+        stats = dict(sent=self.sent, dropped=self.dropped,
+                     queue_depth=len(self.queue))
+        self.sent = self.dropped = 0
+
+        now = self.time_function()
+        if self.spool is not None:
+            oldest = self.spool.oldest_timestamp()
+            stats.update(
+                spool_bytes=self.spool.bytes,
+                spool_drain_rate=self.drained / max(now - self.last_report,
+                                                    1e-6),
+                spool_oldest_age=now - oldest if oldest is not None else 0)
+        self.drained = 0
+        self.last_report = now
+        return stats
+
+
+class CarbonClientManager(Service):
+    """
+    Sends datapoints to several carbon-caches, each metric always going to
+    the same one.
+    """
+
+    def __init__(self, max_queue_size=20000, batch_size=1000,
+                 protocol="pickle", reactor=None, spool_directory=None,
+                 spool_segment_size=64 * 1024 * 1024, spool_fsync="segment",
+                 drain_rate=10000):
+        """
+        If C{spool_directory} is given, each destination spools the
+        datapoints which do not fit in its queue to a L{Spool} in a
+        subdirectory of it.
+        """
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.protocol = protocol
+        self.spool_directory = spool_directory
+        self.spool_segment_size = spool_segment_size
+        self.spool_fsync = spool_fsync
+        self.drain_rate = drain_rate
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if CarbonHashRing is None:
+            self.ring = ConsistentHashRing([])
+        else:
+            self.ring = CarbonHashRing([])
+        # The destination of each node of the ring.
+        self.ring_nodes = {}
+        self.client_factories = {}
+
+    def startClient(self, destination):
+        """Add a C{(host, port, instance)} carbon-cache to send to."""
+        if destination in self.client_factories:
+            return
+        spool = None
+        if self.spool_directory is not None:
+            spool = Spool(os.path.join(self.spool_directory,
+                                       "%s_%d_%s" % destination),
+                          segment_size=self.spool_segment_size,
+                          fsync=self.spool_fsync)
+        factory = CarbonClientFactory(
+            destination, max_queue_size=self.max_queue_size,
+            batch_size=self.batch_size, protocol=self.protocol, spool=spool,
+            drain_rate=self.drain_rate)
+        self.client_factories[destination] = factory
+        node = destination
+        if CarbonHashRing is not None:
+            # Like graphite-web, leave the port out of the node.
+            node = (destination[0], destination[2])
+        self.ring_nodes[node] = destination
+        self.ring.add_node(node)
+        if self.running:
+            factory.startConnecting(self.reactor)
+
+    def startService(self):
+        Service.startService(self)
+        for factory in self.client_factories.itervalues():
+            factory.startConnecting(self.reactor)
+
+    def stopService(self):
+        Service.stopService(self)
+        for factory in self.client_factories.itervalues():
+            factory.stopConnecting()
+
+    def sendDatapoints(self, datapoints):
+        """Send a list of C{(metric, (timestamp, value))}."""
+        if len(self.client_factories) == 1:
+            self.client_factories.values()[0].sendDatapoints(datapoints)
+            return
+
+        get_node = self.ring.get_node
+        ring_nodes = self.ring_nodes
+        by_destination = {}
+        for datapoint in datapoints:
+            destination = ring_nodes[get_node(datapoint[0])]
+            if destination in by_destination:
+                by_destination[destination].append(datapoint)
+            else:
+                by_destination[destination] = [datapoint]
+        for destination, queued in by_destination.iteritems():
+            self.client_factories[destination].sendDatapoints(queued)
+
+    def sendDatapoint(self, metric, datapoint):
+        self.sendDatapoints([(metric, datapoint)])
+
+    def report_stats(self):
+        """
+        Return the datapoints sent and dropped since the last call, and how
+        many are queued, for each destination.
+        """
+        stats = {}
+        for factory in self.client_factories.itervalues():
+            for name, value in factory.report_stats().iteritems():
+                stats["destinations.%s.%s" % (factory.name, name)] = value
+        return stats
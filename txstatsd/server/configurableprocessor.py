@@ -43,9 +43,14 @@ class ConfigurableMessageProcessor(MessageProcessor):
     """
 
     def __init__(self, time_function=time.time, message_prefix="",
-                 internal_metrics_prefix="", plugins=None):
+                 internal_metrics_prefix="", plugins=None,
+                 key_cache_size=100000, timing_sample_rate=1,
+                 idle_ttls=None, key_limits=None, prefix_key_limits=None):
         super(ConfigurableMessageProcessor, self).__init__(
-            time_function=time_function, plugins=plugins)
+            time_function=time_function, plugins=plugins,
+            key_cache_size=key_cache_size,
+            timing_sample_rate=timing_sample_rate, idle_ttls=idle_ttls,
+            key_limits=key_limits, prefix_key_limits=prefix_key_limits)
 
         if not internal_metrics_prefix and not message_prefix:
             internal_metrics_prefix = "statsd."
@@ -93,6 +98,27 @@ class ConfigurableMessageProcessor(MessageProcessor):
             self.meter_metrics[key] = metric
         self.meter_metrics[key].mark(value)
 
+    def export_state(self):
+        state = super(ConfigurableMessageProcessor, self).export_state()
+        state["counters"] = dict((key, metric.count) for key, metric
+                                 in state["counters"].iteritems())
+        return state
+
+    # The metric reporters keep state from one flush to the next, so they
+    # cannot be swapped out and reduced in a thread.
+    snapshot = None
+    reduce_snapshot = None
+
+    def merge_counter_metric(self, key, value):
+        self.compose_counter_metric(key, value)
+
+    def merge_timer_metric(self, key, metric):
+        if not key in self.timer_metrics:
+            self.timer_metrics[key] = TimerMetricReporter(
+                key, wall_time_func=self.time_function,
+                prefix=self.message_prefix)
+        self.timer_metrics[key].merge(metric)
+
     def flush_counter_metrics(self, interval, timestamp):
         for metric in self.counter_metrics.itervalues():
             messages = metric.report(timestamp)
@@ -59,6 +59,28 @@ class ListMetrics(resource.Resource):
         return json.dumps(data)
 
 
+class KeyBudgets(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, processor):
+        resource.Resource.__init__(self)
+        self.processor = processor
+
+    def render_GET(self, request):
+        return json.dumps(self.processor.get_key_budgets())
+
+
+class RuleStats(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, router):
+        resource.Resource.__init__(self)
+        self.router = router
+
+    def render_GET(self, request):
+        return json.dumps(self.router.get_rule_stats())
+
+
 class Metrics(resource.Resource):
 
     def __init__(self, processor):
@@ -94,7 +116,7 @@ class TimerResource(resource.Resource):
         return json.dumps(result)
 
 
-def makeService(options, processor, statsd_service):
+def makeService(options, processor, statsd_service, router=None):
 
     if options["http-port"] is None:
         return service.MultiService()
@@ -103,6 +125,9 @@ def makeService(options, processor, statsd_service):
     root.putChild("status", Status(processor, statsd_service))
     root.putChild("metrics", Metrics(processor))
     root.putChild("list_metrics", ListMetrics(processor))
+    root.putChild("key_budgets", KeyBudgets(processor))
+    if router is not None:
+        root.putChild("rules", RuleStats(router))
     site = server.Site(root)
     s = internet.TCPServer(int(options["http-port"]), site)
     return s
@@ -0,0 +1,106 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+
+from twisted.python import log
+
+
+class IngestQueue(object):
+    """
+    A bounded buffer between the listening protocols and the processor.
+
+    Received payloads are appended to the buffer and drained in batches,
+    once per reactor iteration, instead of scheduling a delayed call for
+    every single message. Each drain runs for at most C{time_budget}
+    seconds; whatever is left is picked up on the next iteration.
+    Payloads arriving while the buffer is full are dropped.
+    """
+
+    # How many messages to process between checks of the time budget.
+    check_every = 64
+
+    def __init__(self, processor, max_size=100000, time_budget=0.05,
+                 clock=None, time_function=time.time):
+        """
+        @param processor: The C{BaseMessageProcessor} fed by this queue.
+        @param max_size: The maximum number of payloads to buffer.
+        @param time_budget: The number of seconds a single drain may run.
+        @param clock: The reactor used to schedule drains.
+        """
+        self.processor = processor
+        self.max_size = max_size
+        self.time_budget = time_budget
+        self.time_function = time_function
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+
+        self.queue = []
+        self.dropped = 0
+        self.pending = None
+
+    def process_datagram(self, datagram):
+        """Queue a datagram that may hold several messages."""
+        self.put(self.processor.process_datagram, datagram)
+
+    def process(self, message):
+        """Queue a single message."""
+        self.put(self.processor.process, message)
+
+    def put(self, function, data):
+        if len(self.queue) >= self.max_size:
+            self.dropped += 1
+        else:
+            self.queue.append((function, data))
+        if self.pending is None:
+            self.pending = self.clock.callLater(0, self.drain)
+
+    def drain(self):
+        """Process queued payloads until empty or out of time."""
+        self.pending = None
+        queue = self.queue
+        depth = len(queue)
+        deadline = self.time_function() + self.time_budget
+        check_every = self.check_every
+
+        index = 0
+        try:
+            while index < depth:
+                function, data = queue[index]
+                index += 1
+                try:
+                    function(data)
+                except Exception:
+                    log.err(None, "Failed to process %r" % (data,))
+                if (not index % check_every and
+                    self.time_function() >= deadline):
+                    break
+        finally:
+            # Whatever happens, never replay payloads already handled.
+            del queue[:index]
+
+        dropped, self.dropped = self.dropped, 0
+        self.processor.count_ingest_batch(index, depth, dropped)
+
+        if queue:
+            self.pending = self.clock.callLater(0, self.drain)
@@ -46,9 +46,10 @@ class LoggingMessageProcessor(ConfigurableMessageProcessor):
         return super(LoggingMessageProcessor, self).process_message(
             message, metric_type, key, fields)
 
-    def flush(self, interval=10000, percent=90):
+    def flush(self, interval=10000, percent=90, reduced=None):
         """Log all received metric samples to the supplied logger."""
         parent = super(LoggingMessageProcessor, self)
-        for msg in parent.flush(interval=interval, percent=percent):
+        for msg in parent.flush(interval=interval, percent=percent,
+                                reduced=reduced):
             self.logger.info("Out: %s %s %s" % msg)
             yield msg
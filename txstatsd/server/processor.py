@@ -19,19 +19,31 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import copy
+import functools
+import heapq
 import re
+import string
 import time
 import logging
 
 from twisted.python import log
 
 from txstatsd.metrics.metermetric import MeterMetricReporter
+from txstatsd.stats.ddsketch import DDSketch
 
 
 SPACES = re.compile("\s+")
 SLASHES = re.compile("\/+")
 NON_ALNUM = re.compile("[^a-zA-Z_\-0-9\.]")
-RATE = re.compile("^@([\d\.]+)")
+
+
+VALID_KEY_CHARS = string.ascii_letters + string.digits + "_-."
+INVALID_KEY_CHARS = "".join(
+    chr(i) for i in range(256) if chr(i) not in VALID_KEY_CHARS)
+NON_SEPARATOR_CHARS = "".join(
+    chr(i) for i in range(256) if chr(i) not in string.whitespace + "/")
+DECIMAL = string.digits + "."
 
 
 def normalize_key(key):
@@ -39,31 +51,389 @@ def normalize_key(key):
     Normalize a key that might contain spaces, forward-slashes and other
     special characters into something that is acceptable by graphite.
     """
+    if isinstance(key, str):
+        # Most keys only need invalid characters dropped, if anything, which
+        # a translate table does in one pass.
+        valid = key.translate(None, INVALID_KEY_CHARS)
+        if len(valid) == len(key):
+            return key
+        if not key.translate(None, NON_SEPARATOR_CHARS):
+            return valid
     key = SPACES.sub("_", key)
     key = SLASHES.sub("-", key)
     key = NON_ALNUM.sub("", key)
     return key
 
 
+def parse_sample_rate(field):
+    """
+    Return the sample rate of a counter's C{@0.1} field, or C{None} unless
+    it is a plain decimal, without sign, exponent or special value, above
+    zero.
+    """
+    if field[:1] != "@" or field[1:].strip(DECIMAL):
+        return None
+    try:
+        rate = float(field[1:])
+    except ValueError:
+        return None
+    if not rate > 0:
+        return None
+    return rate
+
+
+def parse_message(message):
+    """
+    Split a StatsD line such as C{gorets:1|c|@0.1} into the tuple
+    C{(key, metric_type, fields)}, where C{fields} holds the value, the
+    metric type and, if given, the sample rate. Return C{None} if the line
+    is malformed.
+    """
+    key, colon, data = message.strip().partition(":")
+    fields = data.split("|")
+    if not 2 <= len(fields) <= 3:
+        return None
+    return key, fields[1], fields
+
+
+class KeyCache(object):
+    """
+    A bounded cache of normalized keys, evicting with the clock algorithm:
+    a hit only marks its entry as referenced, and the clock hand passes
+    over referenced entries once, clearing the mark, before evicting.
+    """
+
+    def __init__(self, size, normalize=normalize_key):
+        """
+        @param size: The maximum number of keys kept.
+        @param normalize: The function normalizing a key on a miss.
+        """
+        self.size = size
+        self.normalize_miss = normalize
+        self.entries = {}
+        self.ring = []
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def normalize(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = True
+            return entry[0]
+
+        self.misses += 1
+        normalized = self.normalize_miss(key)
+        if len(self.ring) < self.size:
+            self.ring.append(key)
+        else:
+            ring = self.ring
+            entries = self.entries
+            hand = self.hand
+            while entries[ring[hand]][1]:
+                entries[ring[hand]][1] = False
+                hand = (hand + 1) % self.size
+            del entries[ring[hand]]
+            ring[hand] = key
+            self.hand = (hand + 1) % self.size
+            self.evictions += 1
+        self.entries[key] = [normalized, False]
+        return normalized
+
+    def reset_stats(self):
+        """Return and reset the hit, miss and eviction counters."""
+        stats = (self.hits, self.misses, self.evictions)
+        self.hits = self.misses = self.evictions = 0
+        return stats
+
+
+class OutputNames(object):
+    """
+    The names under which the datapoints of each key are reported, one
+    C{prefix + key + suffix} for each of C{formats}, built on the first
+    flush of the key and handed out again on every later one instead of
+    being concatenated anew.
+    """
+
+    def __init__(self, formats=(), parent=None):
+        """
+        @param formats: A sequence of C{(prefix, suffix)}.
+        @param parent: The L{OutputNames} whose names are handed out, but
+            never changed, by this one. See L{overlay}.
+        """
+        self.formats = list(formats)
+        self.names = {}
+        self.parent = parent
+
+    def __getitem__(self, key):
+        names = self.names.get(key)
+        if names is None and self.parent is not None:
+            names = self.parent.names.get(key)
+        if names is None:
+            names = self.names[key] = tuple(prefix + key + suffix
+                                            for prefix, suffix
+                                            in self.formats)
+        return names
+
+    def reset(self, formats):
+        """Build names from C{formats} from now on."""
+        self.formats = list(formats)
+        self.names = {}
+        self.parent = None
+
+    def overlay(self):
+        """
+        Return L{OutputNames} reading the names built so far, and keeping
+        the ones it builds itself, so that it can be used outside the
+        reactor thread. Its names are added back here with L{merge}.
+        """
+        return OutputNames(self.formats, parent=self)
+
+    def merge(self, overlay, live):
+        """
+        Keep the names built by C{overlay}, then L{trim} to C{live}.
+        """
+        if overlay.parent is not self:
+            # The overlay was reset to other formats.
+            self.formats = overlay.formats
+            self.names = {}
+        self.names.update(overlay.names)
+        self.trim(live)
+
+    def trim(self, live):
+        """
+        Forget the names of keys not in C{live}, once they outnumber the
+        ones that are.
+        """
+        if len(self.names) > 2 * len(live):
+            names = self.names
+            self.names = dict((key, names[key]) for key in live
+                              if key in names)
+
+
+# The processor attribute holding the metrics of each kind whose idle keys
+# can be expired, and the kind of each built-in message type.
+IDLE_METRICS = {"counter": "counter_metrics",
+                "timer": "timer_metrics",
+                "gauge": "gauge_metrics",
+                "meter": "meter_metrics",
+                "plugin": "plugin_metrics"}
+MESSAGE_KINDS = {"c": "counter", "ms": "timer", "g": "gauge", "m": "meter"}
+
+
+class IdleKeys(object):
+    """
+    Remember in which flush interval each key of a kind of metric was last
+    updated, grouping the keys by interval so that the ones idle for C{ttl}
+    intervals are found without walking all the others.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.interval = 0
+        self.last_update = {}
+        self.updated = {0: set()}
+        self.expired = 0
+
+    def touch(self, key):
+        interval = self.last_update.get(key)
+        if interval != self.interval:
+            if interval is not None:
+                self.updated[interval].discard(key)
+            self.last_update[key] = self.interval
+            self.updated[self.interval].add(key)
+
+    def expire(self):
+        """
+        End the current flush interval and return the keys which were not
+        updated in any of the last C{ttl} intervals.
+        """
+        expired = self.updated.pop(self.interval - self.ttl, ())
+        for key in expired:
+            del self.last_update[key]
+        self.expired += len(expired)
+        self.interval += 1
+        self.updated[self.interval] = set()
+        return expired
+
+
+class KeyBudget(object):
+    """
+    Admit at most C{limit} keys of a kind of metric, or any number if it is
+    zero, and at most C{prefix_limits[prefix]} keys under each of those
+    dotted prefixes. New keys beyond their budget are folded into the key
+    C{<prefix>.__overflow__} instead, where the prefix is the one whose
+    budget ran out, or the first component of the key.
+    """
+
+    overflow = "__overflow__"
+    # Rejections are counted for this many prefixes at most; keys under
+    # others all overflow into C{__overflow__}.
+    max_offenders = 1000
+    # Rejected keys are counted once per interval, remembering this many
+    # of them at most; past that the memory starts afresh.
+    max_rejected_keys = 100000
+
+    def __init__(self, limit=0, prefix_limits=None):
+        self.limit = limit
+        self.prefix_limits = prefix_limits or {}
+        self.keys = {}
+        self.prefix_counts = {}
+        self.rejected = 0
+        self.recent_rejected = 0
+        self.rejected_keys = set()
+        self.offenders = {}
+
+    def budget_prefix(self, key):
+        """Return the longest prefix of C{key} with its own budget."""
+        end = key.rfind(".")
+        while end > 0:
+            prefix = key[:end]
+            if prefix in self.prefix_limits:
+                return prefix
+            end = key.rfind(".", 0, end)
+        return None
+
+    def admit(self, key):
+        """Return C{key} if it fits in its budget, or its overflow key."""
+        if key in self.keys:
+            return key
+        prefix = self.budget_prefix(key)
+        if not self.limit or len(self.keys) < self.limit:
+            if prefix is None:
+                # Only keys counting against a budget are remembered.
+                if self.limit:
+                    self.keys[key] = None
+                return key
+            count = self.prefix_counts.get(prefix, 0)
+            if count < self.prefix_limits[prefix]:
+                self.keys[key] = prefix
+                self.prefix_counts[prefix] = count + 1
+                return key
+
+        if prefix is None:
+            prefix = key.partition(".")[0]
+        if key not in self.rejected_keys:
+            if len(self.rejected_keys) >= self.max_rejected_keys:
+                self.rejected_keys.clear()
+            self.rejected_keys.add(key)
+            self.rejected += 1
+            self.recent_rejected += 1
+            if prefix in self.offenders:
+                self.offenders[prefix] += 1
+            elif len(self.offenders) < self.max_offenders:
+                self.offenders[prefix] = 1
+        if prefix not in self.offenders:
+            return self.overflow
+        return prefix + "." + self.overflow
+
+    def reset_interval(self):
+        """
+        End the current flush interval, returning how many keys were
+        rejected during it.
+        """
+        recent, self.recent_rejected = self.recent_rejected, 0
+        self.rejected_keys.clear()
+        return recent
+
+    def release(self, key):
+        """Give back the budget taken by C{key}."""
+        if key in self.keys:
+            prefix = self.keys.pop(key)
+            if prefix is not None:
+                self.prefix_counts[prefix] -= 1
+
+    def top_offenders(self, count=10):
+        """Return the C{count} prefixes with the most rejected keys."""
+        return heapq.nlargest(count, self.offenders.iteritems(),
+                              key=lambda item: item[1])
+
+
+def admitting(handler, admit):
+    """Wrap a message handler to pass keys through C{admit} first."""
+    def handle(key, fields, message):
+        handler(admit(key), fields, message)
+    return handle
+
+
+def touching(handler, touch):
+    """Wrap a message handler to C{touch} the key of every message."""
+    def handle(key, fields, message):
+        touch(key)
+        handler(key, fields, message)
+    return handle
+
+
 class BaseMessageProcessor(object):
 
-    def process(self, message):
+    normalize_key = staticmethod(normalize_key)
+
+    def process_datagram(self, datagram):
         """
+        Process a datagram that may carry several newline-separated
+        messages, as batching clients send them.
         """
-        if not ":" in message:
-            return self.fail(message)
+        lines = [line for line in datagram.split("\n") if line.strip()]
+        self.count_datagram(len(lines))
+        for line in lines:
+            try:
+                self.process(line)
+            except Exception:
+                log.err(None, "Failed to process %r" % (line,))
+
+    def get_key_budgets(self, top=10):
+        """
+        Describe the key budget of each kind of metric, with the prefixes
+        under which most keys were rejected.
+        """
+        return dict((kind, dict(keys=len(budget.keys), limit=budget.limit,
+                                rejected=budget.rejected,
+                                top_prefixes=budget.top_offenders(top)))
+                    for kind, budget in self.key_budgets.iteritems())
 
-        key, data = message.strip().split(":", 1)
-        if not "|" in data:
-            return self.fail(message)
+    def count_datagram(self, lines):
+        """Account for a received datagram holding C{lines} messages."""
 
-        fields = data.split("|")
-        if len(fields) < 2 or len(fields) > 3:
+    def count_ingest_batch(self, size, depth, dropped):
+        """
+        Account for a batch of C{size} payloads drained from an ingest
+        queue C{depth} long, after C{dropped} payloads overflowed it.
+        """
+
+    def count_flush_send(self, duration, blocked, chunks):
+        """
+        Account for the last flush, which took C{duration} seconds from its
+        start until all of its C{chunks} of datapoints were handed to the
+        carbon client, C{blocked} of which were spent on the reactor.
+        """
+
+    def count_redirect_packet(self, destination, size, messages):
+        """
+        Account for a datagram of C{size} bytes packing C{messages}
+        messages, redirected to C{destination}.
+        """
+
+    def count_redirect_buffer(self, destination, buffered, dropped, latency):
+        """
+        Account for C{buffered} bytes waiting to be redirected to
+        C{destination}, after C{dropped} lines were dropped for lack of
+        room. C{latency} is how long the lines waited once they were all
+        written, or C{None}.
+        """
+
+    def process(self, message):
+        """
+        Parse a single StatsD line and hand it to L{process_message}.
+        """
+        parsed = parse_message(message)
+        if parsed is None:
             return self.fail(message)
 
-        key = normalize_key(key)
-        metric_type = fields[1]
-        return self.process_message(message, metric_type, key, fields)
+        key, metric_type, fields = parsed
+        return self.process_message(message, metric_type,
+                                    self.normalize_key(key), fields)
 
     def rebuild_message(self, metric_type, key, fields):
         return key + ":" + "|".join(fields)
@@ -82,14 +452,28 @@ class MessageProcessor(BaseMessageProcessor):
     <txstatsd.server.configurableprocessor.ConfigurableMessageProcessor>}).
     """
 
+    # The number of distinct counter sample rates remembered as checked.
+    max_sample_rates = 100
+
     def __init__(self, time_function=time.time, plugins=None,
                  legacy_namespace=1, message_prefix="stats", internal_metrics_prefix="statsd.",
-                 delete_idle_counters=0, lightweight_mode=0):
+                 delete_idle_counters=0, lightweight_mode=0,
+                 timer_accuracy=None, key_cache_size=100000,
+                 timing_sample_rate=1, idle_ttls=None, key_limits=None,
+                 prefix_key_limits=None):
         self.time_function = time_function
 
         self.legacy_namespace = legacy_namespace
         self.delete_idle_counters = delete_idle_counters
         self.lightweight_mode = lightweight_mode
+        # When set, timers are summarised in a DDSketch with this relative
+        # accuracy instead of keeping every duration until the flush.
+        self.timer_accuracy = timer_accuracy
+
+        self.key_cache = None
+        if key_cache_size:
+            self.key_cache = KeyCache(key_cache_size)
+            self.normalize_key = self.key_cache.normalize
 
         self.stats_prefix = "stats."
         self.internal_metrics_prefix = "statsd."
@@ -104,10 +488,41 @@ class MessageProcessor(BaseMessageProcessor):
             self.timer_prefix = self.stats_prefix + "timers."
             self.gauge_prefix = self.stats_prefix + "gauges."
 
+        if legacy_namespace:
+            self.counter_names = OutputNames([(self.stats_prefix, ""),
+                                              (self.count_prefix, "")])
+        else:
+            self.counter_names = OutputNames([(self.count_prefix, ".rate"),
+                                              (self.count_prefix, ".count")])
+        self.gauge_names = OutputNames([(self.gauge_prefix, ".value")])
+        # Filled in on the first flush, once the percentiles are known.
+        self.timer_names = OutputNames()
+
+        # Only one in every C{timing_sample_rate} messages is timed, and its
+        # duration scaled up to stand for the others; counts are exact.
+        self.timing_sample_rate = max(1, timing_sample_rate)
+        self.timing_countdown = 1
+        self.sample_rates = {}
         self.process_timings = {}
         self.by_type = {}
         self.last_flush_duration = 0
         self.last_process_duration = 0
+        self.datagrams = 0
+        self.datagram_lines = 0
+        self.ingest_batches = 0
+        self.ingest_batched = 0
+        self.ingest_max_depth = 0
+        self.ingest_dropped = 0
+        self.flush_send = None
+        # The datagrams, bytes and messages redirected to each destination.
+        self.redirect_packets = {}
+        # The lines dropped, most bytes buffered and longest drain of each
+        # destination redirected to by tcp.
+        self.redirect_buffers = {}
+
+        # Set to a dict to record when each gauge was last written, so that
+        # gauges from several processors can be merged in order.
+        self.gauge_updates = None
 
         self.timer_metrics = {}
         self.counter_metrics = {}
@@ -121,6 +536,26 @@ class MessageProcessor(BaseMessageProcessor):
             for plugin in plugins:
                 self.plugins[plugin.metric_type] = plugin
 
+        # Metrics of the kinds in C{idle_ttls} are dropped after that many
+        # flush intervals without an update.
+        self.idle_keys = {}
+        if idle_ttls is not None:
+            for kind, ttl in idle_ttls.iteritems():
+                self.idle_keys[kind] = IdleKeys(ttl)
+
+        # New keys beyond the budget of their kind in C{key_limits}, or of
+        # their prefix in C{prefix_key_limits}, are folded into an
+        # overflow key.
+        self.key_budgets = {}
+        if key_limits or prefix_key_limits:
+            for kind in IDLE_METRICS:
+                limit = (key_limits or {}).get(kind, 0)
+                if limit or prefix_key_limits:
+                    self.key_budgets[kind] = KeyBudget(limit,
+                                                       prefix_key_limits)
+
+        self.message_handlers = self.build_message_handlers()
+
     def get_metric_names(self):
         """Return the names of all seen metrics."""
         metrics = set()
@@ -131,28 +566,95 @@ class MessageProcessor(BaseMessageProcessor):
         metrics.update(self.plugin_metrics.keys())
         return list(metrics)
 
+    def count_datagram(self, lines):
+        self.datagrams += 1
+        self.datagram_lines += lines
+
+    def count_ingest_batch(self, size, depth, dropped):
+        self.ingest_batches += 1
+        self.ingest_batched += size
+        self.ingest_dropped += dropped
+        if depth > self.ingest_max_depth:
+            self.ingest_max_depth = depth
+
+    def count_flush_send(self, duration, blocked, chunks):
+        self.flush_send = (duration, blocked, chunks)
+
+    def count_redirect_packet(self, destination, size, messages):
+        packets = self.redirect_packets.get(destination)
+        if packets is None:
+            packets = self.redirect_packets[destination] = [0, 0, 0]
+        packets[0] += 1
+        packets[1] += size
+        packets[2] += messages
+
+    def count_redirect_buffer(self, destination, buffered, dropped, latency):
+        stats = self.redirect_buffers.get(destination)
+        if stats is None:
+            stats = self.redirect_buffers[destination] = [0, 0, None]
+        stats[0] += dropped
+        stats[1] = max(stats[1], buffered)
+        if latency is not None and (stats[2] is None or latency > stats[2]):
+            stats[2] = latency
+
+    def build_message_handlers(self):
+        """
+        Map each metric type to a callable taking C{(key, fields, message)},
+        so that messages are dispatched with a single lookup.
+        """
+        timer = self.process_timer_metric
+        gauge = self.process_gauge_metric
+        meter = self.process_meter_metric
+        handlers = {}
+        for metric_type in self.plugins:
+            handlers[metric_type] = functools.partial(
+                self.process_plugin_metric, metric_type)
+        handlers.update({
+            "c": self.process_counter_metric,
+            "ms": lambda key, fields, message: timer(key, fields[0], message),
+            "g": lambda key, fields, message: gauge(key, fields[0], message),
+            "m": lambda key, fields, message: meter(key, fields[0], message),
+            })
+        for metric_type, handler in handlers.items():
+            kind = MESSAGE_KINDS.get(metric_type, "plugin")
+            idle_keys = self.idle_keys.get(kind)
+            if idle_keys is not None:
+                handler = touching(handler, idle_keys.touch)
+            budget = self.key_budgets.get(kind)
+            if budget is not None:
+                handler = admitting(handler, budget.admit)
+            handlers[metric_type] = handler
+        return handlers
+
     def process_message(self, message, metric_type, key, fields):
         """
         Process a single entry, adding it to either C{counters}, C{timers},
         or C{gauge_metrics} depending on which kind of message it is.
         """
-        start = self.time_function()
-        if metric_type == "c":
-            self.process_counter_metric(key, fields, message)
-        elif metric_type == "ms":
-            self.process_timer_metric(key, fields[0], message)
-        elif metric_type == "g":
-            self.process_gauge_metric(key, fields[0], message)
-        elif metric_type == "m":
-            self.process_meter_metric(key, fields[0], message)
-        elif metric_type in self.plugins:
-            self.process_plugin_metric(metric_type, key, fields, message)
-        else:
+        handler = self.message_handlers.get(metric_type)
+        if handler is None:
             return self.fail(message)
-        self.process_timings.setdefault(metric_type, 0)
-        self.process_timings[metric_type] += self.time_function() - start
-        self.by_type.setdefault(metric_type, 0)
-        self.by_type[metric_type] += 1
+        self.timing_countdown -= 1
+        if self.timing_countdown:
+            handler(key, fields, message)
+            try:
+                self.by_type[metric_type] += 1
+            except KeyError:
+                self.by_type[metric_type] = 1
+            return
+
+        self.timing_countdown = self.timing_sample_rate
+        start = self.time_function()
+        handler(key, fields, message)
+        duration = (self.time_function() - start) * self.timing_sample_rate
+        try:
+            self.process_timings[metric_type] += duration
+        except KeyError:
+            self.process_timings[metric_type] = duration
+        try:
+            self.by_type[metric_type] += 1
+        except KeyError:
+            self.by_type[metric_type] = 1
 
     def get_message_prefix(self, kind):
         return "stats." + kind
@@ -175,6 +677,11 @@ class MessageProcessor(BaseMessageProcessor):
         self.compose_timer_metric(key, duration)
 
     def compose_timer_metric(self, key, duration):
+        if self.timer_accuracy is not None:
+            if key not in self.timer_metrics:
+                self.timer_metrics[key] = DDSketch(self.timer_accuracy)
+            self.timer_metrics[key].add(duration)
+            return
         if key not in self.timer_metrics:
             self.timer_metrics[key] = []
         self.timer_metrics[key].append(duration)
@@ -184,13 +691,18 @@ class MessageProcessor(BaseMessageProcessor):
             value = float(composite[0])
         except (TypeError, ValueError):
             return self.fail(message)
-        rate = 1
-        if len(composite) == 3:
-            match = RATE.match(composite[2])
-            if match is None:
+        if len(composite) != 3:
+            return self.compose_counter_metric(key, value, 1)
+
+        # Clients use a handful of rates, each checked once.
+        rate = self.sample_rates.get(composite[2])
+        if rate is None:
+            rate = parse_sample_rate(composite[2])
+            if rate is None:
                 return self.fail(message)
-            rate = match.group(1)
-
+            if len(self.sample_rates) >= self.max_sample_rates:
+                self.sample_rates.clear()
+            self.sample_rates[composite[2]] = rate
         self.compose_counter_metric(key, value, rate)
 
     def compose_counter_metric(self, key, value, rate):
@@ -202,27 +714,27 @@ class MessageProcessor(BaseMessageProcessor):
             self.counter_metrics[key] = value * (1 / float(rate))
 
     def process_gauge_metric(self, key, composite, message):
-        values = composite.split(":")
-        if not len(values) == 1:
+        if ":" in composite:
             return self.fail(message)
 
         try:
-            value = float(values[0])
+            value = float(composite)
         except (TypeError, ValueError):
             self.fail(message)
 
+        if self.gauge_updates is not None:
+            self.gauge_updates[key] = (self.time_function(), value)
         self.compose_gauge_metric(key, value)
 
     def compose_gauge_metric(self, key, value):
         self.gauge_metrics[key] = value
 
     def process_meter_metric(self, key, composite, message):
-        values = composite.split(":")
-        if not len(values) == 1:
+        if ":" in composite:
             return self.fail(message)
 
         try:
-            value = float(values[0])
+            value = float(composite)
         except (TypeError, ValueError):
             self.fail(message)
 
@@ -235,35 +747,259 @@ class MessageProcessor(BaseMessageProcessor):
             self.meter_metrics[key] = metric
         self.meter_metrics[key].mark(value)
 
-    def flush(self, interval=10000, percent=90):
+    def snapshot(self):
+        """
+        Swap in empty counters and timers and return the ones gathered so
+        far, to be reduced with L{reduce_snapshot} while this processor
+        keeps taking messages.
+        """
+        snapshot = dict(counters=self.counter_metrics,
+                        timers=self.timer_metrics,
+                        timestamp=int(self.time_function()))
+        if self.delete_idle_counters:
+            self.release_keys("counter", self.counter_metrics)
+            self.counter_metrics = {}
+        else:
+            self.counter_metrics = dict.fromkeys(self.counter_metrics, 0)
+        self.release_keys("timer", self.timer_metrics)
+        self.timer_metrics = {}
+        return snapshot
+
+    def reduce_snapshot(self, snapshot, interval=10000, percent=90):
+        """
+        Compute the counter and timer datapoints of a L{snapshot}, to be
+        reported by L{flush}. Nothing but the snapshot is changed, so this
+        can run outside the reactor thread.
+        """
+        frozen = copy.copy(self)
+        frozen.counter_metrics = snapshot["counters"]
+        frozen.timer_metrics = snapshot["timers"]
+        # L{snapshot} gave back the budget of the keys it dropped.
+        frozen.key_budgets = {}
+        # The name caches are only read here; new names are merged back by
+        # flush, in the reactor thread.
+        frozen.counter_names = self.counter_names.overlay()
+        frozen.timer_names = self.timer_names.overlay()
+        timestamp = snapshot["timestamp"]
+        reduced = dict(timestamp=timestamp,
+                       names=(frozen.counter_names, snapshot["counters"],
+                              frozen.timer_names, snapshot["timers"]))
+
+        start = self.time_function()
+        metrics = list(frozen.flush_counter_metrics(interval / 1000,
+                                                    timestamp))
+        reduced["counter"] = (metrics, self.time_function() - start)
+
+        start = self.time_function()
+        metrics = list(frozen.flush_timer_metrics(percent, timestamp))
+        reduced["timer"] = (metrics, self.time_function() - start)
+        return reduced
+
+    def export_state(self):
+        """
+        Hand over the partial aggregates collected since the last export and
+        start afresh. The result can be pickled and merged into another
+        processor with L{merge_states}.
+        """
+        state = dict(
+            counters=self.counter_metrics,
+            timers=self.timer_metrics,
+            gauges=self.gauge_updates or {},
+            meters=dict((key, metric.value) for key, metric
+                        in self.meter_metrics.iteritems() if metric.value),
+            plugins=self.plugin_metrics,
+            process_timings=self.process_timings,
+            by_type=self.by_type,
+            datagrams=(self.datagrams, self.datagram_lines),
+            ingest=(self.ingest_batches, self.ingest_batched,
+                    self.ingest_max_depth, self.ingest_dropped),
+            redirect_packets=self.redirect_packets,
+            redirect_buffers=self.redirect_buffers,
+            keys=(self.key_cache.reset_stats()
+                  if self.key_cache is not None else (0, 0, 0)))
+
+        for kind, name in IDLE_METRICS.iteritems():
+            self.release_keys(kind, getattr(self, name))
+        self.counter_metrics = {}
+        self.timer_metrics = {}
+        self.gauge_metrics = {}
+        if self.gauge_updates is not None:
+            self.gauge_updates = {}
+        self.meter_metrics = {}
+        self.plugin_metrics = {}
+        self.process_timings = {}
+        self.by_type = {}
+        self.datagrams = self.datagram_lines = 0
+        self.ingest_batches = self.ingest_batched = 0
+        self.ingest_max_depth = self.ingest_dropped = 0
+        self.redirect_packets = {}
+        self.redirect_buffers = {}
+        return state
+
+    def merged_items(self, kind, metrics, admit=True):
+        """
+        Yield the items of C{metrics} merged from another processor, with
+        their keys admitted by the key budget and touched as updates.
+        """
+        budget = self.key_budgets.get(kind) if admit else None
+        idle_keys = self.idle_keys.get(kind)
+        for key, value in metrics.iteritems():
+            if budget is not None:
+                key = budget.admit(key)
+            if idle_keys is not None:
+                idle_keys.touch(key)
+            yield key, value
+
+    def merge_states(self, states):
+        """
+        Merge the partial aggregates exported by other processors with
+        L{export_state}, as if their messages had been processed here.
+        """
+        gauges = []
+        for state in states:
+            for key, value in self.merged_items("counter",
+                                                state["counters"]):
+                self.merge_counter_metric(key, value)
+            for key, timers in self.merged_items("timer", state["timers"]):
+                self.merge_timer_metric(key, timers)
+            for key, (when, value) in self.merged_items("gauge",
+                                                        state["gauges"]):
+                gauges.append((when, key, value))
+            for key, value in self.merged_items("meter", state["meters"]):
+                self.compose_meter_metric(key, value)
+            # Plugin metrics are merged whole and keep their own name, so
+            # they cannot be folded into an overflow key.
+            for key, metric in self.merged_items("plugin", state["plugins"],
+                                                 admit=False):
+                self.merge_plugin_metric(key, metric)
+
+            for metric_type, duration in state["process_timings"].iteritems():
+                self.process_timings.setdefault(metric_type, 0)
+                self.process_timings[metric_type] += duration
+            for metric_type, count in state["by_type"].iteritems():
+                self.by_type.setdefault(metric_type, 0)
+                self.by_type[metric_type] += count
+            datagrams, lines = state["datagrams"]
+            self.datagrams += datagrams
+            self.datagram_lines += lines
+            batches, batched, depth, dropped = state["ingest"]
+            self.ingest_batches += batches
+            self.ingest_batched += batched
+            self.ingest_max_depth = max(self.ingest_max_depth, depth)
+            self.ingest_dropped += dropped
+            for destination, counts in state["redirect_packets"].iteritems():
+                totals = self.redirect_packets.setdefault(destination,
+                                                          [0, 0, 0])
+                for i, count in enumerate(counts):
+                    totals[i] += count
+            for destination, (dropped, buffered, latency) in state[
+                    "redirect_buffers"].iteritems():
+                self.count_redirect_buffer(destination, buffered, dropped,
+                                           latency)
+            if self.key_cache is not None:
+                hits, misses, evictions = state["keys"]
+                self.key_cache.hits += hits
+                self.key_cache.misses += misses
+                self.key_cache.evictions += evictions
+
+        # The last write wins, whichever processor received it.
+        gauges.sort()
+        for when, key, value in gauges:
+            self.compose_gauge_metric(key, value)
+
+    def merge_counter_metric(self, key, value):
+        self.counter_metrics[key] = self.counter_metrics.get(key, 0) + value
+
+    def merge_timer_metric(self, key, timers):
+        if self.timer_accuracy is not None:
+            if key in self.timer_metrics:
+                self.timer_metrics[key].merge(timers)
+            else:
+                self.timer_metrics[key] = timers
+            return
+        self.timer_metrics.setdefault(key, []).extend(timers)
+
+    def merge_plugin_metric(self, key, metric):
+        if key in self.plugin_metrics:
+            self.plugin_metrics[key].merge(metric)
+        else:
+            if hasattr(metric, "wall_time_func"):
+                metric.wall_time_func = self.time_function
+            self.plugin_metrics[key] = metric
+
+    def expire_idle_metrics(self):
+        """
+        Drop the metrics which were not updated for as many flush intervals
+        as their kind's time to live.
+        """
+        for kind, idle_keys in self.idle_keys.iteritems():
+            metrics = getattr(self, IDLE_METRICS[kind])
+            budget = self.key_budgets.get(kind)
+            for key in idle_keys.expire():
+                metrics.pop(key, None)
+                if budget is not None:
+                    budget.release(key)
+                if kind == "gauge" and self.gauge_updates is not None:
+                    self.gauge_updates.pop(key, None)
+
+    def release_keys(self, kind, metrics):
+        """
+        Give back the budget taken by the keys of C{metrics}, a dict of
+        metrics of C{kind} which is being dropped.
+        """
+        budget = self.key_budgets.get(kind)
+        if budget is not None:
+            for key in metrics:
+                budget.release(key)
+
+    def flush(self, interval=10000, percent=90, reduced=None):
         """
         Flush all queued stats, computing a normalized count based on
-        C{interval} and mean timings based on C{threshold}.
+        C{interval} and mean timings based on C{percent}, which may also be
+        a sequence of percentiles to report.
+
+        If C{reduced} is given, it is the result of L{reduce_snapshot}, and
+        its counters and timers are reported instead of the ones held here.
         """
+        self.expire_idle_metrics()
         per_metric = {}
         num_stats = 0
         interval = interval / 1000
-        timestamp = int(self.time_function())
-
-        start = self.time_function()
-        events = 0
-        for metrics in self.flush_counter_metrics(interval, timestamp):
-            for metric in metrics:
-                yield metric
-            events += 1
-        duration = self.time_function() - start
-        num_stats += events
-        per_metric["counter"] = (events, duration)
 
-        start = self.time_function()
-        events = 0
-        for metrics in self.flush_timer_metrics(percent, timestamp):
-            for metric in metrics:
-                yield metric
-            events += 1
-        duration = self.time_function() - start
-        num_stats += events
-        per_metric["timer"] = (events, duration)
+        if reduced is not None:
+            timestamp = reduced["timestamp"]
+            counter_names, counters, timer_names, timers = reduced["names"]
+            self.counter_names.merge(counter_names, counters)
+            self.timer_names.merge(timer_names, timers)
+            for name in ("counter", "timer"):
+                groups, duration = reduced[name]
+                for metrics in groups:
+                    for metric in metrics:
+                        yield metric
+                num_stats += len(groups)
+                per_metric[name] = (len(groups), duration)
+        else:
+            timestamp = int(self.time_function())
+
+            start = self.time_function()
+            events = 0
+            for metrics in self.flush_counter_metrics(interval, timestamp):
+                for metric in metrics:
+                    yield metric
+                events += 1
+            duration = self.time_function() - start
+            num_stats += events
+            per_metric["counter"] = (events, duration)
+
+            start = self.time_function()
+            events = 0
+            for metrics in self.flush_timer_metrics(percent, timestamp):
+                for metric in metrics:
+                    yield metric
+                events += 1
+            duration = self.time_function() - start
+            num_stats += events
+            per_metric["timer"] = (events, duration)
 
         start = self.time_function()
         events = 0
@@ -301,26 +1037,31 @@ class MessageProcessor(BaseMessageProcessor):
                 yield metric
 
     def flush_counter_metrics(self, interval, timestamp):
+        names = self.counter_names
         for key, count in self.counter_metrics.iteritems():
             self.counter_metrics[key] = 0
 
-            value = count / interval
-            if not self.legacy_namespace:
-                output = ((self.count_prefix + key + ".rate", value, timestamp),
-                          (self.count_prefix + key + ".count", count, timestamp))
-            else:
-                output = ((self.stats_prefix + key, value, timestamp),
-                          (self.count_prefix + key, count, timestamp))
+            rate_name, count_name = names[key]
             if self.lightweight_mode:
-                yield output[1:2]
+                yield ((count_name, count, timestamp),)
             else:
-                yield output
+                yield ((rate_name, count / interval, timestamp),
+                       (count_name, count, timestamp))
+        names.trim(self.counter_metrics)
         # clear all keys on each flush to avoid processing zeros.
         if self.delete_idle_counters:
+            self.release_keys("counter", self.counter_metrics)
             self.counter_metrics = {}
 
     def flush_timer_metrics(self, percent, timestamp):
-        threshold_value = ((100 - percent) / 100.0)
+        percentiles = self.timer_percentiles(percent)
+        self.update_timer_names(percentiles)
+        if self.timer_accuracy is not None:
+            for metrics in self.flush_timer_sketches(percentiles, timestamp):
+                yield metrics
+            self.timer_names.trim(self.timer_metrics)
+            return
+
         for key, timers in self.timer_metrics.iteritems():
             count = len(timers)
             if count > 0:
@@ -331,27 +1072,117 @@ class MessageProcessor(BaseMessageProcessor):
                 upper = timers[-1]
                 count = len(timers)
 
-                mean = lower
-                threshold_upper = upper
+                if count > 1:
+                    # Walk the sorted timers once, from the lowest rank up,
+                    # summing only the values each threshold adds.
+                    ranks = self.timer_ranks(percentiles, count)
+                    thresholds = [None] * len(ranks)
+                    total = 0
+                    position = 0
+                    for index, i in sorted(zip(ranks, range(len(ranks)))):
+                        total += sum(timers[position:index])
+                        position = index
+                        thresholds[i] = (total / index, timers[index - 1])
+                else:
+                    thresholds = [(lower, upper)] * len(percentiles)
+
+                yield self.format_timer_metrics(
+                    key, percentiles, timestamp, count, lower, upper,
+                    thresholds)
+        self.timer_names.trim(self.timer_metrics)
+
+    def flush_timer_sketches(self, percentiles, timestamp):
+        for key, sketch in self.timer_metrics.iteritems():
+            count = sketch.count
+            if count > 0:
+                lower = sketch.min
+                upper = sketch.max
 
                 if count > 1:
-                    index = count - int(round(threshold_value * count))
-                    timers = timers[:index]
-                    threshold_upper = timers[-1]
-                    mean = sum(timers) / index
-
-                items = {".mean": mean,
-                         ".upper": upper,
-                         ".upper_%s" % percent: threshold_upper,
-                         ".lower": lower}
-                if not self.lightweight_mode:
-                    items[".count"] = count
-                yield sorted((self.timer_prefix + key + item, value, timestamp)
-                             for item, value in items.iteritems())
+                    ranks = self.timer_ranks(percentiles, count)
+                    thresholds = [(total / index, threshold_upper)
+                                  for index, (total, threshold_upper)
+                                  in zip(ranks, sketch.lowest_many(ranks))]
+                else:
+                    thresholds = [(lower, upper)] * len(percentiles)
+
+                sketch.clear()
+                yield self.format_timer_metrics(
+                    key, percentiles, timestamp, count, lower, upper,
+                    thresholds)
+
+    def timer_percentiles(self, percent):
+        """
+        Return C{(threshold, mean names, upper name)} for each percentile
+        in C{percent}, which is a single number or a sequence of them.
+
+        A single percentile is reported as C{.mean} and C{.upper_N}, as it
+        always was. Several are each reported as C{.mean_N} and
+        C{.upper_N}, and C{.mean} is then the mean within the 90th
+        percentile, whether it is listed or not, so that its meaning does
+        not depend on the order of C{percent}.
+        """
+        if not isinstance(percent, (list, tuple)):
+            percent = [percent]
+        percentiles = []
+        for value in percent:
+            if value == int(value):
+                value = int(value)
+            name = str(value).replace(".", "")
+            if len(percent) == 1:
+                mean_names = (".mean",)
+            elif value == 90:
+                mean_names = (".mean", ".mean_90")
+            else:
+                mean_names = (".mean_" + name,)
+            percentiles.append(((100 - value) / 100.0, mean_names,
+                                ".upper_" + name))
+        if len(percent) > 1 and 90 not in percent:
+            percentiles.append((0.1, (".mean",), None))
+        return percentiles
+
+    def update_timer_names(self, percentiles):
+        """
+        Make L{timer_names} build the names reported for C{percentiles}, in
+        the order they sort, unless it already does.
+        """
+        suffixes = set([".upper", ".lower"])
+        for _, mean_names, upper_name in percentiles:
+            suffixes.update(mean_names)
+            if upper_name is not None:
+                suffixes.add(upper_name)
+        if not self.lightweight_mode:
+            suffixes.add(".count")
+        formats = [(self.timer_prefix, suffix) for suffix in sorted(suffixes)]
+        if formats != self.timer_names.formats:
+            self.timer_names.reset(formats)
+
+    def timer_ranks(self, percentiles, count):
+        """Return the number of timers within each of C{percentiles}."""
+        return [max(count - int(round(threshold * count)), 1)
+                for threshold, _, _ in percentiles]
+
+    def format_timer_metrics(self, key, percentiles, timestamp, count, lower,
+                             upper, thresholds):
+        items = {".upper": upper,
+                 ".lower": lower}
+        for (_, mean_names, upper_name), (mean, threshold_upper) in zip(
+            percentiles, thresholds):
+            for mean_name in mean_names:
+                items[mean_name] = mean
+            if upper_name is not None:
+                items[upper_name] = threshold_upper
+        if not self.lightweight_mode:
+            items[".count"] = count
+        names = self.timer_names
+        return [(name, items[suffix], timestamp)
+                for name, (_, suffix) in zip(names[key], names.formats)]
 
     def flush_gauge_metrics(self, timestamp):
+        names = self.gauge_names
         for key, value in self.gauge_metrics.iteritems():
-            yield ((self.gauge_prefix + key + ".value", value, timestamp),)
+            yield ((names[key][0], value, timestamp),)
+        names.trim(self.gauge_metrics)
 
     def flush_meter_metrics(self, timestamp):
         for metric in self.meter_metrics.itervalues():
@@ -380,16 +1211,105 @@ class MessageProcessor(BaseMessageProcessor):
             self.last_flush_duration += duration
 
         self.last_process_duration = 0
-        for metric_type, duration in self.process_timings.iteritems():
+        for metric_type, count in self.by_type.iteritems():
+            duration = self.process_timings.get(metric_type, 0)
             yield ((self.internal_metrics_prefix +
                     "receive.%s.count" %
-                    metric_type, self.by_type[metric_type], timestamp),
+                    metric_type, count, timestamp),
                    (self.internal_metrics_prefix +
                     "receive.%s.duration" %
                     metric_type, duration * 1000, timestamp))
             log.msg("Processing %d %s metrics took %.6f" %
-                    (self.by_type[metric_type], metric_type, duration))
+                    (count, metric_type, duration))
             self.last_process_duration += duration
 
         self.process_timings.clear()
         self.by_type.clear()
+
+        if self.datagrams:
+            yield ((self.internal_metrics_prefix + "receive.datagrams",
+                    self.datagrams, timestamp),
+                   (self.internal_metrics_prefix + "receive.datagram_lines",
+                    self.datagram_lines, timestamp))
+            log.msg("Received %d metrics in %d datagrams" %
+                    (self.datagram_lines, self.datagrams))
+        self.datagrams = 0
+        self.datagram_lines = 0
+
+        if self.ingest_batches:
+            yield ((self.internal_metrics_prefix + "ingest.batches",
+                    self.ingest_batches, timestamp),
+                   (self.internal_metrics_prefix + "ingest.batch_size",
+                    self.ingest_batched / float(self.ingest_batches),
+                    timestamp),
+                   (self.internal_metrics_prefix + "ingest.queue_depth",
+                    self.ingest_max_depth, timestamp),
+                   (self.internal_metrics_prefix + "ingest.dropped",
+                    self.ingest_dropped, timestamp))
+            if self.ingest_dropped:
+                log.msg("Dropped %d payloads on a full ingest queue" %
+                        self.ingest_dropped)
+        self.ingest_batches = 0
+        self.ingest_batched = 0
+        self.ingest_max_depth = 0
+        self.ingest_dropped = 0
+
+        if self.flush_send is not None:
+            duration, blocked, chunks = self.flush_send
+            yield ((self.internal_metrics_prefix + "flush.send.duration",
+                    duration * 1000, timestamp),
+                   (self.internal_metrics_prefix + "flush.send.blocked",
+                    blocked * 1000, timestamp),
+                   (self.internal_metrics_prefix + "flush.send.chunks",
+                    chunks, timestamp))
+        self.flush_send = None
+
+        for destination, (packets, size, messages) in sorted(
+                self.redirect_packets.iteritems()):
+            prefix = self.internal_metrics_prefix + "redirect." + destination
+            yield ((prefix + ".packets", packets, timestamp),
+                   (prefix + ".bytes", size, timestamp),
+                   (prefix + ".metrics_per_packet",
+                    messages / float(packets), timestamp))
+        self.redirect_packets = {}
+
+        for destination, (dropped, buffered, latency) in sorted(
+                self.redirect_buffers.iteritems()):
+            prefix = self.internal_metrics_prefix + "redirect." + destination
+            yield ((prefix + ".dropped", dropped, timestamp),
+                   (prefix + ".buffered_bytes", buffered, timestamp))
+            if latency is not None:
+                yield ((prefix + ".drain_latency", latency * 1000,
+                        timestamp),)
+            if dropped:
+                log.msg("Dropped %d lines redirected to %s" %
+                        (dropped, destination))
+        self.redirect_buffers = {}
+
+        for kind, idle_keys in sorted(self.idle_keys.iteritems()):
+            yield ((self.internal_metrics_prefix + "keys.%s.live" % kind,
+                    len(idle_keys.last_update), timestamp),
+                   (self.internal_metrics_prefix + "keys.%s.expired" % kind,
+                    idle_keys.expired, timestamp))
+            idle_keys.expired = 0
+
+        for kind, budget in sorted(self.key_budgets.iteritems()):
+            rejected = budget.reset_interval()
+            if rejected:
+                yield ((self.internal_metrics_prefix +
+                        "keys.%s.rejected" % kind,
+                        rejected, timestamp),)
+                log.msg("Folded %d new %s keys into overflow keys" %
+                        (rejected, kind))
+
+        if self.key_cache is not None:
+            hits, misses, evictions = self.key_cache.reset_stats()
+            if hits or misses:
+                yield ((self.internal_metrics_prefix + "keys.cache_hits",
+                        hits, timestamp),
+                       (self.internal_metrics_prefix + "keys.cache_misses",
+                        misses, timestamp),
+                       (self.internal_metrics_prefix + "keys.cache_evictions",
+                        evictions, timestamp),
+                       (self.internal_metrics_prefix + "keys.cache_size",
+                        len(self.key_cache.entries), timestamp))
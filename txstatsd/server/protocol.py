@@ -28,7 +28,9 @@ class StatsDServerProtocol(DatagramProtocol):
     """A Twisted-based implementation of the StatsD server.
 
     Data is received via UDP for local aggregation and then sent to a Graphite
-    server via TCP.
+    server via TCP. The C{processor} is usually an
+    L{IngestQueue<txstatsd.server.ingest.IngestQueue>}, so that datagrams are
+    processed in batches rather than as they arrive.
     """
 
     def __init__(self, processor, monitor_message=None,
@@ -44,8 +46,7 @@ class StatsDServerProtocol(DatagramProtocol):
             # monitoring agent.
             return self.transport.write(
                 self.monitor_response, (host, port))
-        return self.transport.reactor.callLater(
-            0, self.processor.process, data)
+        self.processor.process_datagram(data)
 
 
 class StatsDTCPServerProtocol(LineReceiver):
@@ -67,8 +68,7 @@ class StatsDTCPServerProtocol(LineReceiver):
             # Send the expected response to the
             # monitoring agent.
             return self.transport.write(self.monitor_response)
-        return self.transport.reactor.callLater(
-            0, self.processor.process, data)
+        self.processor.process(data)
 
 
 class StatsDTCPServerFactory(Factory):
@@ -36,11 +36,21 @@ Conditions supported:
         fnmatch.
     not [rule..]: will return the negation of the result of rule
 
+Since these conditions only look at the metric type and path, what each
+rule decides for a given pair is cached, as is the result of each rewrite.
 
 Targets supported:
     drop: will drop the message, stopping any further processing.
-    redirect_udp host port: will send to (host, port) by udp
-    redirect_tcp host port: will send to (host, port) by tcp
+    redirect_udp host port [payload_size]: will send to (host, port) by
+        udp, packing messages into datagrams of up to payload_size bytes
+        (1432 by default, 0 to send each message on its own)
+    redirect_tcp host port [buffer_size [spool_directory]]: will send to
+        (host, port) by tcp, buffering up to buffer_size bytes (1048576 by
+        default) while the connection is down or slow, and spilling the
+        oldest lines past that to spool_directory, or dropping them
+    redirect_hash host:port [host:port]*: will send by udp to the one of
+        the destinations that a consistent hash ring picks for the path,
+        packing messages into datagrams as redirect_udp does
     rewrite pattern repl: will rewrite the path like re.sub
     set_metric_type metric_type: will make the metric of type metric_type
 
@@ -48,6 +58,7 @@ Targets supported:
 import re
 import time
 import fnmatch
+from collections import deque
 
 from zope.interface import implements
 
@@ -57,10 +68,12 @@ from twisted.internet import interfaces
 from twisted.internet.protocol import (
     ReconnectingClientFactory, Protocol)
 from twisted.internet import defer
-from twisted.python import log
 
-from txstatsd.server.processor import BaseMessageProcessor
+from txstatsd.server.processor import (
+    BaseMessageProcessor, KeyCache, normalize_key)
+from txstatsd.server.spool import LineSpool
 from txstatsd.client import StatsDClientProtocol, TwistedStatsDClient
+from txstatsd.hashing import ConsistentHashRing
 
 
 class StopProcessingException(Exception):
@@ -85,29 +98,209 @@ class TCPRedirectService(Service):
         self.factory.stopTrying()
         if self.factory.protocol:
             self.factory.protocol.transport.loseConnection()
+        self.factory.close()
+        return Service.stopService(self)
+
+
+class CoalescingSender(Service):
+    """
+    Packs the messages written to it into newline-separated datagrams of at
+    most C{max_size} bytes for C{client}, sending each datagram once it is
+    full or C{delay} seconds after its first message.
+    """
+
+    def __init__(self, client, max_size=1432, delay=0.01, clock=None,
+                 count_packet=None):
+        """
+        @param count_packet: If given, called with the size and number of
+            messages of each datagram sent.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.client = client
+        self.max_size = max_size
+        self.delay = delay
+        self.clock = clock
+        self.count_packet = count_packet
+        self.buffer = []
+        # The size of the buffered messages, each with its newline.
+        self.size = 0
+        self.pending = None
+
+    def write(self, message):
+        size = len(message)
+        if self.buffer and self.size + size > self.max_size:
+            self.flush()
+        self.buffer.append(message)
+        self.size += size + 1
+        if self.size > self.max_size:
+            self.flush()
+        elif self.pending is None:
+            self.pending = self.clock.callLater(self.delay, self.flush)
+
+    def flush(self):
+        """Send the buffered messages as a datagram."""
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        if not self.buffer:
+            return
+        data = "\n".join(self.buffer)
+        self.client.write(data)
+        if self.count_packet is not None:
+            self.count_packet(len(data), len(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    def stopService(self):
+        self.flush()
         return Service.stopService(self)
 
 
 class TCPRedirectClientFactory(ReconnectingClientFactory):
+    """
+    Buffers the lines redirected to a destination for as long as they
+    cannot be written, in at most C{max_bytes} bytes, and writes them in
+    batches once they can. Past that budget, the oldest lines are spilled
+    to C{spool} if there is one, or dropped.
+    """
+
+    # The most bytes of buffered lines handed to a single writeSequence,
+    # and the most spooled lines read back at once.
+    batch_bytes = 64 * 1024
+    batch_lines = 1000
 
-    def __init__(self, callback=None):
+    def __init__(self, callback=None, max_bytes=1024 * 1024, spool=None,
+                 count_buffer=None, clock=None):
+        """
+        @param spool: A L{LineSpool} for the lines past C{max_bytes}.
+        @param count_buffer: If given, called with the bytes waiting to be
+            written, how many lines were just dropped and how long the
+            lines waited once they were all written, or C{None}.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
         self.callback = callback
         self.protocol = None
+        self.max_bytes = max_bytes
+        self.spool = spool
+        self.count_buffer = count_buffer
+        self.clock = clock
+        self.buffer = deque()
+        self.buffered = 0
+        self.pending = None
+        # When the oldest line still waiting could not be written.
+        self.stalled_since = None
 
     def buildProtocol(self, addr):
-        from twisted.internet import reactor
-
         self.resetDelay()
-        self.protocol = TCPRedirectProtocol()
+        protocol = TCPRedirectProtocol()
+        protocol.factory = self
         if self.callback:
-            reactor.callLater(0, self.callback)
+            self.clock.callLater(0, self.callback)
             self.callback = None
 
-        return self.protocol
+        return protocol
+
+    def clientConnected(self, protocol):
+        self.protocol = protocol
+        self.drain()
+
+    def clientDisconnected(self, protocol):
+        if self.protocol is protocol:
+            self.protocol = None
+
+    def writable(self):
+        return self.protocol is not None and not self.protocol.paused
+
+    def backlog(self):
+        """Return how many bytes of lines are waiting to be written."""
+        if self.spool is not None:
+            return self.buffered + self.spool.bytes
+        return self.buffered
+
+    def write(self, line):
+        if line[-2:] != "\r\n":
+            if line[-1] == "\r":
+                line += "\n"
+            else:
+                line += "\r\n"
+        self.buffer.append(line)
+        self.buffered += len(line)
+        dropped = 0
+        if self.buffered > self.max_bytes:
+            dropped = self.shed()
+
+        if self.writable():
+            # Lines written in the same reactor iteration share a batch.
+            if self.pending is None:
+                self.pending = self.clock.callLater(0, self.drain)
+        elif self.stalled_since is None:
+            self.stalled_since = self.clock.seconds()
+        if (dropped or self.stalled_since is not None) and (
+                self.count_buffer is not None):
+            self.count_buffer(self.backlog(), dropped, None)
+
+    def shed(self):
+        """
+        Bring the buffer back within budget, spilling the oldest lines to
+        the spool, down to half the budget so as to spill in bulk, or else
+        dropping them. Return how many lines were dropped.
+        """
+        buffer = self.buffer
+        if self.spool is not None:
+            lines = []
+            while self.buffered > self.max_bytes // 2:
+                line = buffer.popleft()
+                self.buffered -= len(line)
+                lines.append(line)
+            self.spool.append(lines)
+            return 0
+
+        dropped = 0
+        while self.buffered > self.max_bytes:
+            self.buffered -= len(buffer.popleft())
+            dropped += 1
+        return dropped
+
+    def drain(self):
+        """Write the waiting lines in batches, oldest first, until paused."""
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        while self.writable():
+            if self.spool is not None and self.spool.bytes:
+                lines = self.spool.read(self.batch_lines)
+            elif self.buffer:
+                buffer = self.buffer
+                lines = []
+                size = 0
+                while buffer and size < self.batch_bytes:
+                    line = buffer.popleft()
+                    size += len(line)
+                    lines.append(line)
+                self.buffered -= size
+            else:
+                break
+            self.protocol.transport.writeSequence(lines)
 
-    def write(self, data):
-        if self.protocol:
-            self.protocol.write(data)
+        if self.stalled_since is not None and not self.backlog():
+            latency = self.clock.seconds() - self.stalled_since
+            self.stalled_since = None
+            if self.count_buffer is not None:
+                self.count_buffer(0, 0, latency)
+
+    def close(self):
+        if self.pending is not None:
+            if self.pending.active():
+                self.pending.cancel()
+            self.pending = None
+        if self.spool is not None:
+            self.spool.close()
 
 
 class TCPRedirectProtocol(Protocol):
@@ -118,8 +311,6 @@ class TCPRedirectProtocol(Protocol):
 
     def __init__(self):
         self.paused = False
-        self.last_paused = None
-        self.dropped = 0
 
     def connectionMade(self):
         """
@@ -127,50 +318,98 @@ class TCPRedirectProtocol(Protocol):
         bound transport.
         """
         self.transport.registerProducer(self, True)
+        self.factory.clientConnected(self)
+
+    def connectionLost(self, reason):
+        self.factory.clientDisconnected(self)
 
     def pauseProducing(self):
         """Pause producing messages, since the buffer is full."""
-        self.last_paused = int(time.time())
         self.paused = True
 
     stopProducing = pauseProducing
 
     def resumeProducing(self):
         """We can write to the transport again. Yay!."""
-        time_now = int(time.time())
-        log("Resumed TCP redirect. "
-            "Dropped %s messages during %s seconds ",
-                self.dropped, time_now - self.last_paused)
         self.paused = False
-        self.dropped = 0
-        self.last_paused = None
+        self.factory.drain()
 
-    def write(self, line):
-        if self.paused:
-            self.dropped += 1
-            return
 
-        if line[-2:] != "\r\n":
-            if line[-1] == "\r":
-                line += "\n"
-            else:
-                line += "\r\n"
-        self.transport.write(line)
+class Rule(object):
+    """
+    A routing rule built from a line of the rules config, counting the
+    metrics it matched and the time spent evaluating its condition.
+    """
+
+    def __init__(self, line, condition, target):
+        self.line = line.strip()
+        self.condition = condition
+        self.target = target
+        # Whether the condition only depends on the metric type and key,
+        # so that its result can be cached.
+        self.pure = getattr(condition, "pure", False)
+        self.forwards = getattr(target, "forwards", False)
+        self.hits = 0
+        self.duration = 0
+
+
+def pure(condition):
+    """Mark C{condition} as only depending on the metric type and key."""
+    condition.pure = True
+    return condition
+
+
+def forwarding(target):
+    """
+    Mark C{target} as taking the message as a fourth argument, so that it
+    can send on the received bytes. The message is C{None} when it has to
+    be rebuilt, because a rule changed the metric.
+    """
+    target.forwards = True
+    return target
+
+
+# The processor hooks through which the router and its targets count
+# datagrams, batches, flushes and redirects.
+COUNT_HOOKS = ("count_datagram", "count_ingest_batch", "count_flush_send",
+               "count_redirect_packet", "count_redirect_buffer")
 
 
 class Router(BaseMessageProcessor):
 
-    def __init__(self, message_processor, rules_config, service=None):
+    # How long redirected messages may wait for others to share their
+    # datagram, in seconds.
+    coalesce_delay = 0.01
+
+    def __init__(self, message_processor, rules_config, service=None,
+                 cache_size=100000):
         """Configure a router with rules_config.
 
         rules_config is a new_line separeted list of rules.
+
+        @param cache_size: How many C{(metric_type, key)} decisions, and how
+            many keys per rewrite rule, are cached. Zero disables caching.
         """
         self.rules_config = rules_config
+        self.cache_size = cache_size
         self.message_processor = message_processor
         self.flush = message_processor.flush
+        self.snapshot = getattr(message_processor, "snapshot", None)
+        self.reduce_snapshot = getattr(message_processor, "reduce_snapshot",
+                                       None)
+        # Counts go to the processor if it keeps them, and are otherwise
+        # dropped by the no-op hooks inherited here.
+        for name in COUNT_HOOKS:
+            count = getattr(message_processor, name, None)
+            if count is not None:
+                setattr(self, name, count)
+        # Share the processor's key cache, since keys are normalized here.
+        self.normalize_key = getattr(message_processor, "normalize_key",
+                                     normalize_key)
         self.ready = defer.succeed(None)
         self.service = service
         self.rules = self.build_rules(rules_config)
+        self.reset_decisions(self.rules)
 
     def build_condition(self, condition):
         condition_parts = [
@@ -184,6 +423,7 @@ class Router(BaseMessageProcessor):
         return condition_function
 
     def build_rules(self, rules_config):
+        """Build the L{Rule}s in C{rules_config}."""
         rules = []
         for line in rules_config.split("\n"):
             if not line:
@@ -202,14 +442,56 @@ class Router(BaseMessageProcessor):
                 raise ValueError("unknown target %s" %
                                 (target_parts[0],))
 
-            rules.append((
-                condition_function,
-                target_factory(*target_parts[1:])))
+            rules.append(Rule(line, condition_function,
+                              target_factory(*target_parts[1:])))
         return rules
 
+    def reset_decisions(self, rules):
+        """Start a fresh cache of the decisions made by C{rules}."""
+        self.decided_rules = rules
+        if self.cache_size:
+            self.decisions = KeyCache(self.cache_size, normalize=self.decide)
+            self.lookup_decision = self.decisions.normalize
+        else:
+            self.decisions = None
+            self.lookup_decision = self.decide
+
+    def decide(self, metric):
+        """
+        Return whether each rule's condition matches the C{(metric_type,
+        key)} of C{metric}, or C{None} for the conditions which must be
+        evaluated for every message.
+        """
+        metric_type, key = metric
+        decision = []
+        for rule in self.decided_rules:
+            if not rule.pure:
+                decision.append(None)
+                continue
+            start = time.time()
+            decision.append(bool(rule.condition(metric_type, key, None)))
+            rule.duration += time.time() - start
+        return decision
+
+    def get_rule_stats(self):
+        """
+        Describe how many metrics each rule matched and how long its
+        condition took to evaluate, along with the decision cache.
+        """
+        rules = [dict(rule=rule.line, hits=rule.hits,
+                      evaluation_time=rule.duration)
+                 for rule in self.rules]
+        stats = dict(rules=rules)
+        if self.decisions is not None:
+            stats["cache"] = dict(size=len(self.decisions.entries),
+                                  hits=self.decisions.hits,
+                                  misses=self.decisions.misses,
+                                  evictions=self.decisions.evictions)
+        return stats
+
     def build_condition_any(self):
         """Returns a condition that always matches."""
-        return lambda *args: True
+        return pure(lambda *args: True)
 
     def build_condition_not(self, *args):
         """
@@ -219,18 +501,24 @@ class Router(BaseMessageProcessor):
 
         def not_condition(metric_type, key, fields):
             return not other_condition(metric_type, key, fields)
+        if getattr(other_condition, "pure", False):
+            pure(not_condition)
         return not_condition
 
     def build_condition_metric_type(self, *metric_types):
         """Returns a condition that matched on metric kind."""
+        metric_types = frozenset(metric_types)
+
         def metric_type_condition(metric_type, key, fields):
             return (metric_type in metric_types)
-        return metric_type_condition
+        return pure(metric_type_condition)
 
     def build_condition_path_like(self, pattern):
+        match = re.compile(fnmatch.translate(pattern)).match
+
         def path_like_condition(metric_type, key, fields):
-            return fnmatch.fnmatch(key, pattern)
-        return path_like_condition
+            return match(key) is not None
+        return pure(path_like_condition)
 
     def build_target_drop(self):
         """Returns a target that stops the processing of a message."""
@@ -241,11 +529,16 @@ class Router(BaseMessageProcessor):
     def build_target_rewrite(self, pattern, repl, dup="no-dup"):
         rexp = re.compile(pattern)
 
+        def rewrite(key):
+            return rexp.match(key) is not None, rexp.sub(repl, key)
+        if self.cache_size:
+            rewrite = KeyCache(self.cache_size, normalize=rewrite).normalize
+
         def rewrite_target(metric_type, key, fields):
-            if dup == "dup" and rexp.match(key) is not None:
+            matched, rewritten = rewrite(key)
+            if dup == "dup" and matched:
                 yield metric_type, key, fields
-            key = rexp.sub(repl, key)
-            yield metric_type, key, fields
+            yield metric_type, rewritten, fields
 
         return rewrite_target
 
@@ -256,61 +549,172 @@ class Router(BaseMessageProcessor):
             yield metric_type, key, fields
         return set_metric_type
 
-    def build_target_redirect_udp(self, host, port):
-        if self.service is None:
-            return lambda *args: True
-
-        port = int(port)
+    def build_udp_sender(self, host, port, payload_size=1432):
+        """
+        Return an object whose C{write} sends messages to C{(host, port)}
+        by udp, packed into datagrams of up to C{payload_size} bytes unless
+        it is zero.
+        """
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
 
+        def connected():
+            # An IP address is "resolved" both straight away and once the
+            # resolver answers.
+            if not d.called:
+                d.callback(None)
+
         client = TwistedStatsDClient.create(
-            host, port, connect_callback=lambda: d.callback(None))
+            host, port, connect_callback=connected)
         protocol = StatsDClientProtocol(client)
 
         udp_service = UDPServer(0, protocol)
         udp_service.setServiceParent(self.service)
 
-        def redirect_udp_target(metric_type, key, fields):
-            message = self.rebuild_message(metric_type, key, fields)
-            client.write(message)
+        if not payload_size:
+            return client
+
+        destination = "%s_%d" % (host.replace(".", "_"), port)
+
+        def count_packet(size, messages):
+            self.count_redirect_packet(destination, size, messages)
+        sender = CoalescingSender(client, payload_size, self.coalesce_delay,
+                                  count_packet=count_packet)
+        # Stopped before the udp service, so that it gets the last messages.
+        sender.setServiceParent(self.service)
+        return sender
+
+    def build_target_redirect_udp(self, host, port, payload_size=1432):
+        if self.service is None:
+            return lambda *args: True
+
+        sender = self.build_udp_sender(host, int(port), int(payload_size))
+
+        def redirect_udp_target(metric_type, key, fields, message=None):
+            if message is None:
+                message = self.rebuild_message(metric_type, key, fields)
+            sender.write(message)
+            yield metric_type, key, fields
+        return forwarding(redirect_udp_target)
+
+    def build_target_redirect_hash(self, *destinations):
+        if not destinations:
+            raise ValueError("redirect_hash needs at least one destination")
+        if self.service is None:
+            return lambda *args: True
+
+        senders = {}
+        for destination in destinations:
+            host, port = destination.rsplit(":", 1)
+            senders[destination] = self.build_udp_sender(host, int(port))
+        # The ring holds the destinations as written, so that every router
+        # given the same ones shards keys alike.
+        ring = ConsistentHashRing(sorted(senders))
+
+        def find_sender(key):
+            return senders[ring.get_node(key)]
+        if self.cache_size:
+            find_sender = KeyCache(self.cache_size,
+                                   normalize=find_sender).normalize
+
+        def redirect_hash_target(metric_type, key, fields, message=None):
+            if message is None:
+                message = self.rebuild_message(metric_type, key, fields)
+            find_sender(key).write(message)
             yield metric_type, key, fields
-        return redirect_udp_target
+        return forwarding(redirect_hash_target)
 
-    def build_target_redirect_tcp(self, host, port):
+    def build_target_redirect_tcp(self, host, port, buffer_size=1048576,
+                                  spool_directory=None):
         if self.service is None:
             return lambda *args: True
 
         port = int(port)
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
-        factory = TCPRedirectClientFactory(lambda: d.callback(None))
+
+        destination = "%s_%d" % (host.replace(".", "_"), port)
+
+        def count_buffer(buffered, dropped, latency):
+            self.count_redirect_buffer(destination, buffered, dropped,
+                                       latency)
+        spool = None
+        if spool_directory is not None:
+            spool = LineSpool(spool_directory)
+        factory = TCPRedirectClientFactory(
+            lambda: d.callback(None), max_bytes=int(buffer_size),
+            spool=spool, count_buffer=count_buffer)
 
         redirect_service = TCPRedirectService(host, port, factory)
         redirect_service.setServiceParent(self.service)
 
-        def redirect_tcp_target(metric_type, key, fields):
-            message = self.rebuild_message(metric_type, key, fields)
+        def redirect_tcp_target(metric_type, key, fields, message=None):
+            if message is None:
+                message = self.rebuild_message(metric_type, key, fields)
             factory.write(message)
             yield metric_type, key, fields
-        return redirect_tcp_target
+        return forwarding(redirect_tcp_target)
+
+    def is_raw_message(self, message, key):
+        """
+        Whether C{message} is exactly what L{rebuild_message} would make of
+        its parsed fields, with C{key} as normalized: no whitespace around
+        it, and a key that normalizing left alone.
+        """
+        return (message.startswith(key) and
+                message[len(key):len(key) + 1] == ":" and
+                not message[-1:].isspace())
 
     def process_message(self, message, metric_type, key, fields):
-        metrics = [(metric_type, key, fields)]
+        # Each metric carries the decision of every rule for its type and
+        # key, looked up once and kept for as long as neither changes, and
+        # the message as received for as long as no rule modifies it.
+        if not self.is_raw_message(message, key):
+            message = None
+        metrics = [(metric_type, key, fields, None, message)]
         if self.rules:
-            for condition, target in self.rules:
+            if self.rules is not self.decided_rules:
+                self.reset_decisions(self.rules)
+            lookup_decision = self.lookup_decision
+            for index, rule in enumerate(self.rules):
                 pending, metrics = metrics, []
                 if not pending:
                     return
-                for metric_type, key, fields in pending:
-                    if not condition(metric_type, key, fields):
-                        metrics.append((metric_type, key, fields))
+                for metric_type, key, fields, decision, message in pending:
+                    if decision is None:
+                        decision = lookup_decision((metric_type, key))
+                    matched = decision[index]
+                    if matched is None:
+                        start = time.time()
+                        matched = rule.condition(metric_type, key, fields)
+                        rule.duration += time.time() - start
+                    if not matched:
+                        metrics.append((metric_type, key, fields, decision,
+                                        message))
                         continue
-                    result = target(metric_type, key, fields)
-                    if result is not None:
-                        metrics.extend(result)
-
-        for (metric_type, key, fields) in metrics:
-            message = self.rebuild_message(metric_type, key, fields)
+                    rule.hits += 1
+                    if rule.forwards:
+                        result = rule.target(metric_type, key, fields,
+                                             message)
+                    else:
+                        result = rule.target(metric_type, key, fields)
+                    if result is None:
+                        continue
+                    for new_type, new_key, new_fields in result:
+                        # The message only holds the key and fields.
+                        if new_key != key or new_fields is not fields:
+                            new_message = None
+                        else:
+                            new_message = message
+                        if new_type != metric_type or new_key != key:
+                            new_decision = None
+                        else:
+                            new_decision = decision
+                        metrics.append((new_type, new_key, new_fields,
+                                        new_decision, new_message))
+
+        for (metric_type, key, fields, decision, message) in metrics:
+            if message is None:
+                message = self.rebuild_message(metric_type, key, fields)
             self.message_processor.process_message(message, metric_type,
                                                    key, fields)
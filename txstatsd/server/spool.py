@@ -0,0 +1,180 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Append-only, segmented spool files for datapoints that could not be sent
+to carbon, and for lines that could not be redirected.
+"""
+
+import os
+import struct
+
+# Each record is the timestamp, the value and the length of the metric
+# name, followed by the name itself.
+RECORD = struct.Struct("!IdH")
+# A spooled line is its length, followed by the line.
+LINE_RECORD = struct.Struct("!I")
+
+FSYNC_POLICIES = ("never", "segment", "always")
+
+
+class Spool(object):
+    """
+    Datapoints appended to numbered segment files in C{directory}, and read
+    back oldest first. A new segment is started once the current one holds
+    C{segment_size} bytes, and read segments are deleted.
+
+    Whatever is in the directory when the spool is created is read back
+    too, so that spooled datapoints survive a restart.
+    """
+
+    suffix = ".spool"
+    # The header of each record, whose last field is the length of the
+    # payload following it.
+    record = RECORD
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync="segment"):
+        """
+        @param fsync: When to ask for written data to reach the disk:
+            C{"never"}, on every full C{"segment"}, or after C{"always"}
+            appending.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r." % (fsync,))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = sorted(
+            int(name[:-len(self.suffix)]) for name in os.listdir(directory)
+            if name.endswith(self.suffix))
+        self.bytes = sum(os.path.getsize(self.path(segment))
+                         for segment in self.segments)
+        self.writer = None
+        self.written = 0
+        self.reader = None
+
+    def path(self, segment):
+        return os.path.join(self.directory,
+                            "%010d%s" % (segment, self.suffix))
+
+    def pack(self, datapoint):
+        metric, (timestamp, value) = datapoint
+        return RECORD.pack(int(timestamp), value, len(metric)) + metric
+
+    def unpack(self, header, payload):
+        timestamp, value, length = header
+        return payload, (timestamp, value)
+
+    def append(self, datapoints):
+        """Spool a list of C{(metric, (timestamp, value))}."""
+        data = "".join(self.pack(datapoint) for datapoint in datapoints)
+        if self.writer is None or self.written >= self.segment_size:
+            self.rotate()
+        self.writer.write(data)
+        self.written += len(data)
+        self.bytes += len(data)
+        if self.fsync == "always":
+            self.sync()
+
+    def rotate(self):
+        """Close the segment being written, and start a new one."""
+        if self.writer is not None:
+            if self.fsync != "never":
+                self.sync()
+            self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self.writer = open(self.path(segment), "ab")
+        self.written = 0
+
+    def sync(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+
+    def read(self, count):
+        """Remove and return up to C{count} of the oldest datapoints."""
+        datapoints = []
+        if self.writer is not None:
+            self.writer.flush()
+        while len(datapoints) < count and self.segments:
+            if self.reader is None:
+                self.reader = open(self.path(self.segments[0]), "rb")
+            record = self.reader.read(self.record.size)
+            if len(record) == self.record.size:
+                header = self.record.unpack(record)
+                length = header[-1]
+                payload = self.reader.read(length)
+                if len(payload) == length:
+                    datapoints.append(self.unpack(header, payload))
+                    self.bytes -= self.record.size + length
+                    continue
+                record += payload
+            # The end of the segment, or a record still being written.
+            self.reader.seek(-len(record), os.SEEK_CUR)
+            if len(self.segments) == 1 and self.writer is not None:
+                break
+            self.reader.close()
+            self.reader = None
+            os.remove(self.path(self.segments.pop(0)))
+            self.bytes -= len(record)
+        return datapoints
+
+    def oldest_timestamp(self):
+        """Return the timestamp of the oldest datapoint, or C{None}."""
+        if self.writer is not None:
+            self.writer.flush()
+        for segment in self.segments:
+            if segment == self.segments[0] and self.reader is not None:
+                position = self.reader.tell()
+                record = self.reader.read(RECORD.size)
+                self.reader.seek(position)
+            else:
+                with open(self.path(segment), "rb") as reader:
+                    record = reader.read(RECORD.size)
+            if len(record) == RECORD.size:
+                return RECORD.unpack(record)[0]
+        return None
+
+    def close(self):
+        for spool_file in (self.reader, self.writer):
+            if spool_file is not None:
+                spool_file.close()
+        self.reader = self.writer = None
+
+
+class LineSpool(Spool):
+    """A L{Spool} of lines, appended and read back as strings."""
+
+    record = LINE_RECORD
+
+    def pack(self, line):
+        return LINE_RECORD.pack(len(line)) + line
+
+    def unpack(self, header, payload):
+        return payload
+
+    def oldest_timestamp(self):
+        """Lines carry no timestamp."""
+        return None
@@ -0,0 +1,308 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+Spreads UDP ingestion over several worker processes.
+
+Every worker binds the same UDP port with C{SO_REUSEPORT}, so that the kernel
+balances datagrams between them, and aggregates what it receives with its own
+processor. At flush time the coordinating process asks each worker for its
+partial aggregates and merges them into its own processor, which then flushes
+to carbon as if it had received every message itself.
+
+Coordinator and workers talk over the workers' stdin and stdout, with
+length-prefixed pickles:
+    - the coordinator first sends the pickled options;
+    - then, at every flush, the string C{collect}, to which the worker
+      answers with the pickled result of C{export_state}.
+"""
+import os
+import sys
+import socket
+import struct
+import cPickle as pickle
+
+from twisted.application.service import Service, MultiService
+from twisted.internet import defer, udp
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+
+# Not exposed by the socket module of older Pythons; this is Linux's value.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+COLLECT = "collect"
+
+
+class ReusePort(udp.Port):
+    """A UDP port that other sockets can bind to as well."""
+
+    def createInternetSocket(self):
+        skt = udp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return skt
+
+
+class ReusePortUDPServer(Service):
+    """Listens on a UDP port shared with other processes."""
+
+    def __init__(self, port, protocol, interface="", reactor=None):
+        self.port = port
+        self.protocol = protocol
+        self.interface = interface
+        self.reactor = reactor
+        self.listener = None
+
+    def startService(self):
+        Service.startService(self)
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.listener = ReusePort(self.port, self.protocol,
+                                  interface=self.interface,
+                                  reactor=self.reactor)
+        self.listener.startListening()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            return listener.stopListening()
+
+
+class FrameReceiver(Int32StringReceiver):
+    """Reassembles the frames written by the other end of a pipe."""
+
+    MAX_LENGTH = 2 ** 31 - 1
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def stringReceived(self, data):
+        self.callback(data)
+
+
+def frame(data):
+    """Length-prefix C{data} the way L{FrameReceiver} expects it."""
+    return struct.pack(FrameReceiver.structFormat, len(data)) + data
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """The coordinator's end of the pipes to a worker process."""
+
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+        self.receiver = FrameReceiver(self.stateReceived)
+        self.states = []
+        self.waiting = None
+        self.running = False
+
+    def connectionMade(self):
+        self.running = True
+        self.transport.write(frame(pickle.dumps(self.pool.options, 2)))
+
+    def outReceived(self, data):
+        self.receiver.dataReceived(data)
+
+    def errReceived(self, data):
+        for line in data.rstrip().split("\n"):
+            log.msg("worker %d: %s" % (self.number, line))
+
+    def stateReceived(self, data):
+        self.states.append(pickle.loads(data))
+        self.done()
+
+    def collect(self):
+        """Ask the worker for its partial aggregates."""
+        self.done()
+        self.waiting = defer.Deferred()
+        self.transport.write(frame(COLLECT))
+        return self.waiting
+
+    def done(self):
+        if self.waiting is not None:
+            waiting, self.waiting = self.waiting, None
+            waiting.callback(None)
+
+    def stop(self):
+        self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        self.running = False
+        self.done()
+        self.pool.workerEnded(self, reason)
+
+
+class WorkerPool(Service):
+    """Runs the worker processes and merges their aggregates."""
+
+    respawn_delay = 1
+
+    def __init__(self, options, processor, workers, timeout=5, reactor=None):
+        """
+        @param options: The L{StatsDOptions}, handed to every worker.
+        @param processor: The processor merging the workers' aggregates.
+        @param workers: The number of worker processes.
+        @param timeout: How long, in seconds, to wait for the workers'
+            aggregates at flush time. Aggregates arriving later are merged
+            at the next flush.
+        """
+        self.options = dict(options)
+        self.processor = processor
+        self.count = workers
+        self.timeout = timeout
+        self.reactor = reactor
+        self.workers = []
+
+    def startService(self):
+        Service.startService(self)
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        for number in range(self.count):
+            self.spawn(number)
+
+    def stopService(self):
+        Service.stopService(self)
+        for worker in self.workers:
+            if worker.running:
+                worker.stop()
+
+    def spawn(self, number):
+        worker = WorkerProcessProtocol(self, number)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, "-m", "txstatsd.server.workers"], env=env)
+        self.workers.append(worker)
+
+    def workerEnded(self, worker, reason):
+        self.merge()
+        self.workers.remove(worker)
+        if self.running:
+            log.msg("worker %d ended: %s, restarting" %
+                    (worker.number, reason.getErrorMessage()))
+            self.reactor.callLater(self.respawn_delay, self.spawn,
+                                   worker.number)
+
+    def collect(self):
+        """
+        Merge the partial aggregates of all the workers into the processor.
+
+        @return: A C{Deferred} firing once every worker answered, or the
+            timeout expired.
+        """
+        finished = defer.Deferred()
+
+        def finish(_):
+            if timeout.active():
+                timeout.cancel()
+            if not finished.called:
+                self.merge()
+                finished.callback(None)
+
+        timeout = self.reactor.callLater(self.timeout, finish, None)
+        pending = [worker.collect() for worker in self.workers
+                   if worker.running]
+        defer.DeferredList(pending).addCallback(finish)
+        return finished
+
+    def merge(self):
+        states = []
+        for worker in self.workers:
+            states.extend(worker.states)
+            worker.states = []
+        if states:
+            self.processor.merge_states(states)
+
+
+def createWorkerService(options):
+    """
+    Create the services of a worker process, returning its processor and
+    the service to start.
+    """
+    from txstatsd import service
+    from txstatsd.server.ingest import IngestQueue
+    from txstatsd.server.protocol import StatsDServerProtocol
+    from txstatsd.server.router import Router
+
+    root_service = MultiService()
+    processor = service.createProcessor(options, service.get_plugins(options))
+    processor.gauge_updates = {}
+    # Workers hand all their metrics over at every collect, so only the
+    # coordinator expires idle ones and keeps to the key budgets.
+    processor.idle_keys = {}
+    processor.key_budgets = {}
+    processor.message_handlers = processor.build_message_handlers()
+    input_router = Router(processor, options["routing"], root_service,
+                          cache_size=options["routing-cache-size"])
+
+    ingest_queue = IngestQueue(
+        input_router, max_size=options["ingest-queue-size"],
+        time_budget=options["ingest-time-budget"] / 1000.0)
+    statsd_server_protocol = StatsDServerProtocol(
+        ingest_queue,
+        monitor_message=options["monitor-message"],
+        monitor_response=options["monitor-response"])
+    listener = ReusePortUDPServer(options["listen-port"],
+                                  statsd_server_protocol)
+    listener.setServiceParent(root_service)
+    return processor, root_service
+
+
+class WorkerProtocol(Int32StringReceiver):
+    """The worker's end of the pipes to the coordinator."""
+
+    MAX_LENGTH = FrameReceiver.MAX_LENGTH
+
+    processor = None
+    service = None
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def stringReceived(self, data):
+        if self.processor is None:
+            options = pickle.loads(data)
+            self.processor, self.service = createWorkerService(options)
+            self.service.startService()
+        elif data == COLLECT:
+            state = self.processor.export_state()
+            self.sendString(pickle.dumps(state, 2))
+
+    def connectionLost(self, reason):
+        if self.service is not None:
+            self.service.stopService()
+        self.reactor.stop()
+
+
+def main():
+    from twisted.internet import reactor, stdio
+
+    log.startLogging(sys.stderr)
+    stdio.StandardIO(WorkerProtocol(reactor))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -34,17 +34,21 @@ from twisted.plugin import getPlugins
 from txstatsd.client import InternalClient
 from txstatsd.metrics.metrics import Metrics
 from txstatsd.metrics.extendedmetrics import ExtendedMetrics
-from txstatsd.server.processor import MessageProcessor
+from txstatsd.server.processor import IDLE_METRICS, MessageProcessor
 from txstatsd.server.configurableprocessor import ConfigurableMessageProcessor
 from txstatsd.server.loggingprocessor import LoggingMessageProcessor
 from txstatsd.server.protocol import (
     StatsDServerProtocol, StatsDTCPServerFactory)
 from txstatsd.server.router import Router
+from txstatsd.server.carbonclient import CarbonClientManager
+from txstatsd.server.spool import FSYNC_POLICIES
+from txstatsd.server.ingest import IngestQueue
+from txstatsd.server.workers import WorkerPool
 from txstatsd.server import httpinfo
 from txstatsd.report import ReportingService, ReactorInspectorService
 from txstatsd.itxstatsd import IMetricFactory
 from twisted.application.service import Service
-from twisted.internet import task
+from twisted.internet import task, threads
 
 
 def accumulateClassList(classObj, attr, listObj,
@@ -61,6 +65,85 @@ def accumulateClassList(classObj, attr, listObj,
             listObj.extend(classObj.__dict__.get(attr, []))
 
 
+def parse_percentiles(value):
+    """Parse a comma-separated list of percentiles, such as C{50,90,99.9}."""
+    percentiles = []
+    for item in value.split(","):
+        percentile = float(item)
+        if not 0 < percentile <= 100:
+            raise ValueError("Percentiles must be between 0 and 100.")
+        if percentile == int(percentile):
+            percentile = int(percentile)
+        percentiles.append(percentile)
+    return tuple(percentiles)
+
+
+parse_percentiles.coerceDoc = "Must be a comma-separated list of numbers."
+
+
+def parse_kind_counts(value):
+    """
+    Parse a comma-separated list of metric kinds and positive numbers, such
+    as C{timer=10,gauge=60}.
+    """
+    counts = {}
+    for item in value.split(","):
+        kind, count = item.split("=")
+        kind = kind.strip()
+        if kind not in IDLE_METRICS:
+            raise ValueError("Unknown metric kind %r." % (kind,))
+        count = int(count)
+        if count < 1:
+            raise ValueError("Counts must be at least one.")
+        counts[kind] = count
+    return counts
+
+
+parse_kind_counts.coerceDoc = (
+    "Must be a comma-separated list of kind=number, where kind is one of "
+    "%s." % ", ".join(sorted(IDLE_METRICS)))
+
+
+def parse_prefix_counts(value):
+    """
+    Parse a comma-separated list of metric name prefixes and positive
+    numbers, such as C{app.requests=1000,hosts=5000}.
+    """
+    counts = {}
+    for item in value.split(","):
+        prefix, count = item.rsplit("=", 1)
+        count = int(count)
+        if count < 1:
+            raise ValueError("Counts must be at least one.")
+        counts[prefix.strip().rstrip(".")] = count
+    return counts
+
+
+parse_prefix_counts.coerceDoc = (
+    "Must be a comma-separated list of prefix=number.")
+
+
+def parse_carbon_protocol(value):
+    """Check that C{value} names a protocol carbon-cache understands."""
+    if value not in ("pickle", "line"):
+        raise ValueError("Unknown carbon protocol %r." % (value,))
+    return value
+
+
+parse_carbon_protocol.coerceDoc = "Must be either pickle or line."
+
+
+def parse_fsync_policy(value):
+    """Check that C{value} names a spool fsync policy."""
+    if value not in FSYNC_POLICIES:
+        raise ValueError("Unknown fsync policy %r." % (value,))
+    return value
+
+
+parse_fsync_policy.coerceDoc = "Must be one of %s." % ", ".join(
+    FSYNC_POLICIES)
+
+
 class OptionsGlue(usage.Options):
     """Extends usage.Options to also read parameters from a config file."""
 
@@ -151,7 +234,9 @@ class StatsDOptions(OptionsGlue):
 
     optParameters = [
         ["carbon-cache-host", "h", None,
-         "The host where carbon cache is listening.", str],
+         "The host where carbon cache is listening. Metrics are spread "
+         "across several carbon-caches as graphite-web expects only when "
+         "the carbon package is installed.", str],
         ["carbon-cache-port", "p", None,
          "The port where carbon cache is listening.", int],
         ["carbon-cache-name", "n", None,
@@ -188,14 +273,70 @@ class StatsDOptions(OptionsGlue):
          " before passing them to carbon.", int],
         ["routing", "g", "",
          "Routing rules", str],
+        ["routing-cache-size", None, 100000,
+         "Number of routing decisions, and of rewrites per rule, to cache "
+         "(0 to disable).", int],
         ["listen-tcp-port", "t", None,
          "The TCP port where we will listen.", int],
         ["max-queue-size", "Q", 20000,
          "Maximum send queue size per destination.", int],
         ["max-datapoints-per-message", "M", 1000,
          "Maximum datapoints per message to carbon-cache.", int],
+        ["carbon-protocol", None, "pickle",
+         "How to send datapoints to carbon-cache {pickle|line}.",
+         parse_carbon_protocol],
+        ["spool-dir", None, None,
+         "Directory where datapoints which do not fit in a destination's "
+         "send queue are spooled, instead of being dropped.", str],
+        ["spool-segment-size", None, 64 * 1024 * 1024,
+         "Size in bytes of each spool file.", int],
+        ["spool-fsync", None, "segment",
+         "When to fsync spooled datapoints {never|segment|always}.",
+         parse_fsync_policy],
+        ["spool-drain-rate", None, 10000,
+         "Most spooled datapoints sent per second and destination once "
+         "reconnected.", int],
         ["http-port", "P", None,
          "The httpinfo port.", int],
+        ["ingest-queue-size", None, 100000,
+         "Maximum number of received payloads waiting to be processed.",
+         int],
+        ["ingest-time-budget", None, 50,
+         "Milliseconds spent processing queued payloads per reactor "
+         "iteration.", int],
+        ["workers", None, 0,
+         "Number of worker processes sharing listen-port with SO_REUSEPORT, "
+         "whose aggregates are merged at flush time (0 to receive UDP in "
+         "this process).", int],
+        ["timer-accuracy", None, 0,
+         "Relative error of timer percentiles when summarised in a bounded "
+         "DDSketch, e.g. 0.01 (0 keeps every duration until the flush). "
+         "StatsD-compliant mode only.", float],
+        ["key-cache-size", None, 100000,
+         "Number of normalized metric names to cache (0 to disable).", int],
+        ["receive-timing-sample", None, 1,
+         "Time only one in this many received messages for the "
+         "receive.<type>.duration metrics and scale the result up "
+         "(1 times every message). Counts stay exact.", int],
+        ["percentiles", None, (90,),
+         "Comma-separated timer percentiles to report as mean_N and "
+         "upper_N, e.g. 50,90,99,99.9; mean is then the mean within the "
+         "90th. StatsD-compliant mode only.", parse_percentiles],
+        ["expire-idle", None, None,
+         "Drop metrics after this many flush intervals without an update, "
+         "per kind, e.g. counter=10,timer=10,gauge=60,meter=60,plugin=60.",
+         parse_kind_counts],
+        ["max-keys", None, None,
+         "Most keys to keep per kind, e.g. counter=100000,timer=20000; "
+         "further new keys are folded into <prefix>.__overflow__.",
+         parse_kind_counts],
+        ["max-keys-per-prefix", None, None,
+         "Most keys to keep under each prefix, per kind, e.g. "
+         "app.requests=1000.", parse_prefix_counts],
+        ["flush-in-thread", None, 0,
+         "Set to 1 to swap out counters and timers at each flush and reduce "
+         "them in a thread instead of on the reactor. StatsD-compliant mode "
+         "only.", int],
         ]
 
     def __init__(self):
@@ -217,10 +358,24 @@ class StatsDOptions(OptionsGlue):
 
 class StatsDService(Service):
 
-    def __init__(self, carbon_client, processor, flush_interval, clock=None):
+    def __init__(self, carbon_client, processor, flush_interval, clock=None,
+                 workers=None, percentiles=(90,), flush_in_thread=False,
+                 max_datapoints=1000):
         self.carbon_client = carbon_client
         self.processor = processor
         self.flush_interval = flush_interval
+        # Datapoints are handed to the carbon client, and the cooperator
+        # given back control, in chunks of this size.
+        self.max_datapoints = max_datapoints
+        self.percentiles = percentiles
+        self.workers = workers
+        # Reduce a snapshot of the counters and timers in a thread, so that
+        # sorting timers does not hold up the reactor, if the processor can
+        # take one.
+        self.flush_in_thread = (
+            flush_in_thread and
+            getattr(processor, "reduce_snapshot", None) is not None)
+        self.deferToThread = threads.deferToThread
         self.flush_task = task.LoopingCall(self.flushProcessor)
         self.coop = task.Cooperator()
         if clock is not None:
@@ -228,20 +383,68 @@ class StatsDService(Service):
 
     def flushProcessor(self):
         """Flush messages queued in the processor to Graphite."""
+        if self.workers is not None:
+            # Merge what the worker processes aggregated first.
+            d = self.workers.collect()
+            d.addCallback(lambda _: self._flushProcessor())
+            return d
+        return self._flushProcessor()
+
+    def _flushProcessor(self):
         start = time.time()
         interval = self.flush_interval
+        percentiles = self.percentiles
         flush = self.processor.flush
 
-        def doWork():
+        def doWork(reduced=None):
             flushed = 0
-            for metric, value, timestamp in flush(interval=interval):
-                yield self.carbon_client.sendDatapoint(
-                    metric, (timestamp, value))
-                flushed += 1
-            log.msg("Flushed total %d metrics in %.6f" %
-                    (flushed, time.time() - start))
-
-        self.coop.coiterate(doWork())
+            chunks = 0
+            blocked = 0
+            resumed = time.time()
+            chunk = []
+            for metric, value, timestamp in flush(interval=interval,
+                                                  percent=percentiles,
+                                                  reduced=reduced):
+                chunk.append((metric, (timestamp, value)))
+                if len(chunk) >= self.max_datapoints:
+                    self.sendDatapoints(chunk)
+                    flushed += len(chunk)
+                    chunks += 1
+                    chunk = []
+                    blocked += time.time() - resumed
+                    yield None
+                    resumed = time.time()
+            if chunk:
+                self.sendDatapoints(chunk)
+                flushed += len(chunk)
+                chunks += 1
+            blocked += time.time() - resumed
+
+            duration = time.time() - start
+            self.processor.count_flush_send(duration, blocked, chunks)
+            log.msg("Flushed total %d metrics in %.6f, blocking for %.6f" %
+                    (flushed, duration, blocked))
+
+        if not self.flush_in_thread:
+            self.coop.coiterate(doWork())
+            return
+
+        # The returned Deferred keeps the next flush from starting before
+        # this one's snapshot was reduced.
+        d = self.deferToThread(self.processor.reduce_snapshot,
+                               self.processor.snapshot(),
+                               interval=interval, percent=percentiles)
+        d.addCallback(lambda reduced: self.coop.coiterate(doWork(reduced)))
+        d.addErrback(log.err, "Could not reduce the flush snapshot")
+        return d
+
+    def sendDatapoints(self, datapoints):
+        """Hand a chunk of C{(metric, (timestamp, value))} to carbon."""
+        send = getattr(self.carbon_client, "sendDatapoints", None)
+        if send is not None:
+            return send(datapoints)
+        for metric, datapoint in datapoints:
+            self.carbon_client.sendDatapoint(metric, datapoint)
 
     def startService(self):
         self.flush_task.start(self.flush_interval / 1000, False)
@@ -251,30 +454,25 @@ class StatsDService(Service):
             self.flush_task.stop()
 
 
-def report_client_manager_stats():
-    from carbon.instrumentation import stats
-
-    current_stats = stats.copy()
-    for name, value in list(current_stats.items()):
-        del current_stats[name]
-        if name.startswith("destinations"):
-            current_stats[name.replace(":", "_")] = value
-        stats[name] = 0
-    return current_stats
-
+def get_instance_name(options):
+    """Return the name this instance reports its own stats under."""
+    instance_name = options["instance-name"]
+    if not instance_name:
+        instance_name = platform.node()
+    return instance_name
 
-def createService(options):
-    """Create a txStatsD service."""
-    from carbon.routers import ConsistentHashingRouter
-    from carbon.client import CarbonClientManager
-    from carbon.conf import settings
 
-    settings.MAX_QUEUE_SIZE = options["max-queue-size"]
-    settings.MAX_DATAPOINTS_PER_MESSAGE = options["max-datapoints-per-message"]
+def get_plugins(options):
+    """Return the configured metric plugins."""
+    plugin_metrics = []
+    for plugin in getPlugins(IMetricFactory):
+        plugin.configure(options)
+        plugin_metrics.append(plugin)
+    return plugin_metrics
 
-    root_service = MultiService()
-    root_service.setName("statsd")
 
+def createProcessor(options, plugin_metrics):
+    """Create the message processor configured by C{options}."""
     prefix = options["prefix"]
     internal_prefix = options["self-prefix"]
     legacy_namespace = options["legacy-namespace"]
@@ -286,15 +484,7 @@ def createService(options):
     if internal_prefix is None:
         internal_prefix = "statsd"
 
-    instance_name = options["instance-name"]
-    if not instance_name:
-        instance_name = platform.node()
-
-    # initialize plugins
-    plugin_metrics = []
-    for plugin in getPlugins(IMetricFactory):
-        plugin.configure(options)
-        plugin_metrics.append(plugin)
+    instance_name = get_instance_name(options)
 
     processor = None
     if options["dump-mode"]:
@@ -305,31 +495,56 @@ def createService(options):
         processor = functools.partial(LoggingMessageProcessor, logger=log)
 
     if options["statsd-compliance"]:
-        processor = (processor or MessageProcessor)(
+        return (processor or MessageProcessor)(
             plugins=plugin_metrics,
             message_prefix=prefix,
             internal_metrics_prefix=(internal_prefix or prefix) +
             "." + instance_name + ".",
             legacy_namespace=legacy_namespace,
             delete_idle_counters=delete_idle_counters,
-            lightweight_mode=lightweight_mode)
-        input_router = Router(processor, options['routing'], root_service)
-        connection = InternalClient(input_router)
-        metrics = Metrics(connection)
+            lightweight_mode=lightweight_mode,
+            timer_accuracy=options["timer-accuracy"] or None,
+            key_cache_size=options["key-cache-size"],
+            timing_sample_rate=options["receive-timing-sample"],
+            idle_ttls=options["expire-idle"],
+            key_limits=options["max-keys"],
+            prefix_key_limits=options["max-keys-per-prefix"])
     else:
-        processor = (processor or ConfigurableMessageProcessor)(
+        return (processor or ConfigurableMessageProcessor)(
             message_prefix=prefix,
             internal_metrics_prefix=(internal_prefix or prefix) +
             "." + instance_name + ".",
-            plugins=plugin_metrics)
-        input_router = Router(processor, options['routing'], root_service)
-        connection = InternalClient(input_router)
+            plugins=plugin_metrics,
+            key_cache_size=options["key-cache-size"],
+            timing_sample_rate=options["receive-timing-sample"],
+            idle_ttls=options["expire-idle"],
+            key_limits=options["max-keys"],
+            prefix_key_limits=options["max-keys-per-prefix"])
+
+
+def createService(options):
+    """Create a txStatsD service."""
+    root_service = MultiService()
+    root_service.setName("statsd")
+
+    instance_name = get_instance_name(options)
+    plugin_metrics = get_plugins(options)
+    processor = createProcessor(options, plugin_metrics)
+    input_router = Router(processor, options['routing'], root_service,
+                          cache_size=options["routing-cache-size"])
+    connection = InternalClient(input_router)
+    if options["statsd-compliance"]:
+        metrics = Metrics(connection)
+    else:
         metrics = ExtendedMetrics(connection)
 
     if not options["carbon-cache-host"]:
         options["carbon-cache-host"].append("127.0.0.1")
     if not options["carbon-cache-port"]:
-        options["carbon-cache-port"].append(2004)
+        if options["carbon-protocol"] == "line":
+            options["carbon-cache-port"].append(2003)
+        else:
+            options["carbon-cache-port"].append(2004)
     if not options["carbon-cache-name"]:
         options["carbon-cache-name"].append(None)
     if not options["carbon-client-prefix"]:
@@ -341,10 +556,6 @@ def createService(options):
     reporting = ReportingService(carbon_client_prefix)
     reporting.setServiceParent(root_service)
 
-    reporting.schedule(report_client_manager_stats,
-                       options["flush-interval"] / 1000,
-                       metrics.gauge)
-
     if options["report"] is not None:
         from txstatsd import process
         from twisted.internet import reactor
@@ -362,9 +573,14 @@ def createService(options):
                                     report_name.upper(), ()):
                 reporting.schedule(reporter, 60, metrics.gauge)
 
-    # XXX Make this configurable.
-    router = ConsistentHashingRouter()
-    carbon_client = CarbonClientManager(router)
+    carbon_client = CarbonClientManager(
+        max_queue_size=options["max-queue-size"],
+        batch_size=options["max-datapoints-per-message"],
+        protocol=options["carbon-protocol"],
+        spool_directory=options["spool-dir"],
+        spool_segment_size=options["spool-segment-size"],
+        spool_fsync=options["spool-fsync"],
+        drain_rate=options["spool-drain-rate"])
     carbon_client.setServiceParent(root_service)
 
     for host, port, name in zip(options["carbon-cache-host"],
@@ -372,21 +588,43 @@ def createService(options):
                                 options["carbon-cache-name"]):
         carbon_client.startClient((host, port, name))
 
+    reporting.schedule(carbon_client.report_stats,
+                       options["flush-interval"] / 1000,
+                       metrics.gauge)
+
+    workers = None
+    if options["workers"] > 0:
+        workers = WorkerPool(options, processor, options["workers"])
+
     statsd_service = StatsDService(carbon_client, input_router,
-                                   options["flush-interval"])
+                                   options["flush-interval"],
+                                   workers=workers,
+                                   percentiles=options["percentiles"],
+                                   flush_in_thread=(
+                                       options["flush-in-thread"] and
+                                       options["statsd-compliance"]),
+                                   max_datapoints=options[
+                                       "max-datapoints-per-message"])
     statsd_service.setServiceParent(root_service)
 
-    statsd_server_protocol = StatsDServerProtocol(
-        input_router,
-        monitor_message=options["monitor-message"],
-        monitor_response=options["monitor-response"])
+    ingest_queue = IngestQueue(
+        input_router, max_size=options["ingest-queue-size"],
+        time_budget=options["ingest-time-budget"] / 1000.0)
+
+    if workers is not None:
+        workers.setServiceParent(root_service)
+    else:
+        statsd_server_protocol = StatsDServerProtocol(
+            ingest_queue,
+            monitor_message=options["monitor-message"],
+            monitor_response=options["monitor-response"])
 
-    listener = UDPServer(options["listen-port"], statsd_server_protocol)
-    listener.setServiceParent(root_service)
+        listener = UDPServer(options["listen-port"], statsd_server_protocol)
+        listener.setServiceParent(root_service)
 
     if options["listen-tcp-port"] is not None:
         statsd_tcp_server_factory = StatsDTCPServerFactory(
-            input_router,
+            ingest_queue,
             monitor_message=options["monitor-message"],
             monitor_response=options["monitor-response"])
 
@@ -394,7 +632,8 @@ def createService(options):
                              statsd_tcp_server_factory)
         listener.setServiceParent(root_service)
 
-    httpinfo_service = httpinfo.makeService(options, processor, statsd_service)
+    httpinfo_service = httpinfo.makeService(options, processor, statsd_service,
+                                            router=input_router)
     httpinfo_service.setServiceParent(root_service)
 
     return root_service
@@ -0,0 +1,206 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A bounded-memory, mergeable quantile sketch.
+
+See:
+- U{DDSketch: A Fast and Fully-Mergeable Quantile Sketch with
+    Relative-Error Guarantees <https://arxiv.org/abs/1908.10693>}
+"""
+
+from math import ceil, log
+
+
+class DDSketch(object):
+    """
+    Summarises a stream of values in logarithmically sized buckets.
+
+    Every value C{x} falls into the bucket C{ceil(log(|x|) / log(gamma))},
+    where C{gamma = (1 + a) / (1 - a)} for a relative accuracy C{a}, so any
+    quantile read back is within C{a * |x|} of a value that actually has
+    that rank. Count, sum, minimum and maximum are kept exactly.
+
+    Memory is bounded by C{max_bins} buckets per sign. When a stream spans
+    more than that, the buckets closest to zero are folded together, which
+    only affects the accuracy of the lowest quantiles. With the default
+    accuracy of 1%, 2048 buckets cover values from 1 to about 10**17.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        """Creates a new C{DDSketch}.
+
+        @param relative_accuracy: The relative error bound on quantiles,
+            strictly between 0 and 1.
+        @param max_bins: The maximum number of buckets kept for positive
+            and for negative values.
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / log(self.gamma)
+        self.max_bins = max_bins
+        self.clear()
+
+    def clear(self):
+        self.positive = {}
+        self.negative = {}
+        self.positive_floor = None
+        self.negative_floor = None
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def key(self, value):
+        """Return the bucket index for a positive C{value}."""
+        return int(ceil(log(value) * self.multiplier))
+
+    def value(self, key):
+        """Return the representative value of the bucket C{key}."""
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        """Record C{value} in the sketch."""
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+
+        if value > 0:
+            key = self.key(value)
+            floor = self.positive_floor
+            bins = self.positive
+        elif value < 0:
+            key = self.key(-value)
+            floor = self.negative_floor
+            bins = self.negative
+        else:
+            self.zero_count += 1
+            return
+
+        if floor is not None and key < floor:
+            key = floor
+        if key in bins:
+            bins[key] += 1
+        else:
+            bins[key] = 1
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+    def _collapse(self, bins):
+        """Fold the lowest buckets of C{bins} so that C{max_bins} remain."""
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        floor = keys[excess]
+        for key in keys[:excess]:
+            bins[floor] += bins.pop(key)
+        if bins is self.positive:
+            self.positive_floor = floor
+        else:
+            self.negative_floor = floor
+
+    def _bins(self):
+        """Yield C{(value, count)} for every bucket, lowest value first."""
+        value = self.value
+        for key in sorted(self.negative, reverse=True):
+            yield -value(key), self.negative[key]
+        if self.zero_count:
+            yield 0, self.zero_count
+        for key in sorted(self.positive):
+            yield value(key), self.positive[key]
+
+    def lowest(self, n):
+        """
+        Return the estimated sum and the largest value of the C{n} smallest
+        values recorded, each within the relative accuracy of the sketch.
+        """
+        return self.lowest_many([n])[0]
+
+    def lowest_many(self, ranks):
+        """
+        Return L{lowest} for each of C{ranks}, walking the buckets once.
+        """
+        results = [None] * len(ranks)
+        pending = sorted(zip(ranks, range(len(ranks))), reverse=True)
+        while pending and pending[0][0] >= self.count:
+            results[pending.pop(0)[1]] = (self.sum, self.max)
+
+        total = 0
+        seen = 0
+        for value, count in self._bins():
+            if not pending:
+                break
+            while pending and pending[-1][0] <= seen + count:
+                n, i = pending.pop()
+                results[i] = (total + value * (n - seen),
+                              min(max(value, self.min), self.max))
+            total += value * count
+            seen += count
+        for n, i in pending:
+            results[i] = (total, self.max)
+        return results
+
+    def quantile(self, q):
+        """Return the estimated value at quantile C{q}, from 0 to 1."""
+        if self.count == 0:
+            return None
+        rank = int(round(q * (self.count - 1))) + 1
+        return self.lowest(rank)[1]
+
+    def merge(self, other):
+        """
+        Fold another C{DDSketch} with the same accuracy into this one, as if
+        its values had been added here.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches of different accuracy.")
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.min, self.max = other.min, other.max
+        else:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.sum += other.sum
+        self.zero_count += other.zero_count
+
+        for sign in ("positive", "negative"):
+            bins = getattr(self, sign)
+            floor = max(getattr(self, sign + "_floor"),
+                        getattr(other, sign + "_floor"))
+            for key, count in getattr(other, sign).iteritems():
+                if floor is not None and key < floor:
+                    key = floor
+                bins[key] = bins.get(key, 0) + count
+            if floor is not None:
+                for key in [low for low in bins if low < floor]:
+                    bins[floor] = bins.get(floor, 0) + bins.pop(key)
+                setattr(self, sign + "_floor", floor)
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
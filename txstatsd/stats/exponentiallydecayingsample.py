@@ -23,6 +23,12 @@ from time import time
 from random import random
 from math import exp
 from bisect import insort
+from heapq import heapify, heapreplace, heappush, nlargest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class ExponentiallyDecayingSample(object):
@@ -97,6 +103,18 @@ class ExponentiallyDecayingSample(object):
     def get_values(self):
         return [v for (k, v) in self._values]
 
+    def merge(self, other):
+        """
+        Fold the reservoir of another C{ExponentiallyDecayingSample} into this
+        one, keeping the values with the highest priorities once both are
+        expressed relative to our landmark.
+        """
+        scale = exp(-self.alpha * (self.start_time - other.start_time))
+        values = self._values + [(k * scale, v) for k, v in other._values]
+        values.sort()
+        self._values = values[-self.reservoir_size:]
+        self.count = len(self._values)
+
     def rescale(self, now, next):
         """
         A common feature of the above techniques - indeed, the key technique
@@ -129,3 +147,65 @@ class ExponentiallyDecayingSample(object):
             nk = k * exp(-self.alpha * (self.start_time - old_start_time))
             insort(new_values, (nk, v))
         self._values = new_values
+
+
+class HeapExponentiallyDecayingSample(ExponentiallyDecayingSample):
+    """
+    An L{ExponentiallyDecayingSample} whose reservoir is a min-heap keyed by
+    priority, so that replacing the lowest priority costs O(log n) instead
+    of an insertion into, and a removal from the front of, a sorted list.
+
+    Rescaling multiplies every priority by the same positive factor, which
+    keeps the heap ordered, so it is a single pass (vectorized with NumPy
+    when available) instead of a rebuild.
+    """
+
+    def update(self, value, timestamp=None):
+        """Adds an old value with a fixed timestamp to the sample.
+
+        @param value: The value to be added.
+        @param timestamp: The epoch timestamp of *value* in seconds.
+        """
+        if timestamp is None:
+            timestamp = self.tick()
+
+        if timestamp >= self.next_scale_time:
+            self.rescale(timestamp, self.next_scale_time)
+
+        priority = exp(self.alpha * (timestamp - self.start_time)) / random()
+        values = self._values
+
+        if self.count < self.reservoir_size:
+            self.count += 1
+            heappush(values, (priority, value))
+        elif values[0][0] < priority:
+            heapreplace(values, (priority, value))
+
+    def merge(self, other):
+        """
+        Fold the reservoir of another C{ExponentiallyDecayingSample} into this
+        one, keeping the values with the highest priorities once both are
+        expressed relative to our landmark.
+        """
+        scale = exp(-self.alpha * (self.start_time - other.start_time))
+        values = self._values + [(k * scale, v) for k, v in other._values]
+        self._values = nlargest(self.reservoir_size, values)
+        heapify(self._values)
+        self.count = len(self._values)
+
+    def rescale(self, now, next):
+        """
+        Move the landmark to C{now}, see
+        L{ExponentiallyDecayingSample.rescale}.
+        """
+        self.next_scale_time = (now + self.RESCALE_THRESHOLD)
+        scale = exp(-self.alpha * (now - self.start_time))
+        self.start_time = now
+
+        values = self._values
+        if numpy is not None and values:
+            priorities = numpy.fromiter(
+                (k for k, v in values), float, len(values)) * scale
+            self._values = zip(priorities.tolist(), [v for k, v in values])
+        else:
+            self._values = [(k * scale, v) for k, v in values]
@@ -0,0 +1,106 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Percentiles of a sample without sorting all of it.
+
+Only the order statistics a percentile interpolates between are selected.
+With NumPy 1.8 or later they come from C{numpy.partition} (introselect),
+otherwise from C{heapq.nsmallest}/C{heapq.nlargest} when they lie in one
+tail of the sample, which is the case for the high percentiles reported by
+timers. A full sort is the fallback when ranks from the middle are
+requested.
+"""
+
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    # numpy.partition first appeared in NumPy 1.8.
+    if not hasattr(numpy, "partition"):
+        numpy = None
+
+
+def percentile_ranks(size, percentiles):
+    """
+    Return C{(lower, upper, fraction)} for each of C{percentiles} over a
+    sample of C{size} values: the value at a percentile is the C{lower}-th
+    sorted value plus C{fraction} of the way to the C{upper}-th.
+    """
+    ranks = []
+    for p in percentiles:
+        pos = p * (size + 1)
+        if pos < 1:
+            ranks.append((0, 0, 0))
+        elif pos >= size:
+            ranks.append((size - 1, size - 1, 0))
+        else:
+            index = int(pos)
+            ranks.append((index - 1, index, pos - index))
+    return ranks
+
+
+def select(values, indexes):
+    """
+    Return a dict mapping each of C{indexes} to the value at that position
+    in C{values} once sorted.
+    """
+    size = len(values)
+    if numpy is not None:
+        wanted = sorted(set(indexes))
+        partitioned = numpy.partition(numpy.asarray(values), wanted)
+        return dict((i, partitioned[i].item()) for i in wanted)
+
+    lowest = max(indexes) + 1
+    highest = size - min(indexes)
+    if highest <= lowest and highest <= size >> 3:
+        top = heapq.nlargest(highest, values)
+        return dict((i, top[size - 1 - i]) for i in indexes)
+    if lowest <= size >> 3:
+        bottom = heapq.nsmallest(lowest, values)
+        return dict((i, bottom[i]) for i in indexes)
+    ordered = sorted(values)
+    return dict((i, ordered[i]) for i in indexes)
+
+
+def percentiles(values, *percentiles):
+    """
+    Return the values at C{percentiles} (between 0 and 1) of C{values},
+    interpolating between the closest ranks.
+    """
+    if not len(values):
+        return [0.0] * len(percentiles)
+    ranks = percentile_ranks(len(values), percentiles)
+    indexes = set()
+    for lower, upper, _ in ranks:
+        indexes.add(lower)
+        indexes.add(upper)
+    selected = select(values, indexes)
+    scores = []
+    for lower, upper, fraction in ranks:
+        value = selected[lower]
+        if fraction:
+            value += fraction * (selected[upper] - value)
+        scores.append(value)
+    return scores
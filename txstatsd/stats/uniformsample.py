@@ -19,8 +19,10 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import math
 import random
 import sys
+from array import array
 
 
 class UniformSample(object):
@@ -36,31 +38,127 @@ class UniformSample(object):
     def __init__(self, reservoir_size):
         """Creates a new C{UniformSample}.
 
+        The reservoir is an C{array('d')} that is only allocated by the
+        first update and grows up to C{reservoir_size} as values arrive,
+        so idle samples cost next to nothing. Clearing keeps the storage
+        and only resets the count.
+
         @param reservoir_size: The number of samples to keep in the sampling
             reservoir.
         """
-        self._values = [0 for i in range(reservoir_size)]
+        self.reservoir_size = reservoir_size
+        self._values = None
         self._count = 0
-        self.clear()
         self.maxint = getattr(sys, 'maxint', sys.maxsize)
 
     def clear(self):
-        self._values = [0 for i in range(len(self._values))]
         self._count = 0
 
     def size(self):
         c = self._count
-        return len(self._values) if c > len(self._values) else c
+        return self.reservoir_size if c > self.reservoir_size else c
 
     def update(self, value):
         self._count += 1
-        if self._count <= len(self._values):
-            self._values[self._count - 1] = value
+        if self._count <= self.reservoir_size:
+            if self._values is None:
+                self._values = array("d")
+            if self._count <= len(self._values):
+                self._values[self._count - 1] = value
+            else:
+                self._values.append(value)
         else:
             r = random.randint(1, self.maxint) % self._count
-            if r < len(self._values):
+            if r < self.reservoir_size:
                 self._values[r] = value
 
     def get_values(self):
         s = self.size()
-        return [self._values[i] for i in range(0, s)]
+        if not s:
+            return []
+        return self._values[:s].tolist()
+
+    def merge(self, other):
+        """
+        Fold the sample of another C{UniformSample} into this one, so that
+        it is a uniform sample of both streams together.
+        """
+        count = self._count + other._count
+        reservoir_size = self.reservoir_size
+        if count <= reservoir_size:
+            values = self.get_values() + other.get_values()
+        else:
+            ours = self.get_values()
+            theirs = other.get_values()
+            random.shuffle(ours)
+            random.shuffle(theirs)
+            # Draw each slot from either stream in proportion to how many
+            # values that stream has seen.
+            weight = float(self._count) / count
+            values = []
+            while len(values) < reservoir_size and (ours or theirs):
+                if ours and (not theirs or random.random() < weight):
+                    values.append(ours.pop())
+                else:
+                    values.append(theirs.pop())
+        self._values = array("d", values)
+        self._count = count
+
+
+class SkippingUniformSample(UniformSample):
+    """
+    A random sample of a stream of values. Uses Li's Algorithm L, which
+    draws how many values to skip before the next one enters the
+    reservoir, so that once the reservoir is full most updates only
+    increment a counter.
+
+    See:
+    - U{Reservoir-Sampling Algorithms of Time Complexity
+        O(n(1 + log(N/n))) <https://doi.org/10.1145/198429.198435>}
+    """
+
+    def __init__(self, reservoir_size):
+        super(SkippingUniformSample, self).__init__(reservoir_size)
+        self._weight = None
+        self._next = None
+
+    def clear(self):
+        super(SkippingUniformSample, self).clear()
+        self._weight = None
+        self._next = None
+
+    def update(self, value):
+        if self._count < self.reservoir_size:
+            super(SkippingUniformSample, self).update(value)
+            if self._count == self.reservoir_size:
+                self._weight = math.exp(
+                    math.log(random.random()) / self.reservoir_size)
+                self._skip()
+            return
+
+        self._count += 1
+        if self._count == self._next:
+            self._values[random.randrange(self.reservoir_size)] = value
+            self._weight *= math.exp(
+                math.log(random.random()) / self.reservoir_size)
+            self._skip()
+
+    def _skip(self):
+        """Draw the position of the next value to enter the reservoir."""
+        self._next = self._count + 1 + int(
+            math.log(1.0 - random.random()) / math.log(1 - self._weight))
+
+    def merge(self, other):
+        super(SkippingUniformSample, self).merge(other)
+        if self._count > self.reservoir_size:
+            # The weight is the largest of the reservoir_size smallest
+            # random keys among the values seen, which is Beta distributed.
+            self._weight = random.betavariate(
+                self.reservoir_size, self._count - self.reservoir_size + 1)
+            self._skip()
+        elif self._count == self.reservoir_size:
+            self._weight = math.exp(
+                math.log(random.random()) / self.reservoir_size)
+            self._skip()
+        else:
+            self._weight = self._next = None
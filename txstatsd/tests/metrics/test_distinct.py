@@ -110,9 +110,71 @@ class TestDistinctMetricReporter(TestCase):
         self.assertTrue(abs(dmr.count_1day(now) - 1728) < 500)
 
 
+class TestSlidingHyperLogLog(TestCase):
+
+    def test_all(self):
+        for r in [10, 1000, 50000]:
+            counter = distinct.SlidingHyperLogLog()
+            for i in range(r):
+                counter.add(1, str(i))
+            # Three standard errors at the default precision.
+            error = abs(counter.distinct() - r)
+            self.assertTrue(error <= 0.1 * r, (r, counter.distinct()))
+
+    def test_duplicates(self):
+        counter = distinct.SlidingHyperLogLog()
+        for i in range(1000):
+            counter.add(1, str(i % 10))
+        self.assertEquals(counter.distinct(), 10)
+
+    def test_reports(self):
+        _wall_time = [0]
+        def _time():
+            return _wall_time[0]
+
+        dmr = distinct.DistinctMetricReporter(
+            "test", wall_time_func=_time, counter=distinct.SlidingHyperLogLog())
+        for i in range(1, 3001):
+            _wall_time[0] = i * 50
+            dmr.update(str(i))
+        now = _time()
+        self.assertTrue(abs(dmr.count() - 3000) < 300)
+        self.assertEquals(dmr.count_1min(now), 2)
+        self.assertTrue(abs(dmr.count_1hour(now) - 72) < 4)
+        self.assertTrue(abs(dmr.count_1day(now) - 1728) < 100)
+
+    def test_merge(self):
+        single = distinct.SlidingHyperLogLog()
+        parts = [distinct.SlidingHyperLogLog(), distinct.SlidingHyperLogLog()]
+        for i in range(5000):
+            single.add(i, str(i))
+            parts[i % 2].add(i, str(i))
+        parts[0].merge(parts[1])
+        self.assertEquals(single.registers, parts[0].registers)
+        self.assertEquals(single.distinct(4000), parts[0].distinct(4000))
+
+    def test_merge_different_precision(self):
+        self.assertRaises(ValueError, distinct.SlidingHyperLogLog(10).merge,
+                          distinct.SlidingHyperLogLog(12))
+
+
 class TestPlugin(TestCase):
 
     def test_factory(self):
         self.assertTrue(distinct_plugin.distinct_metric_factory in \
                         list(getPlugins(IMetricFactory)))
 
+
+    def test_hyperloglog_backend(self):
+        factory = distinct_plugin.DistinctMetricFactory()
+        factory.configure({"plugin_pdistinct": [("backend", "hyperloglog"),
+                                                ("precision", "12")]})
+        metric = factory.build_metric("", "gorets")
+        self.assertTrue(isinstance(metric.counter,
+                                   distinct.SlidingHyperLogLog))
+        self.assertEquals(metric.counter.precision, 12)
+
+        factory.configure({})
+        metric = factory.build_metric("", "gorets")
+        self.assertTrue(isinstance(metric.counter,
+                                   distinct.SlidingDistinctCounter))
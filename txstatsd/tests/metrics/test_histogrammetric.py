@@ -23,7 +23,9 @@ import math
 from unittest import TestCase
 
 from txstatsd.metrics.histogrammetric import HistogramMetricReporter
-from txstatsd.stats.uniformsample import UniformSample
+from txstatsd.stats.exponentiallydecayingsample import (
+    HeapExponentiallyDecayingSample)
+from txstatsd.stats.uniformsample import SkippingUniformSample, UniformSample
 
 
 class TestHistogramReporterMetric(TestCase):
@@ -109,3 +111,44 @@ class TestHistogramReporterMetric(TestCase):
         for i in hist:
             self.assertTrue(abs(i - binsize) <= 1)
 
+
+    def test_merge(self):
+        merged = HistogramMetricReporter(UniformSample(100000))
+        other = HistogramMetricReporter(UniformSample(100000))
+        single = HistogramMetricReporter(UniformSample(100000))
+        for i in range(1, 10001):
+            (merged if i % 3 else other).update(i)
+            single.update(i)
+        merged.merge(other)
+
+        self.assertEqual(merged.count, single.count)
+        self.assertEqual(merged.min(), single.min())
+        self.assertEqual(merged.max(), single.max())
+        self.assertEqual(merged.mean(), single.mean())
+        self.assertTrue(
+            (math.fabs(merged.std_dev() - single.std_dev()) < 0.01),
+            'Should combine the standard deviations')
+        self.assertEqual(sorted(merged.get_values()),
+                         sorted(single.get_values()))
+
+    def test_using_skipping_uniform_sample(self):
+        histogram = HistogramMetricReporter.using_uniform_sample(skipping=True)
+        self.assertTrue(isinstance(histogram.sample, SkippingUniformSample))
+        for i in range(1, 10001):
+            histogram.update(i)
+
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(len(histogram.get_values()), 1028,
+                         'Should keep a full sample')
+
+    def test_using_heap_exponentially_decaying_sample(self):
+        histogram = HistogramMetricReporter.using_exponentially_decaying_sample(
+            heap=True)
+        self.assertTrue(isinstance(histogram.sample,
+                                   HeapExponentiallyDecayingSample))
+        for i in range(1, 10001):
+            histogram.update(i)
+
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(len(histogram.get_values()), 1028,
+                         'Should keep a full sample')
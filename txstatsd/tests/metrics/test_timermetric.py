@@ -25,6 +25,7 @@ import time
 from twisted.trial.unittest import TestCase
 
 from txstatsd.metrics.timermetric import TimerMetricReporter
+from txstatsd.stats.uniformsample import SkippingUniformSample, UniformSample
 
 
 class TestBlankTimerMetric(TestCase):
@@ -141,3 +142,16 @@ class TestTimingSeriesEvents(TestCase):
         self.assertEqual(
             set(self.timer.get_values()), set([10, 20, 20, 30, 40]),
             'Should have a series of values')
+
+
+class TestTimerSample(TestCase):
+
+    def test_default(self):
+        """Durations are sampled with a L{UniformSample} by default."""
+        timer = TimerMetricReporter('test')
+        self.assertEqual(UniformSample, type(timer.histogram.sample))
+
+    def test_skipping(self):
+        """A L{SkippingUniformSample} can be used instead."""
+        timer = TimerMetricReporter('test', skipping=True)
+        self.assertEqual(SkippingUniformSample, type(timer.histogram.sample))
@@ -0,0 +1,106 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import random
+from unittest import TestCase
+
+from txstatsd.stats.ddsketch import DDSketch
+
+
+class TestDDSketch(TestCase):
+
+    def assertWithin(self, expected, actual, accuracy):
+        self.assertTrue(abs(actual - expected) <= accuracy * abs(expected),
+                        "%r not within %r of %r" % (actual, accuracy, expected))
+
+    def test_exact_summary(self):
+        sketch = DDSketch()
+        for value in [4, 8, 15, 16, 23, 42]:
+            sketch.add(value)
+        self.assertEqual(6, sketch.count)
+        self.assertEqual(108, sketch.sum)
+        self.assertEqual(4, sketch.min)
+        self.assertEqual(42, sketch.max)
+        self.assertEqual((108, 42), sketch.lowest(6))
+
+    def test_relative_error_bound(self):
+        values = [random.lognormvariate(0, 2) for i in range(10000)]
+        sketch = DDSketch(0.01)
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in (0.01, 0.25, 0.5, 0.9, 0.99):
+            expected = values[int(round(q * (len(values) - 1)))]
+            self.assertWithin(expected, sketch.quantile(q), 0.01)
+
+    def test_lowest_sum(self):
+        values = range(1, 1001)
+        sketch = DDSketch(0.01)
+        for value in values:
+            sketch.add(value)
+        total, upper = sketch.lowest(900)
+        self.assertWithin(sum(values[:900]), total, 0.01)
+        self.assertWithin(900, upper, 0.01)
+
+    def test_zero_and_negative_values(self):
+        sketch = DDSketch(0.01)
+        for value in [-10, -1, 0, 0, 1, 10]:
+            sketch.add(value)
+        self.assertEqual(-10, sketch.quantile(0))
+        self.assertWithin(-1, sketch.quantile(0.2), 0.01)
+        self.assertEqual(0, sketch.quantile(0.5))
+        self.assertWithin(1, sketch.quantile(0.8), 0.01)
+        self.assertEqual(10, sketch.quantile(1))
+
+    def test_bounded_bins(self):
+        sketch = DDSketch(0.01, max_bins=100)
+        for i in range(1000):
+            sketch.add(1.05 ** i)
+        self.assertEqual(100, len(sketch.positive))
+        self.assertEqual(1000, sketch.count)
+        self.assertWithin(1.05 ** 989, sketch.quantile(0.99), 0.01)
+        sketch.add(1)
+        self.assertEqual(100, len(sketch.positive))
+
+    def test_merge(self):
+        values = [random.expovariate(0.1) for i in range(1000)]
+        single = DDSketch()
+        parts = [DDSketch(), DDSketch()]
+        for i, value in enumerate(values):
+            single.add(value)
+            parts[i % 2].add(value)
+        parts[0].merge(parts[1])
+        self.assertEqual(single.positive, parts[0].positive)
+        self.assertEqual(single.count, parts[0].count)
+        self.assertEqual(single.min, parts[0].min)
+        self.assertEqual(single.max, parts[0].max)
+        self.assertAlmostEqual(single.sum, parts[0].sum)
+
+    def test_merge_different_accuracy(self):
+        self.assertRaises(ValueError, DDSketch(0.01).merge, DDSketch(0.02))
+
+    def test_clear(self):
+        sketch = DDSketch()
+        sketch.add(1)
+        sketch.clear()
+        self.assertEqual(0, sketch.count)
+        self.assertEqual({}, sketch.positive)
+        self.assertEqual(None, sketch.quantile(0.5))
@@ -21,17 +21,20 @@
 
 import random
 
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase, SkipTest
 
+from txstatsd.stats import exponentiallydecayingsample
 from txstatsd.stats.exponentiallydecayingsample import (
-    ExponentiallyDecayingSample)
+    ExponentiallyDecayingSample, HeapExponentiallyDecayingSample)
 
 
 class TestExponentiallyDecayingSample(TestCase):
 
+    sample_class = ExponentiallyDecayingSample
+
     def test_100_out_of_1000_elements(self):
         population = [i for i in range(0, 100)]
-        sample = ExponentiallyDecayingSample(1000, 0.99)
+        sample = self.sample_class(1000, 0.99)
         for i in population:
             sample.update(i)
 
@@ -44,7 +47,7 @@ class TestExponentiallyDecayingSample(TestCase):
 
     def test_100_out_of_10_elements(self):
         population = [i for i in range(0, 10)]
-        sample = ExponentiallyDecayingSample(100, 0.99)
+        sample = self.sample_class(100, 0.99)
         for i in population:
             sample.update(i)
 
@@ -57,7 +60,7 @@ class TestExponentiallyDecayingSample(TestCase):
 
     def test_heavily_biased_100_out_of_1000_elements(self):
         population = [i for i in range(0, 100)]
-        sample = ExponentiallyDecayingSample(1000, 0.01)
+        sample = self.sample_class(1000, 0.01)
         for i in population:
             sample.update(i)
 
@@ -76,7 +79,7 @@ class TestExponentiallyDecayingSample(TestCase):
         def wtime():
             return _time[0]
 
-        sample = ExponentiallyDecayingSample(100, 0.99, wall_time=wtime)
+        sample = self.sample_class(100, 0.99, wall_time=wtime)
         sample.RESCALE_THRESHOLD = 100
         sample.clear()
         for i in xrange(10000000):
@@ -95,7 +98,7 @@ class TestExponentiallyDecayingSample(TestCase):
         def wtime():
             return _time[0]
 
-        sample = ExponentiallyDecayingSample(100, 0.99, wall_time=wtime)
+        sample = self.sample_class(100, 0.99, wall_time=wtime)
         for i in xrange(100):
             sample.update(random.normalvariate(0, 10))
             _time[0] += 10000
@@ -103,3 +106,49 @@ class TestExponentiallyDecayingSample(TestCase):
         self.assertEqual(sample.size(), 100)
         self.assertEqual(len(sample.get_values()), 100,
                          'Should have 100 elements')
+
+
+class TestHeapExponentiallyDecayingSample(TestExponentiallyDecayingSample):
+
+    sample_class = HeapExponentiallyDecayingSample
+
+    def check_matches_sorted_sample(self):
+        """
+        Given the same random draws, the heap keeps exactly the values the
+        sorted reservoir keeps, across rescales and merges.
+        """
+        _time = [10000]
+
+        def wtime():
+            return _time[0]
+
+        samples = []
+        for sample_class in (ExponentiallyDecayingSample,
+                             HeapExponentiallyDecayingSample):
+            random.seed(7)
+            sample = sample_class(100, 0.015, wall_time=wtime)
+            other = sample_class(100, 0.015, wall_time=wtime)
+            sample.RESCALE_THRESHOLD = 100
+            _time[0] = 10000
+            sample.clear()
+            other.clear()
+            for i in xrange(5000):
+                sample.update(i)
+                other.update(-i)
+                _time[0] += 1
+            sample.merge(other)
+            samples.append(sample)
+
+        expected, actual = samples
+        self.assertEqual(sorted(expected.get_values()),
+                         sorted(actual.get_values()))
+        self.assertEqual(expected.start_time, actual.start_time)
+
+    def test_matches_sorted_sample(self):
+        self.patch(exponentiallydecayingsample, "numpy", None)
+        self.check_matches_sorted_sample()
+
+    def test_matches_sorted_sample_numpy(self):
+        if exponentiallydecayingsample.numpy is None:
+            raise SkipTest("NumPy is not installed")
+        self.check_matches_sorted_sample()
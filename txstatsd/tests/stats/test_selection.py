@@ -0,0 +1,86 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+import random
+
+from twisted.trial.unittest import TestCase, SkipTest
+
+from txstatsd.stats import selection
+
+
+def sorted_percentiles(values, *percentiles):
+    """The full-sort computation the selection must agree with."""
+    values = sorted(values)
+    scores = []
+    for p in percentiles:
+        pos = p * (len(values) + 1)
+        if pos < 1:
+            scores.append(values[0])
+        elif pos >= len(values):
+            scores.append(values[-1])
+        else:
+            lower = values[int(pos) - 1]
+            upper = values[int(pos)]
+            scores.append(lower + (pos - math.floor(pos)) * (upper - lower))
+    return scores
+
+
+class PercentilesTest(TestCase):
+
+    percentiles = [
+        (0.5, 0.75, 0.95, 0.98, 0.99, 0.999),
+        (0.99, 0.999),
+        (0.001, 0.01),
+        (0.5,),
+        (0.0, 1.0),
+        ]
+
+    def check(self):
+        rnd = random.Random(0)
+        for size in (1, 2, 7, 100, 1028):
+            values = [rnd.expovariate(1) for i in range(size)]
+            for percentiles in self.percentiles:
+                expected = sorted_percentiles(values, *percentiles)
+                actual = selection.percentiles(values, *percentiles)
+                self.assertEqual(len(expected), len(actual))
+                for e, a in zip(expected, actual):
+                    self.assertAlmostEqual(e, a)
+
+    def test_pure_python(self):
+        """Without NumPy the tails are selected with heapq."""
+        self.patch(selection, "numpy", None)
+        self.check()
+
+    def test_numpy(self):
+        """With NumPy the ranks are selected with numpy.partition."""
+        if selection.numpy is None:
+            raise SkipTest("NumPy is not installed")
+        self.check()
+
+    def test_empty(self):
+        self.assertEqual([0.0, 0.0], selection.percentiles([], 0.5, 0.99))
+
+    def test_values_untouched(self):
+        """The sample passed in is not reordered."""
+        values = [3, 1, 2]
+        selection.percentiles(values, 0.5)
+        self.assertEqual([3, 1, 2], values)
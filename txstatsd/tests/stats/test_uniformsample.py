@@ -21,7 +21,9 @@
 
 from unittest import TestCase
 
-from txstatsd.stats.uniformsample import UniformSample
+import random
+
+from txstatsd.stats.uniformsample import SkippingUniformSample, UniformSample
 
 
 class TestUniformSample(TestCase):
@@ -50,3 +52,111 @@ class TestUniformSample(TestCase):
         self.assertEqual(
             len(set(sample.get_values()).difference(set(population))), 0,
             'Should only have elements from the population')
+
+    def test_merge(self):
+        first, second = UniformSample(100), UniformSample(100)
+        for i in range(0, 1000):
+            first.update(i)
+        for i in range(1000, 1300):
+            second.update(i)
+        first.merge(second)
+
+        self.assertEqual(first.size(), 100, 'Should have 100 elements')
+        self.assertEqual(
+            len(set(first.get_values()).difference(set(range(1300)))), 0,
+            'Should only have elements from both populations')
+
+    def test_merge_not_full(self):
+        first, second = UniformSample(100), UniformSample(100)
+        for i in range(0, 10):
+            first.update(i)
+            second.update(i + 10)
+        first.merge(second)
+
+        self.assertEqual(sorted(first.get_values()), range(20))
+
+    def test_lazy_allocation(self):
+        sample = UniformSample(1028)
+        self.assertEqual(sample.get_values(), [])
+        self.assertEqual(sample._values, None,
+                         'Should not allocate before the first update')
+
+        for i in range(10):
+            sample.update(i)
+        self.assertEqual(len(sample._values), 10,
+                         'Should only grow to the observed count')
+
+    def test_clear_keeps_storage(self):
+        sample = UniformSample(100)
+        for i in range(10):
+            sample.update(i)
+        storage = sample._values
+        sample.clear()
+        self.assertEqual(sample.size(), 0, 'Should be empty')
+        self.assertEqual(sample.get_values(), [])
+
+        for i in range(5):
+            sample.update(i + 100)
+        self.assertTrue(sample._values is storage,
+                        'Should reuse the storage after a clear')
+        self.assertEqual(sample.get_values(), range(100, 105))
+
+
+class TestSkippingUniformSample(TestCase):
+
+    def test_100_out_of_1000_elements(self):
+        population = range(1000)
+        sample = SkippingUniformSample(100)
+        for i in population:
+            sample.update(i)
+
+        self.assertEqual(sample.size(), 100, 'Should have 100 elements')
+        self.assertEqual(
+            len(set(sample.get_values()).difference(set(population))), 0,
+            'Should only have elements from the population')
+
+    def test_uniformity(self):
+        """
+        Every position of the stream is equally likely to be kept: over
+        many runs, each tenth of the stream supplies a tenth of the sample.
+        """
+        random.seed(42)
+        runs, size, length = 2000, 10, 1000
+        counts = [0] * 10
+        for run in range(runs):
+            sample = SkippingUniformSample(size)
+            for i in range(length):
+                sample.update(i)
+            for value in sample.get_values():
+                counts[int(value) * 10 / length] += 1
+
+        expected = runs * size / 10.0
+        chi_square = sum((count - expected) ** 2 / expected
+                         for count in counts)
+        # The 99.9% critical value of chi-square with 9 degrees of freedom.
+        self.assertTrue(chi_square < 27.88,
+                        'Should be uniform, chi-square %.2f' % chi_square)
+
+    def test_clear(self):
+        sample = SkippingUniformSample(10)
+        for i in range(100):
+            sample.update(i)
+        sample.clear()
+        for i in range(5):
+            sample.update(i + 100)
+        self.assertEqual(sample.get_values(), range(100, 105))
+
+    def test_merge(self):
+        first, second = SkippingUniformSample(100), SkippingUniformSample(100)
+        for i in range(0, 1000):
+            first.update(i)
+        for i in range(1000, 1300):
+            second.update(i)
+        first.merge(second)
+        for i in range(1300, 2000):
+            first.update(i)
+
+        self.assertEqual(first.size(), 100, 'Should have 100 elements')
+        self.assertEqual(
+            len(set(first.get_values()).difference(set(range(2000)))), 0,
+            'Should only have elements from every population')
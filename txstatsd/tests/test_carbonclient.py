@@ -0,0 +1,251 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import cPickle as pickle
+import struct
+
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import MemoryReactor, StringTransport
+from twisted.trial.unittest import TestCase, SkipTest
+
+from txstatsd.server.carbonclient import (
+    CarbonClientFactory, CarbonClientManager, CarbonHashRing)
+from txstatsd.server.spool import Spool
+
+
+def unframe(data):
+    """Unpickle the length-prefixed batches in C{data}."""
+    batches = []
+    while data:
+        length, = struct.unpack("!I", data[:4])
+        batches.append(pickle.loads(data[4:4 + length]))
+        data = data[4 + length:]
+    return batches
+
+
+class CarbonClientFactoryTest(TestCase):
+
+    def setUp(self):
+        self.factory = CarbonClientFactory(("127.0.0.1", 2004, "a"),
+                                           max_queue_size=5, batch_size=2)
+        self.datapoints = [("metric.%d" % i, (42, i)) for i in range(4)]
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def test_queued_until_connected(self):
+        """
+        Datapoints are queued until connected, then sent in pickled
+        batches of at most C{batch_size}.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(4, len(self.factory.queue))
+        protocol, transport = self.connect()
+        self.assertEqual([self.datapoints[:2], self.datapoints[2:]],
+                         unframe(transport.value()))
+        self.assertEqual(0, len(self.factory.queue))
+
+    def test_sent_when_connected(self):
+        protocol, transport = self.connect()
+        self.factory.sendDatapoints(self.datapoints[:1])
+        self.assertEqual([self.datapoints[:1]], unframe(transport.value()))
+
+    def test_paused(self):
+        """
+        While the transport is paused datapoints stay queued, and they are
+        sent once it resumes.
+        """
+        protocol, transport = self.connect()
+        protocol.pauseProducing()
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual("", transport.value())
+        protocol.resumeProducing()
+        self.assertEqual(2, len(unframe(transport.value())))
+
+    def test_line_protocol(self):
+        factory = CarbonClientFactory(("127.0.0.1", 2003, None),
+                                      protocol="line")
+        factory.sendDatapoints([("gorets", (42, 1.5))])
+        transport = StringTransport()
+        factory.buildProtocol(None).makeConnection(transport)
+        self.assertEqual("gorets 1.5 42\n", transport.value())
+
+    def test_full_queue(self):
+        """Datapoints which do not fit in the queue are dropped."""
+        self.factory.sendDatapoints(self.datapoints)
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(5, len(self.factory.queue))
+        self.assertEqual(dict(sent=0, dropped=3, queue_depth=5),
+                         self.factory.report_stats())
+        self.connect()
+        self.assertEqual(dict(sent=5, dropped=0, queue_depth=0),
+                         self.factory.report_stats())
+
+    def test_reconnect(self):
+        """
+        A lost connection is retried with a growing delay, which is reset
+        once connected again.
+        """
+        class Connector(object):
+            attempts = 0
+
+            def connect(self):
+                self.attempts += 1
+
+            def stopConnecting(self):
+                pass
+
+            def disconnect(self):
+                pass
+
+        connector = Connector()
+        clock = Clock()
+        self.factory.clock = clock
+        self.factory.clientConnectionFailed(connector, Failure(Exception()))
+        first = self.factory.delay
+        clock.advance(first)
+        self.assertEqual(1, connector.attempts)
+        self.factory.clientConnectionLost(connector, Failure(Exception()))
+        self.assertTrue(self.factory.delay > first)
+        clock.advance(self.factory.delay)
+        self.connect()
+        self.assertEqual(self.factory.initialDelay, self.factory.delay)
+
+        self.factory.clientConnectionLost(connector, Failure(Exception()))
+        self.factory.stopConnecting()
+        self.assertEqual([], clock.getDelayedCalls())
+        self.assertEqual(2, connector.attempts)
+
+
+class SpoolingFactoryTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.spool = Spool(self.mktemp())
+        self.addCleanup(self.spool.close)
+        self.factory = CarbonClientFactory(
+            ("127.0.0.1", 2004, "a"), max_queue_size=4, batch_size=100,
+            spool=self.spool, drain_rate=20, time_function=self.clock.seconds)
+        self.factory.drain_task.clock = self.clock
+        self.factory.drain_task.start(self.factory.drain_interval,
+                                      now=False)
+        self.addCleanup(self.factory.drain_task.stop)
+        self.datapoints = [("metric.%d" % i, (42, i)) for i in range(10)]
+
+    def test_spool_overflow(self):
+        """
+        Datapoints which do not fit in the queue are spooled, and sent back
+        at C{drain_rate} once connected.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(4, len(self.factory.queue))
+        self.assertEqual(0, self.factory.report_stats()["dropped"])
+        self.clock.advance(1)
+        self.assertNotEqual(0, self.spool.bytes)
+
+        transport = StringTransport()
+        self.factory.buildProtocol(None).makeConnection(transport)
+        self.clock.advance(0.1)
+        self.assertEqual(6, sum(len(batch)
+                                for batch in unframe(transport.value())))
+        self.clock.pump([0.1, 0.1])
+        self.assertEqual(sorted(self.datapoints),
+                         sorted(sum(unframe(transport.value()), [])))
+        self.assertEqual(0, self.spool.bytes)
+
+    def test_report_stats(self):
+        """
+        The size of the spool, the age of its oldest datapoint and how fast
+        it drains are reported.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.clock.advance(50)
+        stats = self.factory.report_stats()
+        self.assertEqual(self.spool.bytes, stats["spool_bytes"])
+        self.assertEqual(8, stats["spool_oldest_age"])
+        self.assertEqual(0, stats["spool_drain_rate"])
+
+        self.factory.buildProtocol(None).makeConnection(StringTransport())
+        self.clock.pump([0.1] * 5)
+        stats = self.factory.report_stats()
+        self.assertEqual(0, stats["spool_bytes"])
+        self.assertAlmostEqual(12, stats["spool_drain_rate"])
+
+
+class CarbonClientManagerTest(TestCase):
+
+    def setUp(self):
+        self.manager = CarbonClientManager(reactor=MemoryReactor())
+        self.destinations = [("127.0.0.1", 2004, "a"),
+                             ("127.0.0.1", 2005, "b")]
+        for destination in self.destinations:
+            self.manager.startClient(destination)
+        self.datapoints = [("metric.%d" % i, (42, i)) for i in range(50)]
+
+    def test_consistent_hashing(self):
+        """
+        Every metric always goes to the same destination, chosen by the
+        consistent hash ring.
+        """
+        self.manager.sendDatapoints(self.datapoints)
+        self.manager.sendDatapoint("metric.0", (43, 0))
+        for destination in self.destinations:
+            queue = self.manager.client_factories[destination].queue
+            self.assertTrue(queue)
+            for metric, datapoint in queue:
+                self.assertEqual(destination, self.manager.ring_nodes[
+                    self.manager.ring.get_node(metric)])
+
+    def test_carbon_ring(self):
+        """
+        When carbon is importable, metrics are placed like carbon-relay and
+        graphite-web place them, on C{(host, instance)} nodes.
+        """
+        if CarbonHashRing is None:
+            raise SkipTest("carbon is not installed")
+        ring = CarbonHashRing([("127.0.0.1", "a"), ("127.0.0.1", "b")])
+        self.manager.sendDatapoints(self.datapoints)
+        for destination in self.destinations:
+            queue = self.manager.client_factories[destination].queue
+            for metric, datapoint in queue:
+                self.assertEqual((destination[0], destination[2]),
+                                 ring.get_node(metric))
+
+    def test_start_service(self):
+        """Starting the manager connects to every destination."""
+        self.manager.startService()
+        self.assertEqual(
+            sorted((host, port) for host, port, instance in self.destinations),
+            sorted((host, port) for host, port, factory, timeout, bind
+                   in self.manager.reactor.tcpClients))
+        self.manager.stopService()
+
+    def test_report_stats(self):
+        self.manager.sendDatapoints(self.datapoints)
+        stats = self.manager.report_stats()
+        self.assertEqual(50,
+                         stats["destinations.127.0.0.1_2004_a.queue_depth"] +
+                         stats["destinations.127.0.0.1_2005_b.queue_depth"])
+        self.assertEqual(0, stats["destinations.127.0.0.1_2005_b.dropped"])
@@ -42,6 +42,14 @@ class Dummy:
     def get_metric_names(self):
         return self.metric_names
 
+    def get_key_budgets(self):
+        return {"counter": dict(keys=2, limit=2, rejected=1,
+                                top_prefixes=[("gorets", 1)])}
+
+    def get_rule_stats(self):
+        return {"rules": [dict(rule="any => drop", hits=3,
+                               evaluation_time=0.5)]}
+
 
 class ResponseCollector(protocol.Protocol):
 
@@ -82,7 +90,7 @@ class ServiceTestsBuilder(TestCase):
         o["http-port"] = webport
         d = Dummy()
         d.__dict__.update(kwargs)
-        self.service = s = httpinfo.makeService(o, d, d)
+        self.service = s = httpinfo.makeService(o, d, d, router=d)
         s.startService()
         agent = Agent(reactor)
 
@@ -156,3 +164,17 @@ class ServiceTestsBuilder(TestCase):
             timer_metrics={}, plugin_metrics={'gorets': tmr})
         hist = json.loads(data)
         self.assertTrue(isinstance(hist, dict))
+
+    @defer.inlineCallbacks
+    def test_httpinfo_key_budgets(self):
+        data = yield self.get_results("key_budgets")
+        self.assertEquals({"counter": dict(keys=2, limit=2, rejected=1,
+                                           top_prefixes=[["gorets", 1]])},
+                          json.loads(data))
+
+    @defer.inlineCallbacks
+    def test_httpinfo_rules(self):
+        data = yield self.get_results("rules")
+        self.assertEquals({"rules": [dict(rule="any => drop", hits=3,
+                                          evaluation_time=0.5)]},
+                          json.loads(data))
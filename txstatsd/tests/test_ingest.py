@@ -0,0 +1,123 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txstatsd.server.ingest import IngestQueue
+from txstatsd.server.processor import MessageProcessor
+
+
+class IngestQueueTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.now = [0]
+        self.processor = MessageProcessor(time_function=lambda: 42)
+        self.queue = IngestQueue(self.processor, max_size=3,
+                                 clock=self.clock,
+                                 time_function=lambda: self.now[0])
+
+    def test_process_on_next_iteration(self):
+        """
+        Queued payloads are processed in one batch on the next reactor
+        iteration, with a single delayed call for all of them.
+        """
+        self.queue.process_datagram("gorets:1|c\nglork:1|c")
+        self.queue.process("gorets:1|c")
+        self.assertEqual({}, self.processor.counter_metrics)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(0)
+        self.assertEqual(2, self.processor.counter_metrics["gorets"])
+        self.assertEqual(1, self.processor.counter_metrics["glork"])
+        self.assertEqual([], self.queue.queue)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_overflow_drops(self):
+        """Payloads that do not fit in the queue are dropped and counted."""
+        for i in range(5):
+            self.queue.process("gorets:1|c")
+        self.clock.advance(0)
+        self.assertEqual(3, self.processor.counter_metrics["gorets"])
+        self.assertEqual(2, self.processor.ingest_dropped)
+        self.assertEqual(3, self.processor.ingest_max_depth)
+        self.assertEqual(1, self.processor.ingest_batches)
+
+    def test_failure_isolated(self):
+        """
+        A payload that fails to process is logged and discarded, without
+        holding up or replaying the payloads around it.
+        """
+        def fail(data):
+            raise ValueError(data)
+
+        self.queue.process("gorets:1|c")
+        self.queue.put(fail, "broken")
+        self.queue.process("gorets:1|c")
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(2, self.processor.counter_metrics["gorets"])
+        self.assertEqual([], self.queue.queue)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_time_budget(self):
+        """
+        A drain stops once it runs out of time and resumes on the next
+        reactor iteration.
+        """
+        def advance(message):
+            self.now[0] += 1
+        self.processor.process = advance
+
+        self.queue.max_size = 1000
+        self.queue.check_every = 2
+        self.queue.time_budget = 3
+        for i in range(6):
+            self.queue.process("gorets:1|c")
+
+        self.clock.advance(0)
+        self.assertEqual(0, len(self.queue.queue))
+        self.assertEqual(2, self.processor.ingest_batches)
+        self.assertEqual(6, self.processor.ingest_batched)
+        self.assertEqual(6, self.processor.ingest_max_depth)
+
+    def test_flush_metrics_summary(self):
+        """Ingest statistics are reported under the internal prefix."""
+        for i in range(5):
+            self.queue.process("gorets:1|c")
+        self.clock.advance(0)
+        messages = []
+        map(messages.extend, self.processor.flush_metrics_summary(
+            0, {}, 42))
+        self.assertEqual([("statsd.numStats", 0, 42),
+                          ("statsd.receive.c.count", 3, 42),
+                          ("statsd.receive.c.duration", 0, 42),
+                          ("statsd.ingest.batches", 1, 42),
+                          ("statsd.ingest.batch_size", 3.0, 42),
+                          ("statsd.ingest.queue_depth", 3, 42),
+                          ("statsd.ingest.dropped", 2, 42),
+                          ("statsd.keys.cache_hits", 2, 42),
+                          ("statsd.keys.cache_misses", 1, 42),
+                          ("statsd.keys.cache_evictions", 0, 42),
+                          ("statsd.keys.cache_size", 1, 42)],
+                         messages)
+        self.assertEqual(0, self.processor.ingest_batches)
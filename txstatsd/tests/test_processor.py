@@ -24,7 +24,9 @@ import time
 from twisted.plugin import getPlugins
 from twisted.trial.unittest import TestCase
 
-from txstatsd.server.processor import MessageProcessor
+from txstatsd.server.processor import (
+    IdleKeys, KeyBudget, KeyCache, MessageProcessor, OutputNames, SLASHES,
+    SPACES, NON_ALNUM, normalize_key, parse_message)
 from txstatsd.itxstatsd import IMetricFactory
 
 
@@ -80,6 +82,43 @@ class ProcessMessagesTest(TestCase):
         self.assertEqual(1, len(self.processor.counter_metrics))
         self.assertEqual(1.0, self.processor.counter_metrics["gorets"])
 
+    def test_receive_datagram(self):
+        """
+        A datagram can carry several newline-separated messages, each of
+        which is processed on its own.
+        """
+        self.processor.process_datagram("gorets:1|c\nglork:320|ms\n")
+        self.assertEqual(1.0, self.processor.counter_metrics["gorets"])
+        self.assertEqual([320], self.processor.timer_metrics["glork"])
+        self.assertEqual(1, self.processor.datagrams)
+        self.assertEqual(2, self.processor.datagram_lines)
+
+    def test_receive_datagram_bad_line(self):
+        """
+        A malformed line in a datagram is discarded without affecting the
+        other messages in it.
+        """
+        self.processor.process_datagram("gorets:1|c\nglork\ngorets:2|c")
+        self.assertEqual(3.0, self.processor.counter_metrics["gorets"])
+        self.assertEqual(["glork"], self.processor.failures)
+
+    def test_receive_datagram_error(self):
+        """
+        A line that raises while being processed is logged, and the lines
+        after it in the datagram are still processed.
+        """
+        process = self.processor.process
+
+        def fail(message):
+            if message.endswith("|g"):
+                raise ValueError(message)
+            process(message)
+        self.processor.process = fail
+
+        self.processor.process_datagram("gorets:1|c\nglork:2|g\ngorets:2|c")
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(3.0, self.processor.counter_metrics["gorets"])
+
     def test_receive_counter_rate(self):
         """
         A counter message can also take the format 'gorets:1|c|@01', where
@@ -92,6 +131,39 @@ class ProcessMessagesTest(TestCase):
         self.assertEqual(1, len(self.processor.counter_metrics))
         self.assertEqual(10.0, self.processor.counter_metrics["gorets"])
 
+    def test_receive_counter_bad_rate(self):
+        """
+        A sample rate must be a plain decimal above zero, or the message is
+        discarded.
+        """
+        for rate in ["0", "0.0", "-0.5", "nan", "inf", "1e-9", "", "."]:
+            self.processor.process("gorets:1|c|@" + rate)
+        self.assertEqual({}, self.processor.counter_metrics)
+        self.assertEqual(8, len(self.processor.failures))
+
+        self.processor.process("gorets:1|c|@1")
+        self.assertEqual(1.0, self.processor.counter_metrics["gorets"])
+
+    def test_receive_counter_rate_above_one(self):
+        """Sample rates above one are still accepted, as they always were."""
+        self.processor.process("gorets:3|c|@1.5")
+        self.assertEqual(2.0, self.processor.counter_metrics["gorets"])
+
+    def test_receive_counter_rates_remembered(self):
+        """
+        Valid sample rates are checked once and remembered, up to
+        C{max_sample_rates} of them.
+        """
+        self.processor.max_sample_rates = 2
+        self.processor.process("gorets:1|c|@0.5")
+        self.processor.process("gorets:1|c|@0.5")
+        self.processor.process("gorets:1|c|@0")
+        self.assertEqual({"@0.5": 0.5}, self.processor.sample_rates)
+        self.processor.process("gorets:1|c|@0.25")
+        self.processor.process("gorets:1|c|@0.1")
+        self.assertEqual({"@0.1": 0.1}, self.processor.sample_rates)
+        self.assertEqual(18.0, self.processor.counter_metrics["gorets"])
+
     def test_receive_timer(self):
         """
         A timer message takes the format 'glork:320|ms', where 'glork' is the
@@ -165,6 +237,509 @@ class ProcessMessagesTest(TestCase):
         self.assertEqual(["gorets:1|c|@0.1|yay"], self.processor.failures)
 
 
+    def test_receive_bad_rate(self):
+        """
+        If a counter's sample rate is not '@' and a number, the message is
+        logged and discarded.
+        """
+        self.processor.process("gorets:1|c|0.1")
+        self.processor.process("gorets:1|c|@yay")
+        self.assertEqual(0, len(self.processor.counter_metrics))
+        self.assertEqual(["gorets:1|c|0.1", "gorets:1|c|@yay"],
+                         self.processor.failures)
+
+    def test_receive_unknown_type(self):
+        """A message of an unknown type is logged and discarded."""
+        self.processor.process("gorets:1|yay")
+        self.assertEqual(["gorets:1|yay"], self.processor.failures)
+        self.assertEqual({}, self.processor.by_type)
+
+
+class ParseMessageTest(TestCase):
+
+    def test_parse(self):
+        self.assertEqual(("gorets", "c", ["1", "c"]),
+                         parse_message("gorets:1|c"))
+        self.assertEqual(("gorets", "c", ["1", "c", "@0.1"]),
+                         parse_message("gorets:1|c|@0.1\n"))
+        self.assertEqual(("gorets", "g", ["1:2", "g"]),
+                         parse_message("gorets:1:2|g"))
+        self.assertEqual(("gorets", "", ["1", "", ""]),
+                         parse_message("gorets:1||"))
+
+    def test_malformed(self):
+        for message in ["gorets", "gorets:1", "gorets|c", "gorets:1|c|@1|x"]:
+            self.assertEqual(None, parse_message(message))
+
+    def test_plugin_dispatch(self):
+        """
+        Plugin metric types are dispatched to their plugin, but cannot take
+        over a built-in type.
+        """
+        class Plugin(object):
+            name = "fake"
+
+            def __init__(self, metric_type):
+                self.metric_type = metric_type
+
+            def build_metric(self, prefix, name, wall_time_func):
+                return self
+
+            def process(self, fields):
+                processed.append(fields)
+
+        processed = []
+        processor = MessageProcessor(plugins=[Plugin("xx"), Plugin("c")])
+        processor.process("gorets:1|xx")
+        processor.process("glork:1|c")
+        self.assertEqual([["1", "xx"]], processed)
+        self.assertEqual({"glork": 1}, processor.counter_metrics)
+
+class NormalizeKeyTest(TestCase):
+
+    def regex_normalize(self, key):
+        key = SPACES.sub("_", key)
+        key = SLASHES.sub("-", key)
+        return NON_ALNUM.sub("", key)
+
+    def test_normalize_key(self):
+        """
+        Spaces become underscores, slashes become dashes and anything else
+        that graphite does not accept is dropped.
+        """
+        for key in ["gorets", "glork.foo-bar_baz", "a b", "a  \tb",
+                    "a/b", "a//b", "a$b%c", "a \x01 b", "/ a b /",
+                    u"unicode key", ""]:
+            self.assertEqual(self.regex_normalize(key), normalize_key(key))
+
+    def test_valid_key_untouched(self):
+        """A key that is already valid is returned as is."""
+        key = "glork.foo-bar_baz"
+        self.assertTrue(normalize_key(key) is key)
+
+
+class KeyCacheTest(TestCase):
+
+    def test_hits_and_misses(self):
+        cache = KeyCache(10)
+        self.assertEqual("a_b", cache.normalize("a b"))
+        self.assertEqual("a_b", cache.normalize("a b"))
+        self.assertEqual("c", cache.normalize("c"))
+        self.assertEqual((1, 2, 0), cache.reset_stats())
+        self.assertEqual((0, 0, 0), cache.reset_stats())
+
+    def test_clock_eviction(self):
+        """Keys hit since the hand last passed are spared an eviction."""
+        cache = KeyCache(3)
+        for key in ["a", "b", "c"]:
+            cache.normalize(key)
+        cache.normalize("a")
+        cache.normalize("d")
+        self.assertEqual(["a", "c", "d"], sorted(cache.entries))
+        self.assertEqual(1, cache.evictions)
+        cache.normalize("e")
+        self.assertEqual(["a", "d", "e"], sorted(cache.entries))
+        self.assertEqual(2, cache.evictions)
+        self.assertEqual(3, len(cache.ring))
+
+    def test_processor_reports_cache(self):
+        """Cache statistics are flushed under the internal prefix."""
+        processor = MessageProcessor(time_function=lambda: 42,
+                                     key_cache_size=1)
+        processor.process("gorets:1|c")
+        processor.process("gorets:1|c")
+        processor.process("glork:1|c")
+        messages = list(processor.flush())
+        self.assertTrue(("statsd.keys.cache_hits", 1, 42) in messages)
+        self.assertTrue(("statsd.keys.cache_misses", 2, 42) in messages)
+        self.assertTrue(("statsd.keys.cache_evictions", 1, 42) in messages)
+        self.assertTrue(("statsd.keys.cache_size", 1, 42) in messages)
+
+    def test_disabled(self):
+        processor = MessageProcessor(key_cache_size=0)
+        self.assertEqual(None, processor.key_cache)
+        processor.process("a b:1|c")
+        self.assertEqual(["a_b"], processor.counter_metrics.keys())
+
+
+class SnapshotFlushTest(TestCase):
+
+    def setUp(self):
+        self.processor = MessageProcessor(time_function=lambda: 42)
+
+    def test_snapshot(self):
+        """
+        A snapshot takes the counters and timers gathered so far, leaving
+        idle counters at zero.
+        """
+        self.processor.process("gorets:1|c")
+        self.processor.process("glork:320|ms")
+        snapshot = self.processor.snapshot()
+        self.assertEqual({"gorets": 1}, snapshot["counters"])
+        self.assertEqual({"glork": [320]}, snapshot["timers"])
+        self.assertEqual(42, snapshot["timestamp"])
+        self.assertEqual({"gorets": 0}, self.processor.counter_metrics)
+        self.assertEqual({}, self.processor.timer_metrics)
+
+    def test_snapshot_delete_idle_counters(self):
+        self.processor.delete_idle_counters = 1
+        self.processor.process("gorets:1|c")
+        self.processor.snapshot()
+        self.assertEqual({}, self.processor.counter_metrics)
+
+    def test_flush_reduced(self):
+        """
+        Flushing a reduced snapshot reports the same datapoints as flushing
+        the processor itself.
+        """
+        other = MessageProcessor(time_function=lambda: 42)
+        for processor in (self.processor, other):
+            processor.process("gorets:1|c")
+            processor.process("glork:320|ms")
+            processor.process("glork:200|ms")
+            processor.process("gaugor:333|g")
+        reduced = self.processor.reduce_snapshot(
+            self.processor.snapshot(), percent=[50, 90])
+        self.processor.process("gorets:1|c")
+        expected = [metric for metric in other.flush(percent=[50, 90])
+                    if not metric[0].startswith("statsd.")]
+        flushed = [metric for metric in self.processor.flush(
+            percent=[50, 90], reduced=reduced)
+            if not metric[0].startswith("statsd.")]
+        self.assertEqual(sorted(expected), sorted(flushed))
+        self.assertEqual({"gorets": 1}, self.processor.counter_metrics)
+
+    def test_reduce_snapshot_leaves_names(self):
+        """
+        Reducing a snapshot only reads the name caches; the names it builds
+        are merged back when the reduced snapshot is flushed.
+        """
+        self.processor.process("gorets:1|c")
+        self.processor.process("glork:320|ms")
+        reduced = self.processor.reduce_snapshot(self.processor.snapshot())
+        self.assertEqual({}, self.processor.counter_names.names)
+        self.assertEqual({}, self.processor.timer_names.names)
+        list(self.processor.flush(reduced=reduced))
+        self.assertEqual(["gorets"],
+                         self.processor.counter_names.names.keys())
+        self.assertEqual(["glork"], self.processor.timer_names.names.keys())
+
+
+class IdleKeysTest(TestCase):
+
+    def test_expire(self):
+        """
+        Keys are expired once they were not touched for C{ttl} intervals.
+        """
+        idle_keys = IdleKeys(2)
+        idle_keys.touch("gorets")
+        idle_keys.touch("glork")
+        self.assertEqual((), tuple(idle_keys.expire()))
+        idle_keys.touch("gorets")
+        self.assertEqual((), tuple(idle_keys.expire()))
+        self.assertEqual(set(["glork"]), idle_keys.expire())
+        self.assertEqual(set(["gorets"]), idle_keys.expire())
+        self.assertEqual({}, idle_keys.last_update)
+        self.assertEqual(2, idle_keys.expired)
+
+    def test_touch_again(self):
+        """Touching a key again in the same interval changes nothing."""
+        idle_keys = IdleKeys(1)
+        idle_keys.touch("gorets")
+        idle_keys.touch("gorets")
+        idle_keys.expire()
+        idle_keys.touch("gorets")
+        self.assertEqual((), tuple(idle_keys.expire()))
+        self.assertEqual({1: set(["gorets"]), 2: set()}, idle_keys.updated)
+
+
+class ExpireIdleMetricsTest(TestCase):
+
+    def setUp(self):
+        self.processor = MessageProcessor(
+            time_function=lambda: 42,
+            idle_ttls={"counter": 1, "gauge": 2, "timer": 1})
+
+    def test_expire(self):
+        """
+        Metrics of the configured kinds are dropped once idle for their
+        time to live, the others are kept.
+        """
+        self.processor.process("gorets:1|c")
+        self.processor.process("gaugor:333|g")
+        self.processor.process("glork:320|ms")
+        self.processor.process("meter:1|m")
+        list(self.processor.flush())
+        self.assertEqual(["gorets"], self.processor.counter_metrics.keys())
+
+        list(self.processor.flush())
+        self.assertEqual({}, self.processor.counter_metrics)
+        self.assertEqual({}, self.processor.timer_metrics)
+        self.assertEqual(["gaugor"], self.processor.gauge_metrics.keys())
+        self.assertEqual(["meter"], self.processor.meter_metrics.keys())
+
+        self.processor.process("gaugor:1|g")
+        list(self.processor.flush())
+        self.assertEqual(["gaugor"], self.processor.gauge_metrics.keys())
+
+    def test_expire_merged(self):
+        """Metrics merged from other processors count as updates."""
+        other = MessageProcessor()
+        other.process("gorets:1|c")
+        list(self.processor.flush())
+        self.processor.merge_states([other.export_state()])
+        list(self.processor.flush())
+        self.assertEqual({"gorets": 0}, self.processor.counter_metrics)
+
+    def test_summary(self):
+        """
+        The summary reports how many keys of each kind are alive, and how
+        many were expired since the last flush.
+        """
+        self.processor.process("gorets:1|c")
+        self.processor.process("glork:1|c")
+        list(self.processor.flush())
+        self.processor.process("gorets:1|c")
+        messages = list(self.processor.flush())
+        self.assertIn(("statsd.keys.counter.live", 1, 42), messages)
+        self.assertIn(("statsd.keys.counter.expired", 1, 42), messages)
+        self.assertIn(("statsd.keys.timer.live", 0, 42), messages)
+
+    def test_not_configured(self):
+        """Without C{idle_ttls}, no key is tracked."""
+        processor = MessageProcessor()
+        processor.process("gorets:1|c")
+        self.assertEqual({}, processor.idle_keys)
+        self.assertEqual(processor.process_counter_metric,
+                         processor.message_handlers["c"])
+
+
+class KeyBudgetTest(TestCase):
+
+    def test_limit(self):
+        """
+        Once C{limit} keys were admitted, new keys are folded into the
+        overflow key of their first component.
+        """
+        budget = KeyBudget(2)
+        self.assertEqual("app.a", budget.admit("app.a"))
+        self.assertEqual("app.b", budget.admit("app.b"))
+        self.assertEqual("app.__overflow__", budget.admit("app.c"))
+        self.assertEqual("app.a", budget.admit("app.a"))
+        self.assertEqual(1, budget.rejected)
+
+    def test_rejected_once(self):
+        """
+        A rejected key is counted once per interval, however many messages
+        it gets.
+        """
+        budget = KeyBudget(1)
+        budget.admit("app.a")
+        for i in range(5):
+            self.assertEqual("app.__overflow__", budget.admit("app.b"))
+        budget.admit("app.c")
+        self.assertEqual(2, budget.rejected)
+        self.assertEqual({"app": 2}, budget.offenders)
+        self.assertEqual(2, budget.reset_interval())
+
+        budget.admit("app.b")
+        self.assertEqual(3, budget.rejected)
+        self.assertEqual(1, budget.reset_interval())
+
+    def test_prefix_limits(self):
+        """
+        Keys under a prefix with its own budget are limited by it, the
+        longest matching prefix winning.
+        """
+        budget = KeyBudget(prefix_limits={"app": 2, "app.requests": 1})
+        self.assertEqual("app.requests.a", budget.admit("app.requests.a"))
+        self.assertEqual("app.requests.__overflow__",
+                         budget.admit("app.requests.b"))
+        self.assertEqual("app.a", budget.admit("app.a"))
+        self.assertEqual("app.b", budget.admit("app.b"))
+        self.assertEqual("app.__overflow__", budget.admit("app.c"))
+        self.assertEqual("other", budget.admit("other"))
+        self.assertEqual([("app", 1), ("app.requests", 1)],
+                         sorted(budget.top_offenders()))
+        # Keys outside any budget are not remembered.
+        self.assertEqual(["app.a", "app.b", "app.requests.a"],
+                         sorted(budget.keys))
+
+    def test_release(self):
+        """Releasing a key makes room for a new one."""
+        budget = KeyBudget(prefix_limits={"app": 1})
+        budget.admit("app.a")
+        budget.release("app.a")
+        budget.release("app.__overflow__")
+        self.assertEqual("app.b", budget.admit("app.b"))
+        self.assertEqual({"app": 1}, budget.prefix_counts)
+
+    def test_max_offenders(self):
+        """
+        Past C{max_offenders} offending prefixes, keys all overflow into a
+        single key.
+        """
+        budget = KeyBudget(1)
+        budget.max_offenders = 1
+        budget.admit("a.a")
+        self.assertEqual("b.__overflow__", budget.admit("b.b"))
+        self.assertEqual("__overflow__", budget.admit("c.c"))
+        self.assertEqual({"b": 1}, budget.offenders)
+
+    def test_processor(self):
+        """
+        The processor folds keys beyond the budget of their kind, and
+        reports how many it rejected.
+        """
+        processor = MessageProcessor(
+            time_function=lambda: 42, key_limits={"counter": 1},
+            prefix_key_limits={"app": 1})
+        processor.process("gorets:1|c")
+        processor.process("glork:1|c")
+        processor.process("app.a:1|ms")
+        processor.process("app.b:2|ms")
+        processor.process("app.c:3|ms")
+        processor.process("app.c:4|ms")
+        self.assertEqual({"gorets": 1, "glork.__overflow__": 1},
+                         processor.counter_metrics)
+        self.assertEqual({"app.a": [1], "app.__overflow__": [2, 3, 4]},
+                         processor.timer_metrics)
+        self.assertEqual(dict(keys=1, limit=0, rejected=2,
+                              top_prefixes=[("app", 2)]),
+                         processor.get_key_budgets()["timer"])
+
+        messages = list(processor.flush())
+        self.assertIn(("statsd.keys.counter.rejected", 1, 42), messages)
+        self.assertIn(("statsd.keys.timer.rejected", 2, 42), messages)
+
+    def test_expire_releases(self):
+        """Expiring an idle key gives its budget back."""
+        processor = MessageProcessor(key_limits={"timer": 1},
+                                     idle_ttls={"timer": 1})
+        processor.process("glork:1|ms")
+        list(processor.flush())
+        list(processor.flush())
+        processor.process("gorets:1|ms")
+        self.assertEqual({"gorets": [1]}, processor.timer_metrics)
+
+    def test_delete_idle_counters_releases(self):
+        """Counters dropped on flush give their budget back."""
+        processor = MessageProcessor(key_limits={"counter": 1},
+                                     delete_idle_counters=1)
+        processor.process("glork:1|c")
+        list(processor.flush())
+        processor.process("gorets:1|c")
+        self.assertEqual({"gorets": 1}, processor.counter_metrics)
+
+    def test_snapshot_releases(self):
+        """Timers swapped out by a snapshot give their budget back."""
+        processor = MessageProcessor(key_limits={"timer": 1})
+        processor.process("glork:1|ms")
+        processor.snapshot()
+        processor.process("gorets:1|ms")
+        self.assertEqual({"gorets": [1]}, processor.timer_metrics)
+
+    def test_export_state_releases(self):
+        """Exporting the state gives the budget of its keys back."""
+        processor = MessageProcessor(key_limits={"counter": 1})
+        processor.process("glork:1|c")
+        processor.export_state()
+        processor.process("gorets:1|c")
+        self.assertEqual({"gorets": 1}, processor.counter_metrics)
+
+    def test_merge(self):
+        """Keys merged from other processors are admitted too."""
+        processor = MessageProcessor(key_limits={"counter": 1})
+        other = MessageProcessor()
+        other.process("gorets:1|c")
+        other.process("glork:2|c")
+        processor.merge_states([other.export_state()])
+        self.assertEqual(2, len(processor.counter_metrics))
+        self.assertEqual(3, sum(processor.counter_metrics.values()))
+        self.assertEqual(1, processor.key_budgets["counter"].rejected)
+
+
+class OutputNamesTest(TestCase):
+
+    def test_names(self):
+        """The names of a key are built once, and handed out again."""
+        names = OutputNames([("stats.", ".rate"), ("counts.", "")])
+        self.assertEqual(("stats.foo.rate", "counts.foo"), names["foo"])
+        self.assertIdentical(names["foo"], names["foo"])
+
+    def test_trim(self):
+        """
+        Names of keys no longer live are dropped, once they outnumber the
+        live ones.
+        """
+        names = OutputNames([("", "")])
+        for key in "abc":
+            names[key]
+        names.trim({"a": 1, "b": 2})
+        self.assertEqual(["a", "b", "c"], sorted(names.names))
+        names.trim({"a": 1})
+        self.assertEqual(["a"], sorted(names.names))
+
+    def test_overlay(self):
+        """
+        An overlay hands out the names built so far, and keeps the ones it
+        builds until they are merged back.
+        """
+        names = OutputNames([("", ".rate")])
+        foo = names["foo"]
+        overlay = names.overlay()
+        self.assertIdentical(foo, overlay["foo"])
+        overlay["bar"]
+        self.assertEqual(["foo"], sorted(names.names))
+        names.merge(overlay, {"foo": 0, "bar": 0})
+        self.assertEqual(["bar", "foo"], sorted(names.names))
+        self.assertIdentical(foo, names["foo"])
+
+    def test_merge_reset_overlay(self):
+        """
+        Merging an overlay which was reset switches to its formats.
+        """
+        names = OutputNames([("", ".rate")])
+        names["foo"]
+        overlay = names.overlay()
+        overlay.reset([("", ".count")])
+        overlay["foo"]
+        names.merge(overlay, {"foo": 0})
+        self.assertEqual([("", ".count")], names.formats)
+        self.assertEqual(("foo.count",), names["foo"])
+
+    def test_flush_reuses_names(self):
+        """
+        Every flush reports a key under the same name objects, and timers
+        switch to new names when the percentiles change.
+        """
+        processor = MessageProcessor(time_function=lambda: 42)
+        processor.process("glork:1|c")
+        processor.process("gaugor:1|g")
+        processor.process("timer:1|ms")
+        first = dict((name, name) for name, value, timestamp
+                     in processor.flush())
+        processor.process("timer:1|ms")
+        second = [name for name, value, timestamp in processor.flush()
+                  if not name.startswith("statsd.")]
+        self.assertEqual(8, len(second))
+        for name in second:
+            self.assertIdentical(first[name], name)
+
+        processor.process("timer:1|ms")
+        names = [name for name, value, timestamp
+                 in processor.flush(percent=[90, 99])
+                 if name.startswith("stats.timers.")]
+        self.assertEqual(["stats.timers.timer.count",
+                          "stats.timers.timer.lower",
+                          "stats.timers.timer.mean",
+                          "stats.timers.timer.mean_90",
+                          "stats.timers.timer.mean_99",
+                          "stats.timers.timer.upper",
+                          "stats.timers.timer.upper_90",
+                          "stats.timers.timer.upper_99"], names)
+
+
 class ProcessorStatsTest(TestCase):
 
     def setUp(self):
@@ -181,6 +756,26 @@ class ProcessorStatsTest(TestCase):
         self.assertEqual(5, self.processor.process_timings["c"])
         self.assertEquals(1, self.processor.by_type["c"])
 
+    def test_process_samples_processing_time(self):
+        """
+        With a timing sample rate of N, only every Nth message is timed and
+        its duration stands for N messages, while counts stay exact.
+        """
+        processor = MessageProcessor(time_function=self.timer,
+                                     timing_sample_rate=3)
+        self.timer.set([0, 2, 10, 11, 20, 20])
+        for i in range(7):
+            processor.process("gorets:1|c")
+        processor.process("glork:1|ms")
+        self.assertEqual({"c": 9}, processor.process_timings)
+        self.assertEqual({"c": 7, "ms": 1}, processor.by_type)
+
+        messages = []
+        map(messages.extend, processor.flush_metrics_summary(1, {}, 42))
+        self.assertIn(("statsd.receive.ms.count", 1, 42), messages)
+        self.assertIn(("statsd.receive.ms.duration", 0, 42), messages)
+        self.assertIn(("statsd.receive.c.duration", 9000, 42), messages)
+
     def test_flush_tracks_flushing_time(self):
         """
         When flushing metrics, we track the time each metric type took to be
@@ -228,6 +823,69 @@ class ProcessorStatsTest(TestCase):
         self.assertEquals({}, self.processor.process_timings)
         self.assertEquals({}, self.processor.by_type)
 
+    def test_flush_metrics_summary_send(self):
+        """
+        The summary reports how long the previous flush took to hand its
+        datapoints over to carbon, and for how long it blocked the reactor.
+        """
+        self.processor.count_flush_send(0.5, 0.25, 3)
+        messages = []
+        map(messages.extend, self.processor.flush_metrics_summary(1, {}, 42))
+        self.assertEqual([("statsd.flush.send.duration", 500, 42),
+                          ("statsd.flush.send.blocked", 250, 42),
+                          ("statsd.flush.send.chunks", 3, 42)], messages[1:])
+        self.assertEqual(None, self.processor.flush_send)
+
+    def test_flush_metrics_summary_redirects(self):
+        """
+        The summary reports the datagrams redirected to each destination,
+        their bytes and how many messages each packed on average.
+        """
+        self.processor.count_redirect_packet("relay_8125", 1000, 10)
+        self.processor.count_redirect_packet("relay_8125", 400, 5)
+        messages = []
+        map(messages.extend, self.processor.flush_metrics_summary(1, {}, 42))
+        self.assertEqual(
+            [("statsd.redirect.relay_8125.packets", 2, 42),
+             ("statsd.redirect.relay_8125.bytes", 1400, 42),
+             ("statsd.redirect.relay_8125.metrics_per_packet", 7.5, 42)],
+            messages[1:])
+        self.assertEqual({}, self.processor.redirect_packets)
+
+    def test_flush_metrics_summary_redirect_buffers(self):
+        """
+        The summary reports the lines dropped for each tcp redirect, the
+        most bytes it buffered and its longest drain.
+        """
+        self.processor.count_redirect_buffer("relay_8125", 100, 0, None)
+        self.processor.count_redirect_buffer("relay_8125", 200, 2, None)
+        self.processor.count_redirect_buffer("relay_8125", 0, 0, 1.5)
+        messages = []
+        map(messages.extend, self.processor.flush_metrics_summary(1, {}, 42))
+        self.assertEqual(
+            [("statsd.redirect.relay_8125.dropped", 2, 42),
+             ("statsd.redirect.relay_8125.buffered_bytes", 200, 42),
+             ("statsd.redirect.relay_8125.drain_latency", 1500, 42)],
+            messages[1:])
+        self.assertEqual({}, self.processor.redirect_buffers)
+
+    def test_flush_metrics_summary_datagrams(self):
+        """
+        When datagrams were received, the summary reports how many and how
+        many messages they carried.
+        """
+        self.processor.datagrams = 2
+        self.processor.datagram_lines = 7
+        messages = []
+        map(messages.extend, self.processor.flush_metrics_summary(
+            0, {}, 42))
+        self.assertEqual([('statsd.numStats', 0, 42),
+                          ('statsd.receive.datagrams', 2, 42),
+                          ('statsd.receive.datagram_lines', 7, 42)],
+                         messages)
+        self.assertEqual(0, self.processor.datagrams)
+        self.assertEqual(0, self.processor.datagram_lines)
+
 
 class FlushMessagesTest(TestCase):
 
@@ -353,6 +1011,44 @@ class FlushMessagesTest(TestCase):
         self.assertEqual(("statsd.numStats", 1, 42), messages[5])
         self.assertEqual([], self.processor.timer_metrics["glork"])
 
+    def test_flush_single_timer_multiple_percentiles(self):
+        """
+        Several percentiles can be flushed at once, each reported as
+        C{mean_N} and C{upper_N}. The mean within the 90th percentile is
+        also reported as C{mean}, wherever it is listed.
+        """
+        self.processor.timer_metrics["glork"] = range(1, 1001)
+        messages = list(self.processor.flush(percent=[50, 90, 99.9]))
+        self.assertEqual([
+            ("stats.timers.glork.count", 1000, 42),
+            ("stats.timers.glork.lower", 1, 42),
+            ("stats.timers.glork.mean", 450, 42),
+            ("stats.timers.glork.mean_50", 250, 42),
+            ("stats.timers.glork.mean_90", 450, 42),
+            ("stats.timers.glork.mean_999", 500, 42),
+            ("stats.timers.glork.upper", 1000, 42),
+            ("stats.timers.glork.upper_50", 500, 42),
+            ("stats.timers.glork.upper_90", 900, 42),
+            ("stats.timers.glork.upper_999", 999, 42)], messages[:10])
+        self.assertEqual([], self.processor.timer_metrics["glork"])
+
+    def test_flush_single_timer_percentiles_without_90(self):
+        """
+        C{mean} is the mean within the 90th percentile even when several
+        percentiles are flushed and 90 is not one of them.
+        """
+        self.processor.timer_metrics["glork"] = range(1, 1001)
+        messages = list(self.processor.flush(percent=[50, 99]))
+        self.assertEqual([
+            ("stats.timers.glork.count", 1000, 42),
+            ("stats.timers.glork.lower", 1, 42),
+            ("stats.timers.glork.mean", 450, 42),
+            ("stats.timers.glork.mean_50", 250, 42),
+            ("stats.timers.glork.mean_99", 495, 42),
+            ("stats.timers.glork.upper", 1000, 42),
+            ("stats.timers.glork.upper_50", 500, 42),
+            ("stats.timers.glork.upper_99", 990, 42)], messages[:8])
+
     def test_flush_single_timer_50th_percentile(self):
         """
         It is possible to flush the timers with a different percentile, in this
@@ -453,6 +1149,86 @@ class FlushMessagesTest(TestCase):
             (41, 42), self.processor.plugin_metrics["somemetric"].data)
 
 
+class FlushTimerSketchTest(TestCase):
+
+    def setUp(self):
+        self.processor = MessageProcessor(time_function=lambda: 42,
+                                          timer_accuracy=0.01)
+
+    def assertWithin(self, expected, actual, accuracy=0.01):
+        self.assertTrue(abs(actual - expected) <= accuracy * abs(expected),
+                        "%r not within %r of %r" % (actual, accuracy, expected))
+
+    def test_receive_timer(self):
+        """Timer durations are summarised in a sketch."""
+        self.processor.process("glork:320|ms")
+        self.processor.process("glork:100|ms")
+        sketch = self.processor.timer_metrics["glork"]
+        self.assertEqual(2, sketch.count)
+        self.assertEqual(100, sketch.min)
+        self.assertEqual(320, sketch.max)
+
+    def test_flush_single_timer_single_time(self):
+        """
+        A single data point is reported exactly, and the sketch is cleared
+        after flush is called.
+        """
+        self.processor.process("glork:24|ms")
+        messages = list(self.processor.flush())
+        self.assertEqual(("stats.timers.glork.count", 1, 42), messages[0])
+        self.assertEqual(("stats.timers.glork.lower", 24, 42), messages[1])
+        self.assertEqual(("stats.timers.glork.mean", 24, 42), messages[2])
+        self.assertEqual(("stats.timers.glork.upper", 24, 42), messages[3])
+        self.assertEqual(("stats.timers.glork.upper_90", 24, 42), messages[4])
+        self.assertEqual(0, self.processor.timer_metrics["glork"].count)
+
+    def test_flush_single_timer_multiple_times(self):
+        """
+        The percentile and the mean within it are reported within the
+        accuracy of the sketch; count, lower and upper are exact.
+        """
+        for value in [4, 8, 15, 16, 23, 42]:
+            self.processor.process("glork:%d|ms" % value)
+        messages = list(self.processor.flush())
+        self.assertEqual(("stats.timers.glork.count", 6, 42), messages[0])
+        self.assertEqual(("stats.timers.glork.lower", 4, 42), messages[1])
+        self.assertWithin(13.2, messages[2][1])
+        self.assertEqual(("stats.timers.glork.upper", 42, 42), messages[3])
+        self.assertWithin(23, messages[4][1])
+        self.assertEqual(("statsd.numStats", 1, 42), messages[5])
+
+    def test_flush_multiple_percentiles(self):
+        """Every percentile is computed from a single walk of the sketch."""
+        for i in range(1, 1001):
+            self.processor.process("glork:%d|ms" % i)
+        messages = dict((name, value) for name, value, _ in
+                        list(self.processor.flush_timer_metrics(
+                            [90, 50, 99.9], 42))[0])
+        self.assertWithin(450, messages["stats.timers.glork.mean"])
+        self.assertWithin(450, messages["stats.timers.glork.mean_90"])
+        self.assertWithin(250, messages["stats.timers.glork.mean_50"])
+        self.assertWithin(500, messages["stats.timers.glork.mean_999"])
+        self.assertWithin(500, messages["stats.timers.glork.upper_50"])
+        self.assertWithin(900, messages["stats.timers.glork.upper_90"])
+        self.assertWithin(999, messages["stats.timers.glork.upper_999"])
+
+    def test_flush_matches_list_backend(self):
+        """
+        The sketch reports the same names as the list backend, with values
+        within its relative accuracy.
+        """
+        exact = MessageProcessor(time_function=lambda: 42)
+        for i in range(1, 1001):
+            exact.process("glork:%d|ms" % i)
+            self.processor.process("glork:%d|ms" % i)
+        expected = list(exact.flush_timer_metrics(99, 42))[0]
+        actual = list(self.processor.flush_timer_metrics(99, 42))[0]
+        for (name, value, _), (sketch_name, sketch_value, _) in zip(
+            expected, actual):
+            self.assertEqual(name, sketch_name)
+            self.assertWithin(value, sketch_value)
+
+
 class FlushMeterMetricMessagesTest(TestCase):
 
     def setUp(self):
@@ -25,10 +25,15 @@ from twisted.internet.protocol import DatagramProtocol, Factory
 from twisted.protocols.basic import LineReceiver
 from twisted.application.service import MultiService
 from twisted.internet import reactor, defer
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase as TxTestCase
 
 from txstatsd.server.processor import MessageProcessor
-from txstatsd.server.router import Router
+from txstatsd.server.router import (
+    CoalescingSender, Router, TCPRedirectClientFactory, forwarding)
+from txstatsd.server.spool import LineSpool
+from txstatsd.hashing import ConsistentHashRing
 
 
 class TestMessageProcessor(object):
@@ -65,6 +70,37 @@ class RouteMessagesTest(TestCase):
         self.router.process("gorets:1|c")
         self.assertEqual(len(self.processor.messages), 1)
 
+    def test_receive_datagram(self):
+        """
+        Every message in a datagram gets routed, and the datagram is
+        accounted for by the processor.
+        """
+        processor = MessageProcessor()
+        router = Router(processor, "")
+        router.process_datagram("gorets:1|c\nglork:2|c")
+        self.assertEqual(len(processor.counter_metrics), 2)
+        self.assertEqual(processor.datagrams, 1)
+        self.assertEqual(processor.datagram_lines, 2)
+
+    def test_processor_without_counts(self):
+        """
+        A processor need not keep counts; the router then drops them.
+        """
+        self.router.process_datagram("gorets:1|c\nglork:2|c")
+        self.router.count_redirect_packet("relay_8125", 100, 2)
+        self.assertEqual(len(self.processor.messages), 2)
+
+    def test_shares_key_cache(self):
+        """
+        The router normalizes keys through the key cache of its processor.
+        """
+        processor = MessageProcessor()
+        router = Router(processor, "")
+        router.process("a b:1|c")
+        router.process("a b:1|c")
+        self.assertEqual(processor.counter_metrics, {"a_b": 2})
+        self.assertEqual(processor.key_cache.reset_stats(), (1, 1, 0))
+
     def test_any_and_drop(self):
         """
         Any message gets dropped with the drop rule.
@@ -171,6 +207,300 @@ class RouteMessagesTest(TestCase):
         self.assertEqual(self.processor.messages[0][2], "gorets")
 
 
+class RuleEngineTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+
+    def test_decisions_cached(self):
+        """
+        What the rules decide for a metric type and key is cached, and
+        each rule counts the metrics it matched.
+        """
+        router = Router(self.processor,
+                        "path_like glork* => drop\n"
+                        "metric_type g => drop")
+        for message in ("gorets:1|c", "gorets:2|c", "glork:1|c",
+                        "gorets:1|g"):
+            router.process(message)
+        self.assertEqual(2, len(self.processor.messages))
+        stats = router.get_rule_stats()
+        self.assertEqual([("path_like glork* => drop", 1),
+                          ("metric_type g => drop", 1)],
+                         [(rule["rule"], rule["hits"])
+                          for rule in stats["rules"]])
+        self.assertEqual(dict(size=3, hits=1, misses=3, evictions=0),
+                         stats["cache"])
+
+    def test_rewritten_keys_decided(self):
+        """
+        Keys changed by a rule are decided for themselves by the later
+        rules.
+        """
+        router = Router(self.processor,
+                        "any => rewrite gorets glork dup\n"
+                        "path_like glork => drop")
+        router.process("gorets:1|c")
+        router.process("gorets:1|c")
+        self.assertEqual([("c", "gorets"), ("c", "gorets")],
+                         [message[1:3] for message in self.processor.messages])
+        self.assertEqual([2, 2], [rule["hits"] for rule
+                                  in router.get_rule_stats()["rules"]])
+
+    def test_impure_condition(self):
+        """
+        Conditions not marked as pure are evaluated for every message.
+        """
+        calls = []
+
+        class FieldsRouter(Router):
+
+            def build_condition_sampled(self):
+                def sampled_condition(metric_type, key, fields):
+                    calls.append(fields)
+                    return len(fields) == 3
+                return sampled_condition
+
+        router = FieldsRouter(self.processor, "sampled => drop")
+        router.process("gorets:1|c|@0.1")
+        router.process("gorets:1|c")
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, len(self.processor.messages))
+
+    def test_replaced_rules(self):
+        """Rules replaced after processing started are decided afresh."""
+        router = Router(self.processor, "path_like glork => drop")
+        router.process("gorets:1|c")
+        router.rules = router.build_rules("path_like gorets => drop")
+        router.process("gorets:1|c")
+        self.assertEqual(1, len(self.processor.messages))
+
+    def test_unmodified_message_reused(self):
+        """
+        A message no rule modified is handed on as received, instead of
+        being rebuilt from its fields.
+        """
+        router = Router(self.processor,
+                        "any => set_metric_type g\n"
+                        "any => rewrite gorets glork dup")
+        message = "gorets:1|c|@0.1"
+        router.process(message)
+        self.assertTrue(message is self.processor.messages[0][0])
+        self.assertEqual("glork:1|c|@0.1", self.processor.messages[1][0])
+
+    def test_modified_message_rebuilt(self):
+        """
+        Messages whose key was normalized, or which had whitespace around
+        them, are rebuilt.
+        """
+        router = Router(self.processor, "")
+        router.process("a b:1|c")
+        router.process("gorets:1|c \r")
+        self.assertEqual(["a_b:1|c", "gorets:1|c"],
+                         [message[0] for message in self.processor.messages])
+
+    def test_forwarding_target(self):
+        """
+        Targets marked as forwarding get the message as received, or
+        C{None} once it was modified.
+        """
+        forwarded = []
+
+        class ForwardingRouter(Router):
+
+            def build_target_record(self):
+                def record(metric_type, key, fields, message=None):
+                    forwarded.append(message)
+                    yield metric_type, key, fields
+                return forwarding(record)
+
+        router = ForwardingRouter(self.processor,
+                                  "any => record\n"
+                                  "any => rewrite gorets glork\n"
+                                  "any => record")
+        message = "gorets:1|c"
+        router.process(message)
+        self.assertTrue(message is forwarded[0])
+        self.assertEqual([message, None], forwarded)
+        self.assertEqual("glork:1|c", self.processor.messages[0][0])
+
+    def test_no_cache(self):
+        router = Router(self.processor, "any => rewrite gorets glork",
+                        cache_size=0)
+        router.process("gorets:1|c")
+        self.assertEqual("glork", self.processor.messages[0][2])
+        self.assertFalse("cache" in router.get_rule_stats())
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.datagrams = []
+
+    def write(self, data):
+        self.datagrams.append(data)
+
+
+class CoalescingSenderTest(TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.clock = Clock()
+        self.packets = []
+        self.sender = CoalescingSender(
+            self.client, max_size=20, delay=0.01, clock=self.clock,
+            count_packet=lambda *args: self.packets.append(args))
+
+    def test_delay(self):
+        """Messages are packed into a datagram sent after C{delay}."""
+        self.sender.write("a:1|c")
+        self.sender.write("b:2|c")
+        self.assertEqual([], self.client.datagrams)
+        self.clock.advance(0.01)
+        self.assertEqual(["a:1|c\nb:2|c"], self.client.datagrams)
+        self.assertEqual([(11, 2)], self.packets)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_size(self):
+        """
+        A datagram is sent once the next message would not fit in it, or
+        once it is full.
+        """
+        for message in ("aaaa:1|c", "bbbb:1|c", "cccc:1|c"):
+            self.sender.write(message)
+        self.assertEqual(["aaaa:1|c\nbbbb:1|c"], self.client.datagrams)
+        self.sender.write("dddddd:1|c")
+        self.sender.write("eeeeeeeeeeeeeeeeeeeeee:1|c")
+        self.assertEqual(["aaaa:1|c\nbbbb:1|c", "cccc:1|c\ndddddd:1|c",
+                          "eeeeeeeeeeeeeeeeeeeeee:1|c"],
+                         self.client.datagrams)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_stop(self):
+        """Buffered messages are sent when the sender stops."""
+        self.sender.startService()
+        self.sender.write("a:1|c")
+        self.sender.stopService()
+        self.assertEqual(["a:1|c"], self.client.datagrams)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class RedirectHashTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+        self.senders = {}
+
+        class FakeSenderRouter(Router):
+
+            def build_udp_sender(cself, host, port, payload_size=1432):
+                sender = self.senders[(host, port)] = FakeClient()
+                return sender
+        self.router_class = FakeSenderRouter
+
+    def test_shards_keys(self):
+        """
+        Each key is always sent to the destination the hash ring picks
+        for it, and then processed.
+        """
+        destinations = ["10.0.0.1:8125", "10.0.0.2:8125", "10.0.0.3:8126"]
+        router = self.router_class(
+            self.processor, "any => redirect_hash " + " ".join(destinations),
+            service=MultiService())
+        ring = ConsistentHashRing(destinations)
+        keys = ["gorets.%d" % i for i in range(30)]
+        for key in keys + keys:
+            router.process(key + ":1|c")
+
+        self.assertEqual(60, len(self.processor.messages))
+        for destination in destinations:
+            host, port = destination.split(":")
+            sent = [message.split(":")[0] for message
+                    in self.senders[(host, int(port))].datagrams]
+            expected = [key for key in keys
+                        if ring.get_node(key) == destination]
+            self.assertTrue(expected)
+            self.assertEqual(expected * 2, sent)
+
+    def test_no_destinations(self):
+        self.assertRaises(ValueError, self.router_class, self.processor,
+                          "any => redirect_hash", service=MultiService())
+
+
+class TCPRedirectBufferTest(TxTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.counts = []
+
+    def build_factory(self, **kwargs):
+        factory = TCPRedirectClientFactory(
+            clock=self.clock,
+            count_buffer=lambda *args: self.counts.append(args), **kwargs)
+        self.addCleanup(factory.close)
+        return factory
+
+    def connect(self, factory):
+        transport = StringTransport()
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def test_batched(self):
+        """
+        Lines written in the same reactor iteration are written together.
+        """
+        factory = self.build_factory()
+        protocol, transport = self.connect(factory)
+        factory.write("a:1|c")
+        factory.write("b:1|c\r")
+        self.assertEqual("", transport.value())
+        self.clock.advance(0)
+        self.assertEqual("a:1|c\r\nb:1|c\r\n", transport.value())
+        self.assertEqual([], self.counts)
+
+    def test_paused(self):
+        """
+        Lines are buffered while the transport is paused, the oldest ones
+        dropped past the budget, and written once it resumes.
+        """
+        factory = self.build_factory(max_bytes=16)
+        protocol, transport = self.connect(factory)
+        protocol.pauseProducing()
+        for line in ("a:1|c", "b:1|c", "c:1|c"):
+            factory.write(line)
+        self.assertEqual([(7, 0, None), (14, 0, None), (14, 1, None)],
+                         self.counts)
+        self.clock.advance(2)
+        protocol.resumeProducing()
+        self.assertEqual("b:1|c\r\nc:1|c\r\n", transport.value())
+        self.assertEqual((0, 0, 2), self.counts[-1])
+
+    def test_not_connected(self):
+        """Lines written before connecting are written once connected."""
+        factory = self.build_factory()
+        factory.write("a:1|c")
+        protocol, transport = self.connect(factory)
+        self.assertEqual("a:1|c\r\n", transport.value())
+
+    def test_spool(self):
+        """
+        Past the budget, the oldest lines are spilled to the spool, and
+        written back in order.
+        """
+        spool = LineSpool(self.mktemp())
+        factory = self.build_factory(max_bytes=16, spool=spool)
+        lines = ["%s:1|c" % key for key in "abcdef"]
+        for line in lines:
+            factory.write(line)
+        self.assertNotEqual(0, spool.bytes)
+        self.assertEqual(0, sum(dropped for _, dropped, _ in self.counts))
+        protocol, transport = self.connect(factory)
+        self.assertEqual("".join(line + "\r\n" for line in lines),
+                         transport.value())
+        self.assertEqual(0, factory.backlog())
+
+
 class TestUDPRedirect(TxTestCase):
 
     def setUp(self):
@@ -29,13 +29,15 @@ except ImportError:
 
 from twisted.trial.unittest import TestCase
 
-from carbon.client import CarbonClientManager
-
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
 from twisted.internet.protocol import DatagramProtocol
 from twisted.application.internet import UDPServer
+from twisted.python import usage
 
 from txstatsd import service
+from txstatsd.server.carbonclient import CarbonClientManager
+from txstatsd.server.configurableprocessor import (
+    ConfigurableMessageProcessor)
 from txstatsd.server.processor import MessageProcessor
 from txstatsd.server.protocol import StatsDServerProtocol
 from txstatsd.report import ReportingService
@@ -179,27 +181,140 @@ class StatsDOptionsTestCase(TestCase):
                           ["a", "b", "c"])
 
 
-class ClientManagerStatsTestCase(TestCase):
+    def test_percentiles(self):
+        """
+        Timer percentiles are read as a comma-separated list, from the
+        command line or the config file.
+        """
+        o = service.StatsDOptions()
+        o.parseOptions([])
+        self.assertEquals((90,), o["percentiles"])
+
+        o = service.StatsDOptions()
+        o.parseOptions(["--percentiles", "50,90,99,99.9"])
+        self.assertEquals((50, 90, 99, 99.9), o["percentiles"])
+
+        o = service.StatsDOptions()
+        config_file = ConfigParser.RawConfigParser()
+        config_file.readfp(StringIO("[statsd]\npercentiles = 95,99"))
+        o.configure(config_file)
+        self.assertEquals((95, 99), o["percentiles"])
+
+    def test_invalid_percentiles(self):
+        """An out of range percentile is rejected."""
+        o = service.StatsDOptions()
+        self.assertRaises(usage.UsageError, o.parseOptions,
+                          ["--percentiles", "90,101"])
+
+    def test_expire_idle(self):
+        """
+        The C{expire-idle} option maps metric kinds to the number of flush
+        intervals they may stay idle.
+        """
+        o = service.StatsDOptions()
+        o.parseOptions([])
+        self.assertEquals(None, o["expire-idle"])
+
+        o = service.StatsDOptions()
+        o.parseOptions(["--expire-idle", "timer=10, gauge=60"])
+        self.assertEquals({"timer": 10, "gauge": 60}, o["expire-idle"])
+
+        for value in ["timer", "timer=0", "sprocket=10"]:
+            o = service.StatsDOptions()
+            self.assertRaises(usage.UsageError, o.parseOptions,
+                              ["--expire-idle", value])
+
+    def test_max_keys(self):
+        """Key budgets are given per kind and per prefix."""
+        o = service.StatsDOptions()
+        o.parseOptions(["--max-keys", "counter=1000",
+                        "--max-keys-per-prefix", "app.requests.=10,hosts=5"])
+        self.assertEquals({"counter": 1000}, o["max-keys"])
+        self.assertEquals({"app.requests": 10, "hosts": 5},
+                          o["max-keys-per-prefix"])
+
+        o = service.StatsDOptions()
+        self.assertRaises(usage.UsageError, o.parseOptions,
+                          ["--max-keys-per-prefix", "app"])
+
+
+class FlushProcessorTestCase(TestCase):
+
+    def setUp(self):
+        self.datapoints = []
+        self.processor = MessageProcessor(time_function=lambda: 42)
+
+        class CarbonClient(object):
+            def sendDatapoint(client, metric, datapoint):
+                self.datapoints.append((metric, datapoint))
+        self.carbon_client = CarbonClient()
 
-    def test_report_client_manager_stats(self):
+        class Cooperator(object):
+            def coiterate(cooperator, iterator):
+                list(iterator)
+
+        self.service = service.StatsDService(
+            self.carbon_client, self.processor, 10000, flush_in_thread=True)
+        self.service.coop = Cooperator()
+
+    def test_flush_in_thread(self):
         """
-        Calling C{report_client_manager_stats} pokes into carbon's
-        instrumentation stats global dict and pulls out only metrics that start
-        with C{destinations}.
+        With C{flush_in_thread}, counters and timers are swapped out and
+        reduced in a thread, while the processor keeps taking messages.
         """
-        from carbon.instrumentation import stats
+        reduced = []
+
+        def deferToThread(function, *args, **kwargs):
+            reduced.append((args, kwargs))
+            self.processor.process("gorets:2|c")
+            return succeed(function(*args, **kwargs))
 
-        stats["foo"] = 0
-        stats["bar"] = 1
-        stats["destinations.bahamas"] = 2
-        stats["destinations.hawaii"] = 3
-        self.assertEquals({"destinations.bahamas": 2,
-                           "destinations.hawaii": 3},
-                          service.report_client_manager_stats())
-        self.assertEquals({"foo": 0,
-                           "bar": 0,
-                           "destinations.bahamas": 0,
-                           "destinations.hawaii": 0}, stats)
+        self.service.deferToThread = deferToThread
+        self.processor.process("gorets:1|c")
+        self.processor.process("glork:320|ms")
+        self.service.flushProcessor()
+
+        self.assertEqual(1, len(reduced))
+        self.assertIn(("stats.gorets", (42, 0.1)), self.datapoints)
+        self.assertIn(("stats.timers.glork.count", (42, 1)), self.datapoints)
+        self.assertEqual({"gorets": 2}, self.processor.counter_metrics)
+        self.assertEqual({}, self.processor.timer_metrics)
+
+    def test_flush_in_thread_unsupported(self):
+        """
+        A processor which cannot take a snapshot is flushed as usual, even
+        with C{flush_in_thread}.
+        """
+        processor = ConfigurableMessageProcessor(time_function=lambda: 42)
+        statsd_service = service.StatsDService(
+            self.carbon_client, processor, 10000, flush_in_thread=True)
+        statsd_service.coop = self.service.coop
+        self.assertFalse(statsd_service.flush_in_thread)
+        processor.process("gorets:1|c")
+        statsd_service.flushProcessor()
+        self.assertIn(("gorets.count", (42, 1)), self.datapoints)
+
+    def test_flush_chunks(self):
+        """
+        Datapoints are handed to the carbon client in chunks of at most
+        C{max_datapoints}, and the time spent sending them is accounted to
+        the processor.
+        """
+        chunks = []
+        self.carbon_client.sendDatapoints = chunks.append
+        self.service.flush_in_thread = False
+        self.service.max_datapoints = 4
+        for i in range(5):
+            self.processor.process("gorets.%d:1|c" % i)
+        self.service.flushProcessor()
+
+        self.assertEqual([4] * (len(chunks) - 1),
+                         [len(chunk) for chunk in chunks[:-1]])
+        self.assertIn(("stats.gorets.4", (42, 0.1)), sum(chunks, []))
+        self.assertEqual([], self.datapoints)
+        duration, blocked, count = self.processor.flush_send
+        self.assertEqual(len(chunks), count)
+        self.assertTrue(0 <= blocked <= duration)
 
 
 class Agent(DatagramProtocol):
@@ -253,16 +368,36 @@ class ServiceTestsBuilder(TestCase):
 
     def test_carbon_client_options(self):
         """
-        Options for carbon-client get set into carbon's settings object.
+        Options for the carbon client are handed to its destinations.
         """
-        from carbon.conf import settings
-
         o = service.StatsDOptions()
         o["max-queue-size"] = 10001
         o["max-datapoints-per-message"] = 10002
-        service.createService(o)
-        self.assertEqual(settings.MAX_QUEUE_SIZE, 10001)
-        self.assertEqual(settings.MAX_DATAPOINTS_PER_MESSAGE, 10002)
+        o["carbon-protocol"] = "line"
+        s = service.createService(o)
+        manager = s.services[1]
+        factory = manager.client_factories[("127.0.0.1", 2003, None)]
+        self.assertEqual(10001, factory.max_queue_size)
+        self.assertEqual(10002, factory.batch_size)
+        self.assertEqual("line", manager.protocol)
+
+    def test_spool_options(self):
+        """
+        With a spool directory, each destination spools to its own
+        directory below it.
+        """
+        o = service.StatsDOptions()
+        o.parseOptions(["--spool-dir", self.mktemp(),
+                        "--spool-fsync", "never",
+                        "--spool-drain-rate", "500"])
+        s = service.createService(o)
+        factory = s.services[1].client_factories[("127.0.0.1", 2004, None)]
+        self.assertEqual(500, factory.drain_rate)
+        self.assertEqual("never", factory.spool.fsync)
+        self.assertTrue(factory.spool.directory.startswith(o["spool-dir"]))
+        factory.spool.close()
+        self.assertRaises(usage.UsageError, o.parseOptions,
+                          ["--spool-fsync", "often"])
 
     def test_monitor_response(self):
         """
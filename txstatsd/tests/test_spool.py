@@ -0,0 +1,118 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.server.spool import LineSpool, RECORD, Spool
+
+
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.spool = Spool(self.directory, segment_size=100)
+        self.addCleanup(self.spool.close)
+        self.datapoints = [("metric.%d" % i, (42 + i, i * 0.5))
+                           for i in range(10)]
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_append_read(self):
+        """Datapoints are read back oldest first."""
+        self.spool.append(self.datapoints[:4])
+        self.spool.append(self.datapoints[4:])
+        self.assertEqual(self.datapoints[:3], self.spool.read(3))
+        self.assertEqual(self.datapoints[3:], self.spool.read(100))
+        self.assertEqual([], self.spool.read(100))
+        self.assertEqual(0, self.spool.bytes)
+
+    def test_rotate(self):
+        """
+        Full segments are rotated, and deleted once they were read.
+        """
+        for datapoint in self.datapoints:
+            self.spool.append([datapoint])
+        self.assertEqual(2, len(self.segments()))
+        size = sum(RECORD.size + len(metric)
+                   for metric, datapoint in self.datapoints)
+        self.assertEqual(size, self.spool.bytes)
+        self.assertEqual(self.datapoints[:8], self.spool.read(8))
+        self.assertEqual(1, len(self.segments()))
+        self.assertEqual(self.datapoints[8:], self.spool.read(8))
+        self.assertEqual(1, len(self.segments()))
+
+    def test_reopen(self):
+        """
+        Datapoints spooled before a restart are read back, and new ones go
+        to a new segment.
+        """
+        self.spool.append(self.datapoints[:5])
+        self.spool.close()
+        spool = Spool(self.directory, segment_size=100)
+        self.addCleanup(spool.close)
+        self.assertEqual(self.spool.bytes, spool.bytes)
+        spool.append(self.datapoints[5:])
+        self.assertEqual(2, len(self.segments()))
+        self.assertEqual(self.datapoints, spool.read(100))
+        self.assertEqual(1, len(self.segments()))
+
+    def test_truncated(self):
+        """A record cut short by a crash is skipped."""
+        self.spool.append(self.datapoints[:2])
+        self.spool.close()
+        path = os.path.join(self.directory, self.segments()[0])
+        with open(path, "ab") as segment:
+            segment.write(RECORD.pack(1, 2, 20) + "short")
+        spool = Spool(self.directory)
+        self.addCleanup(spool.close)
+        self.assertEqual(self.datapoints[:2], spool.read(100))
+        self.assertEqual([], self.segments())
+        self.assertEqual(0, spool.bytes)
+
+    def test_oldest_timestamp(self):
+        self.assertEqual(None, self.spool.oldest_timestamp())
+        self.spool.append(self.datapoints)
+        self.assertEqual(42, self.spool.oldest_timestamp())
+        self.spool.read(5)
+        self.assertEqual(47, self.spool.oldest_timestamp())
+        self.assertEqual(self.datapoints[5:], self.spool.read(100))
+
+    def test_fsync_policy(self):
+        self.assertRaises(ValueError, Spool, self.directory, fsync="often")
+        spool = Spool(self.mktemp(), fsync="always")
+        self.addCleanup(spool.close)
+        spool.append(self.datapoints)
+        self.assertEqual(self.datapoints, spool.read(100))
+
+
+class LineSpoolTest(TestCase):
+
+    def test_append_read(self):
+        spool = LineSpool(self.mktemp(), segment_size=10)
+        self.addCleanup(spool.close)
+        lines = ["gorets:1|c\r\n", "glork:320|ms\r\n", ""]
+        spool.append(lines[:2])
+        spool.append(lines[2:])
+        self.assertEqual(lines, spool.read(10))
+        self.assertEqual(0, spool.bytes)
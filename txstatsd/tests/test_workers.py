@@ -0,0 +1,224 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import cPickle as pickle
+import time
+
+from twisted.internet import defer
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import Clock
+from twisted.plugin import getPlugins
+from twisted.trial.unittest import TestCase
+
+from txstatsd.itxstatsd import IMetricFactory
+from txstatsd.metrics.distinctmetric import DistinctMetricReporter
+from txstatsd.server.configurableprocessor import ConfigurableMessageProcessor
+from txstatsd.server.processor import MessageProcessor
+from txstatsd.server.workers import ReusePort, WorkerPool
+
+
+class MergeStatesTest(TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.workers = [self.build_worker(), self.build_worker()]
+        self.processor = MessageProcessor(time_function=lambda: 42)
+
+    def build_worker(self):
+        worker = MessageProcessor(time_function=lambda: self.now[0],
+                                  plugins=getPlugins(IMetricFactory))
+        worker.gauge_updates = {}
+        return worker
+
+    def merge(self):
+        states = [pickle.loads(pickle.dumps(worker.export_state(), 2))
+                  for worker in self.workers]
+        self.processor.merge_states(states)
+
+    def test_counters(self):
+        """Counters are summed across workers."""
+        self.workers[0].process("gorets:1|c")
+        self.workers[1].process("gorets:2|c|@0.5")
+        self.workers[1].process("glork:1|c")
+        self.merge()
+        self.assertEqual({"gorets": 5, "glork": 1},
+                         self.processor.counter_metrics)
+        self.assertEqual({}, self.workers[0].counter_metrics)
+
+    def test_timers(self):
+        """Timer samples of every worker are kept."""
+        self.workers[0].process("glork:1|ms")
+        self.workers[1].process("glork:2|ms")
+        self.merge()
+        self.assertEqual([1, 2], sorted(self.processor.timer_metrics["glork"]))
+
+    def test_timer_sketches(self):
+        """Timer sketches of every worker are merged."""
+        for worker in self.workers:
+            worker.timer_accuracy = 0.01
+        self.processor.timer_accuracy = 0.01
+        self.workers[0].process("glork:1|ms")
+        self.workers[1].process("glork:2|ms")
+        self.workers[1].process("gorets:3|ms")
+        self.merge()
+        sketch = self.processor.timer_metrics["glork"]
+        self.assertEqual((2, 1, 2), (sketch.count, sketch.min, sketch.max))
+        self.assertEqual(1, self.processor.timer_metrics["gorets"].count)
+
+    def test_gauges(self):
+        """The latest gauge write wins, whichever worker received it."""
+        self.now[0] = 2
+        self.workers[0].process("gorets:2|g")
+        self.now[0] = 1
+        self.workers[1].process("gorets:1|g")
+        self.merge()
+        self.assertEqual(2, self.processor.gauge_metrics["gorets"])
+
+    def test_meters(self):
+        """Meter values are summed across workers."""
+        self.workers[0].process("gorets:1|m")
+        self.workers[1].process("gorets:2|m")
+        self.merge()
+        self.assertEqual(3, self.processor.meter_metrics["gorets"].value)
+
+    def test_receive_stats(self):
+        """Receive counts are summed across workers."""
+        self.workers[0].process_datagram("gorets:1|c\nglork:1|c")
+        self.workers[1].process("gorets:1|c")
+        self.merge()
+        self.assertEqual(3, self.processor.by_type["c"])
+        self.assertEqual(1, self.processor.datagrams)
+        self.assertEqual(2, self.processor.datagram_lines)
+
+    def test_redirect_stats(self):
+        """Datagrams redirected by every worker are accounted for."""
+        self.workers[0].count_redirect_packet("relay_8125", 100, 3)
+        self.workers[1].count_redirect_packet("relay_8125", 50, 2)
+        self.merge()
+        self.assertEqual({"relay_8125": [2, 150, 5]},
+                         self.processor.redirect_packets)
+
+    def test_plugins(self):
+        """Plugin metrics are merged with their own C{merge}."""
+        for worker in self.workers:
+            worker.plugin_metrics["gorets"] = DistinctMetricReporter(
+                "gorets", wall_time_func=time.time, seed="gorets")
+        for i in range(100):
+            self.workers[i % 2].process("gorets:%d|pd" % i)
+        single = DistinctMetricReporter("gorets", seed="gorets")
+        for i in range(100):
+            single.process(["%d" % i, "pd"])
+        self.merge()
+        self.assertEqual(single.count(),
+                         self.processor.plugin_metrics["gorets"].count())
+
+    def test_flush_matches_single_process(self):
+        """
+        Flushing the merged aggregates gives the same counters and gauges as
+        a single processor receiving every message.
+        """
+        single = MessageProcessor(time_function=lambda: 42)
+        messages = ["gorets:%d|c" % i for i in range(10)] + [
+            "gauge:%d|g" % i for i in range(10)]
+        for i, message in enumerate(messages):
+            self.now[0] = i
+            self.workers[i % 2].process(message)
+            single.process(message)
+        self.merge()
+        self.assertEqual(sorted(single.flush_counter_metrics(10, 42)),
+                         sorted(self.processor.flush_counter_metrics(10, 42)))
+        self.assertEqual(sorted(single.flush_gauge_metrics(42)),
+                         sorted(self.processor.flush_gauge_metrics(42)))
+
+    def test_configurable_processor(self):
+        """Timer reporters are merged by the configurable processor."""
+        workers = [ConfigurableMessageProcessor(), ConfigurableMessageProcessor()]
+        workers[0].process("glork:1|ms")
+        workers[1].process("glork:3|ms")
+        workers[1].process("gorets:5|c")
+        processor = ConfigurableMessageProcessor()
+        processor.merge_states(
+            [pickle.loads(pickle.dumps(worker.export_state(), 2))
+             for worker in workers])
+        timer = processor.timer_metrics["glork"]
+        self.assertEqual(2, timer.count)
+        self.assertEqual(2.0, timer.mean())
+        self.assertEqual(5, processor.counter_metrics["gorets"].count)
+
+
+class FakeWorker(object):
+
+    running = True
+
+    def __init__(self, state=None):
+        self.state = state
+        self.states = []
+
+    def collect(self):
+        if self.state is None:
+            return defer.Deferred()
+        self.states.append(self.state)
+        return defer.succeed(None)
+
+
+class WorkerPoolTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.processor = MessageProcessor()
+        self.pool = WorkerPool({}, self.processor, 2, timeout=5,
+                               reactor=self.clock)
+
+    def test_collect(self):
+        """Collecting merges the state of every worker."""
+        state = MessageProcessor()
+        state.process("gorets:1|c")
+        self.pool.workers = [FakeWorker(state.export_state()),
+                             FakeWorker(state.export_state())]
+        d = self.pool.collect()
+        self.assertTrue(d.called)
+        self.assertEqual({"gorets": 1}, self.processor.counter_metrics)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_collect_timeout(self):
+        """A worker that does not answer in time does not block the flush."""
+        state = MessageProcessor()
+        state.process("gorets:1|c")
+        self.pool.workers = [FakeWorker(state.export_state()), FakeWorker()]
+        d = self.pool.collect()
+        self.assertFalse(d.called)
+        self.clock.advance(5)
+        self.assertTrue(d.called)
+        self.assertEqual({"gorets": 1}, self.processor.counter_metrics)
+
+
+class ReusePortTest(TestCase):
+
+    def test_shared_port(self):
+        """Two sockets of L{ReusePort} can bind the same UDP port."""
+        first = ReusePort(0, DatagramProtocol()).createInternetSocket()
+        self.addCleanup(first.close)
+        first.bind(("127.0.0.1", 0))
+        port = first.getsockname()[1]
+        second = ReusePort(port, DatagramProtocol()).createInternetSocket()
+        self.addCleanup(second.close)
+        second.bind(("127.0.0.1", port))
+        self.assertEqual(port, second.getsockname()[1])